@@ -0,0 +1,63 @@
+"""Time to first token of the chat mode, against the stand-in LLM server.
+
+A scripted conversation is run on the database of DB_PATH: the follow-up questions of
+a topic reuse its documents, a new topic retrieves them again. The first turn includes
+nothing of the model loading, the session is warmed up before.
+
+    python -m benchmarks.chat
+    python -m benchmarks.chat --questions questions.txt --first-token-delay 0.3
+"""
+
+import argparse
+import os
+import time
+
+from benchmarks.llm_server import StandInLLMServer
+from src.chat import ChatSession
+from src.query import QueryEngine
+
+
+QUESTIONS = [
+    'When is the next team offsite?',
+    'And where is the team offsite this year?',
+    'Who organizes the team offsite?',
+    'What did the bank send about my last transfer?',
+    'Was the bank transfer refunded?',
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='chat mode time to first token')
+    parser.add_argument('--questions', help='text file, one question per line, the questions are scripted by default')
+    parser.add_argument('--n_results', type=int, default=3)
+    parser.add_argument('--first-token-delay', type=float, default=0.2, help='latency of the stand-in LLM')
+    args = parser.parse_args()
+
+    questions = QUESTIONS
+    if args.questions:
+        with open(args.questions, 'r') as questions_file:
+            questions = [line.strip() for line in questions_file if line.strip()]
+
+    with StandInLLMServer(first_token_delay=args.first_token_delay, token_delay=0.0) as server:
+        start = time.perf_counter()
+        engine = QueryEngine(os.environ.get('DB_PATH', './chroma'), 'stand-in', server.base_url)
+        engine.warm_up()
+        session = ChatSession(engine, args.n_results)
+        print(f'warm up {time.perf_counter() - start:.2f} s, stand-in first token delay {args.first_token_delay:.2f} s')
+
+        for question in questions:
+            answer = ''.join(session.ask(question))
+            turn = session.last_turn
+            print(
+                f'ttft {turn["ttft"]:.3f} s  retrieval {turn["retrieval"]:.3f} s  '
+                f'{"reused " if turn["reused"] else "searched"}  '
+                f'history {len(session.history) // 2} turns  {question}'
+            )
+            assert answer == server.answer, 'the streamed answer differs from the stand-in answer'
+
+        sent = server.requests[-1]['messages']
+        print(f'{len(sent)} messages sent with the last question (system, history, prompt)')
+
+
+if __name__ == '__main__':
+    main()
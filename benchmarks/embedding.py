@@ -0,0 +1,97 @@
+"""Benchmark of the embedding backends: throughput and retrieval recall on a fixed corpus.
+
+Each query is built from the words of one document of the corpus, the recall@k is the
+share of queries whose document is in the k nearest neighbours. The overlap@k is the
+share of the torch neighbours also returned by the backend.
+
+    python -m benchmarks.embedding --backends torch,onnx,onnx-int8 --docs 2000
+"""
+
+import argparse
+import random
+import time
+
+from typing import Dict, List, Tuple
+
+from src.embedding.service import BACKENDS, EmbeddingService, get_model_name
+
+
+TOPICS = {
+    'travel': 'flight hotel passport luggage airport train booking visa itinerary museum beach rental',
+    'work': 'meeting deadline report client invoice budget roadmap review manager slides contract quarter',
+    'health': 'doctor appointment prescription vaccine dentist allergy pharmacy insurance therapy checkup',
+    'cooking': 'recipe oven garlic onion pasta butter flour sauce roast bake simmer spices',
+    'home': 'rent plumber furniture garden repair electricity mortgage landlord paint kitchen heating',
+    'money': 'bank transfer savings taxes refund salary pension stocks loan payment receipt',
+}
+FILLER = 'the a about with for and then before after this next our my please remember to'.split()
+
+
+def make_corpus(n_docs: int, n_queries: int, seed: int) -> Tuple[List[str], List[str], List[int]]:
+    rng = random.Random(seed)
+    topics = {name: words.split() for name, words in TOPICS.items()}
+
+    documents = []
+    for _ in range(n_docs):
+        topic = rng.choice(list(topics))
+        sentences = []
+        for _ in range(rng.randint(2, 12)):
+            words = rng.choices(topics[topic], k=rng.randint(3, 8)) + rng.choices(FILLER, k=rng.randint(2, 6))
+            rng.shuffle(words)
+            sentences.append(' '.join(words).capitalize() + '.')
+        documents.append(' '.join(sentences))
+
+    targets = rng.sample(range(n_docs), min(n_queries, n_docs))
+    queries = [' '.join(rng.sample(documents[i].replace('.', '').lower().split(), 6)) for i in targets]
+    return documents, queries, targets
+
+
+def nearest(document_vectors, query_vectors, k: int) -> List[List[int]]:
+    import numpy as np
+
+    documents = np.asarray(document_vectors, dtype=np.float32)
+    queries = np.asarray(query_vectors, dtype=np.float32)
+    documents /= np.linalg.norm(documents, axis=1, keepdims=True)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return np.argsort(-queries @ documents.T, axis=1)[:, :k].tolist()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='embedding backends benchmark')
+    parser.add_argument('--backends', default=','.join(BACKENDS), help='comma separated backends')
+    parser.add_argument('--model', default=get_model_name())
+    parser.add_argument('--docs', type=int, default=2000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    documents, queries, targets = make_corpus(args.docs, args.queries, args.seed)
+    reference: Dict[int, List[int]] = {}
+
+    print(f'{len(documents)} documents, {len(queries)} queries, model {args.model}')
+    for backend in args.backends.split(','):
+        service = EmbeddingService(args.model, backend)
+        service.embed(documents[:8])
+
+        start = time.perf_counter()
+        document_vectors = service.embed(documents)
+        elapsed = time.perf_counter() - start
+
+        neighbours = nearest(document_vectors, service.embed(queries), args.k)
+        recall = sum(target in found for target, found in zip(targets, neighbours)) / len(queries)
+
+        if not reference:
+            reference = dict(enumerate(neighbours))
+        overlap = sum(
+            len(set(found) & set(reference[i])) for i, found in enumerate(neighbours)
+        ) / (len(queries) * args.k)
+
+        print(
+            f'{backend:<10} {len(documents) / elapsed:>8.1f} docs/s '
+            f'recall@{args.k} {recall:.3f}  overlap@{args.k} {overlap:.3f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
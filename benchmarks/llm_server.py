@@ -0,0 +1,170 @@
+"""Local stand-in of an OpenAI compatible chat completion server, to measure the query
+paths without paying for (or waiting on) a real LLM.
+
+The answer is a fixed text streamed word by word, after a configurable delay before
+the first token and between the tokens. It can also be run on its own:
+
+    python -m benchmarks.llm_server --port 8765 --first-token-delay 0.3
+    BASE_URL=http://127.0.0.1:8765/v1 python main.py --mode='chat'
+"""
+
+import argparse
+import json
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+
+ANSWER = 'This is a stand-in answer, streamed word by word to measure the latency of the query path.'
+
+
+class StandInLLMHandler(BaseHTTPRequestHandler):
+
+    server: 'StandInLLMServer'
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_error(404)
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        self.server.record(request)
+
+        # A failure is returned for the first requests when fail_first is set, to exercise the retries
+        if self.server.should_fail():
+            error_type = 'rate_limit_error' if self.server.fail_status == 429 else 'server_error'
+            body = json.dumps({'error': {'message': 'stand-in overload', 'type': error_type}}).encode()
+            self.send_response(self.server.fail_status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        time.sleep(self.server.first_token_delay)
+        words = self.server.answer.split(' ')
+        model = request.get('model', 'stand-in')
+
+        if not request.get('stream'):
+            body = json.dumps({
+                'id': 'chatcmpl-stand-in',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': self.server.answer}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': 0, 'completion_tokens': len(words), 'total_tokens': len(words)},
+            }).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(self.server.token_delay)
+            chunk = {
+                'id': 'chatcmpl-stand-in',
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{'index': 0, 'delta': {'content': word if i == 0 else ' ' + word}, 'finish_reason': None}],
+            }
+            self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+            self.wfile.flush()
+
+        self.wfile.write(b'data: [DONE]\n\n')
+        self.wfile.flush()
+        self.close_connection = True
+
+
+class StandInLLMServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(
+            self,
+            port: int = 0,
+            first_token_delay: float = 0.2,
+            token_delay: float = 0.01,
+            answer: str = ANSWER,
+            fail_first: int = 0,
+            fail_status: int = 503
+    ):
+        """Start the stand-in server in a background thread.
+
+        Args:
+            port (int, optional): the port, 0 for a free one. Defaults to 0.
+            first_token_delay (float, optional): seconds before the first token. Defaults to 0.2.
+            token_delay (float, optional): seconds between two tokens. Defaults to 0.01.
+            answer (str, optional): the streamed answer. Defaults to ANSWER.
+            fail_first (int, optional): number of requests answered with an error first. Defaults to 0.
+            fail_status (int, optional): HTTP status of these errors, 429 or a 5xx. Defaults to 503.
+        """
+
+        super().__init__(('127.0.0.1', port), StandInLLMHandler)
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+        self.answer = answer
+        self.fail_first = fail_first
+        self.fail_status = fail_status
+        self.requests: List[Dict] = []
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}/v1'
+
+    def record(self, request: Dict):
+        with self._lock:
+            self.requests.append(request)
+
+    def should_fail(self) -> bool:
+        with self._lock:
+            if self.fail_first > 0:
+                self.fail_first -= 1
+                return True
+            return False
+
+    def __enter__(self) -> 'StandInLLMServer':
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='stand-in OpenAI compatible server')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--first-token-delay', type=float, default=0.2)
+    parser.add_argument('--token-delay', type=float, default=0.01)
+    args = parser.parse_args()
+
+    server = StandInLLMServer(args.port, args.first_token_delay, args.token_delay)
+    print(f'Serving on {server.base_url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Micro-benchmark of the html to text conversion of the notes and mails.
+
+Compares src.ingestion.text with the previous BeautifulSoup path (when bs4 is installed)
+on a synthetic corpus of notes and mail replies.
+
+    python -m benchmarks.normalize --docs 2000 --repeat 5
+"""
+
+import argparse
+import random
+import time
+
+from typing import Callable, List
+
+from src.ingestion.text import html_to_text, normalize_mail
+
+
+WORDS = (
+    'meeting budget report apple notes project review deadline invoice travel '
+    'draft summary client update plan schedule design budget question answer'
+).split()
+
+
+def make_note(rng: random.Random) -> str:
+    lines = []
+    for _ in range(rng.randint(5, 40)):
+        text = ' '.join(rng.choices(WORDS, k=rng.randint(3, 20)))
+        kind = rng.random()
+        if kind < 0.15:
+            lines.append(f'<ul><li>{text}</li><li>{text} &amp; more</li></ul>')
+        elif kind < 0.25:
+            lines.append('<div><br></div>')
+        else:
+            lines.append(f'<div>{text} <b>{rng.choice(WORDS)}</b> &lt;{rng.choice(WORDS)}&gt;</div>')
+    return ''.join(lines)
+
+
+def make_mail(rng: random.Random) -> str:
+    body = make_note(rng)
+    quoted = make_note(rng) * rng.randint(1, 3)
+    return (
+        f'<html><head><style>p {{ color: red; }}</style></head><body>{body}'
+        f'<div>--<br>John Appleseed<br>Apple Park</div>'
+        f'<div class="gmail_quote">On Mon, Jan 1, 2024, Bob wrote:<blockquote type="cite">{quoted}</blockquote></div>'
+        f'</body></html>'
+    )
+
+
+def run(name: str, convert: Callable[[str], str], docs: List[str], repeat: int):
+    size = sum(len(doc) for doc in docs) / 1e6
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        texts = [convert(doc) for doc in docs]
+        best = min(best, time.perf_counter() - start)
+
+    words = sum(len(text.split()) for text in texts)
+    print(f'{name:<28} {len(docs) / best:>10.0f} docs/s {size / best:>8.1f} MB/s {words:>10} words')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='html to text micro-benchmark')
+    parser.add_argument('--docs', type=int, default=2000, help='number of notes and of mails')
+    parser.add_argument('--repeat', type=int, default=5, help='the best run is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    notes = [make_note(rng) for _ in range(args.docs)]
+    mails = [make_mail(rng) for _ in range(args.docs)]
+
+    try:
+        from bs4 import BeautifulSoup
+
+        def soup_text(html: str) -> str:
+            return BeautifulSoup(html, 'html.parser').get_text(separator=' ', strip=True)
+
+        run('notes  beautifulsoup', soup_text, notes, args.repeat)
+        run('mails  beautifulsoup', soup_text, mails, args.repeat)
+    except ImportError:
+        print('bs4 is not installed, the BeautifulSoup baseline is skipped.')
+
+    run('notes  html_to_text', html_to_text, notes, args.repeat)
+    run('mails  normalize_mail', lambda html: normalize_mail(html, is_html=True), mails, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""Startup time of each mode of main.py, measured with `python -X importtime`.
+
+The modules imported by each mode are imported in a fresh interpreter, the import
+time is the sum of the cumulative time of the top level imports (best of --repeat runs).
+The run fails if a mode goes over its budget, or imports a heavy module it does not need.
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --budget benchmarks/startup_budget.json --repeat 5
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from typing import Dict, List, Set, Tuple
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The imports done by main.py for each mode
+MODES: Dict[str, List[str]] = {
+    'help': [],
+    'query': ['src.daemon.client'],
+    'query-in-process': ['src.daemon.client', 'src.query'],
+    'chat': ['src.chat'],
+    'daemon': ['src.daemon.server'],
+    'serve': ['src.api.app'],
+    'batch': ['src.batch'],
+    'sync': ['src.ingestion.notes.ingestion', 'src.ingestion.mails.ingestion'],
+    'auto-sync': ['src.ingestion.auto_sync.listen'],
+}
+
+# Modules a mode must not import at startup
+FORBIDDEN: Dict[str, Set[str]] = {
+    'help': {'chromadb', 'openai', 'torch', 'sentence_transformers', 'onnxruntime'},
+    'query': {'chromadb', 'openai', 'torch', 'sentence_transformers', 'onnxruntime'},
+    'query-in-process': {'torch', 'sentence_transformers', 'onnxruntime'},
+    'chat': {'torch', 'sentence_transformers', 'onnxruntime'},
+    'daemon': {'torch', 'sentence_transformers', 'onnxruntime'},
+    'serve': {'torch', 'sentence_transformers', 'onnxruntime'},
+    'batch': {'torch', 'sentence_transformers', 'onnxruntime'},
+    'sync': {'openai', 'torch', 'sentence_transformers', 'onnxruntime'},
+    'auto-sync': {'openai', 'torch', 'sentence_transformers', 'onnxruntime'},
+}
+
+DEFAULT_BUDGET_PATH = os.path.join(ROOT, 'benchmarks', 'startup_budget.json')
+
+
+def measure(modules: List[str]) -> Tuple[float, Dict[str, float]]:
+    """Import main.py and the modules of a mode in a fresh interpreter.
+
+    Args:
+        modules (List[str]): the modules imported by the mode.
+
+    Returns:
+        Tuple[float, Dict[str, float]]: the total import time and the cumulative time of each module, in ms.
+    """
+
+    code = '; '.join(['import main'] + [f'import {module}' for module in modules])
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=ROOT,
+        capture_output=True,
+        text=True
+    )
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1])
+
+    # import time: self [us] | cumulative | imported package
+    total = 0.0
+    cumulative: Dict[str, float] = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, time_cumulative, name = line[len('import time:'):].split('|')
+        cumulative[name.strip()] = int(time_cumulative) / 1000
+        if not name.startswith('  '):
+            total += int(time_cumulative) / 1000
+
+    return total, cumulative
+
+
+def main():
+    parser = argparse.ArgumentParser(description='main.py startup time per mode')
+    parser.add_argument('--budget', default=DEFAULT_BUDGET_PATH, help='json file of the budget of each mode, in ms')
+    parser.add_argument('--repeat', type=int, default=3, help='the best run is reported')
+    parser.add_argument('--top', type=int, default=5, help='number of heaviest modules shown')
+    args = parser.parse_args()
+
+    with open(args.budget, 'r') as budget_file:
+        budgets = json.load(budget_file)
+
+    failures = []
+    for mode, modules in MODES.items():
+        runs = [measure(modules) for _ in range(args.repeat)]
+        total, cumulative = min(runs, key=lambda run: run[0])
+
+        heaviest = sorted(
+            ((name, ms) for name, ms in cumulative.items() if '.' not in name),
+            key=lambda item: -item[1]
+        )[:args.top]
+        forbidden = sorted(FORBIDDEN.get(mode, set()) & set(cumulative))
+        budget = budgets.get(mode)
+
+        status = 'ok'
+        if forbidden:
+            status = f'imports {", ".join(forbidden)}'
+        elif budget is not None and total > budget:
+            status = f'over budget ({budget} ms)'
+        if status != 'ok':
+            failures.append(mode)
+
+        print(f'{mode:<18} {total:>8.1f} ms  {status}')
+        print('    ' + ', '.join(f'{name} {ms:.0f} ms' for name, ms in heaviest))
+
+    if failures:
+        print(f'Startup regression in: {", ".join(failures)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
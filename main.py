@@ -2,11 +2,6 @@ import argparse
 import os
 import logging
 
-from src.ingestion.notes.ingestion import sync_notes_data
-from src.ingestion.mails.ingestion import sync_mails_data
-from src.ingestion.auto_sync.listen import start_auto_sync
-from src.query import query
-
 from dotenv import load_dotenv
 from colorama import Fore, Style
 
@@ -30,7 +25,11 @@ def main():
         '--mode',
         choices=[
             'sync',
-            'query'
+            'query',
+            'chat',
+            'daemon',
+            'serve',
+            'batch'
         ]
     )
 
@@ -63,18 +62,112 @@ def main():
         default=3,
         help='Number of documents to return'
     )
+    parser.add_argument(
+        '--no_cache',
+        action='store_true',
+        default=False,
+        help='Ask the LLM again instead of reusing the cached answer of a similar question'
+    )
+    parser.add_argument(
+        '--retrieval',
+        choices=['vector', 'hybrid', 'lexical'],
+        default=None,
+        help='Retrieval of the query mode, lexical does not load the embedding model (default: RAG_RETRIEVAL or vector)'
+    )
+    parser.add_argument(
+        '--after',
+        help='Only the notes created and the mails received on this date or later, like 2024-03-01'
+    )
+    parser.add_argument(
+        '--before',
+        help='Only the notes created and the mails received before this date, like 2024-04-01'
+    )
+    parser.add_argument(
+        '--sender',
+        help='Only the mails of this address'
+    )
+    parser.add_argument(
+        '--folder',
+        help='Only the notes of this folder and the mails of this mailbox'
+    )
+
+    # Batch args
+    parser.add_argument(
+        '--input',
+        help='jsonl file of the questions of the batch mode, one {"id": ..., "query": ...} per line'
+    )
+    parser.add_argument(
+        '--output',
+        help='jsonl file of the answers of the batch mode, stdout by default'
+    )
 
     # get the args values
     args = parser.parse_args()
     
+    # Each mode only imports what it uses, chromadb, openai and the embedding
+    # model are slow to import (see benchmarks/startup.py)
     if args.mode == 'sync' and args.auto:
+        from src.ingestion.auto_sync.listen import start_auto_sync
+
         start_auto_sync()
         
     elif args.mode == 'sync':
+        from src.ingestion.notes.ingestion import sync_notes_data
+        from src.ingestion.mails.ingestion import sync_mails_data
+
         sync_notes_data(db_path=os.environ.get('DB_PATH', './chroma'), **vars(args))
         sync_mails_data(db_path=os.environ.get('DB_PATH', './chroma'), **vars(args))
 
+    elif args.mode == 'daemon':
+        from src.daemon.server import serve
+
+        serve(
+            api_key=os.environ.get('API_KEY', ''),
+            base_url=os.environ.get('BASE_URL', ''),
+            db_path=os.environ.get('DB_PATH', './chroma'),
+            **vars(args)
+        )
+
+    elif args.mode == 'chat':
+        from src.chat import chat
+
+        chat(
+            api_key=os.environ.get('API_KEY', ''),
+            base_url=os.environ.get('BASE_URL', ''),
+            db_path=os.environ.get('DB_PATH', './chroma'),
+            **vars(args)
+        )
+
+    elif args.mode == 'serve':
+        from src.api.app import serve
+
+        serve(
+            api_key=os.environ.get('API_KEY', ''),
+            base_url=os.environ.get('BASE_URL', ''),
+            db_path=os.environ.get('DB_PATH', './chroma'),
+            **vars(args)
+        )
+
+    elif args.mode == 'batch':
+        from src.batch import batch
+
+        batch(
+            api_key=os.environ.get('API_KEY', ''),
+            base_url=os.environ.get('BASE_URL', ''),
+            db_path=os.environ.get('DB_PATH', './chroma'),
+            **vars(args)
+        )
+
     elif args.mode == 'query':
+        from src.daemon.client import query_daemon
+
+        # The question is sent to the query daemon when it runs, it keeps the model and the clients warm
+        use_daemon = os.environ.get('RAG_DAEMON', 'auto') != 'off'
+        if use_daemon and query_daemon(db_path=os.environ.get('DB_PATH', './chroma'), **vars(args)):
+            return
+
+        from src.query import query
+
         query(
             api_key=os.environ.get('API_KEY', ''),
             base_url=os.environ.get('BASE_URL', ''),
@@ -0,0 +1,314 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from array import array
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+
+_logger = logging.getLogger(name='ANSWER_CACHE')
+
+
+class AnswerCache():
+
+    def __init__(
+            self,
+            path: str,
+            max_entries: int = 1000,
+            max_bytes: int = 50 * 1024 * 1024,
+            threshold: float = 0.95
+    ):
+        """Open (or create) the sqlite cache of the LLM answers. The answers are looked up
+        by the similarity of the question embeddings.
+
+        Args:
+            path (str): Location of the sqlite file.
+            max_entries (int, optional): Number of answers kept, the least recently used are evicted. Defaults to 1000.
+            max_bytes (int, optional): Size of the prompts and answers kept. Defaults to 50 MB.
+            threshold (float, optional): Cosine similarity from which two questions have the same answer. Defaults to 0.95.
+        """
+
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        # Vectors of the answers of each context, loaded from the file when it changes
+        self._matrices: Dict[str, Tuple[List[int], np.ndarray]] = {}
+        self._data_version: Optional[int] = None
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS answers (
+                id INTEGER PRIMARY KEY,
+                context TEXT NOT NULL,
+                query TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                prompt TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                documents TEXT NOT NULL,
+                versions TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            )
+            '''
+        )
+        self._connection.execute('CREATE INDEX IF NOT EXISTS answers_context ON answers (context)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS answers_last_used ON answers (last_used)')
+        self._connection.commit()
+
+    def _matrix(self, context: str) -> Tuple[List[int], np.ndarray]:
+        """Get the ids and the normalized vectors of the answers of a context.
+
+        Args:
+            context (str): the context, see QueryEngine.cache_context.
+
+        Returns:
+            Tuple[List[int], np.ndarray]: the entry ids and their vectors, one per row.
+        """
+
+        # data_version changes when another process writes the file
+        (data_version,) = self._connection.execute('PRAGMA data_version').fetchone()
+        if data_version != self._data_version:
+            self._matrices = {}
+            self._data_version = data_version
+
+        if context not in self._matrices:
+            rows = self._connection.execute(
+                'SELECT id, vector FROM answers WHERE context = ?',
+                (context,)
+            ).fetchall()
+            vectors = [np.frombuffer(blob, dtype=np.float32) for _, blob in rows]
+            self._matrices[context] = (
+                [entry_id for entry_id, _ in rows],
+                np.stack(vectors) if vectors else np.empty((0, 0), dtype=np.float32)
+            )
+
+        return self._matrices[context]
+
+    def _similar(self, context: str, vector: np.ndarray) -> List[Tuple[float, int]]:
+        """Find the answers of the questions similar to a question.
+
+        Args:
+            context (str): the context of the question.
+            vector (np.ndarray): the normalized question vector.
+
+        Returns:
+            List[Tuple[float, int]]: the similarity and the id of the entries above the threshold, the closest first.
+        """
+
+        ids, matrix = self._matrix(context)
+        if not ids or matrix.shape[1] != vector.shape[0]:
+            return []
+
+        similarities = matrix @ vector
+        return sorted(
+            ((float(similarity), entry_id) for similarity, entry_id in zip(similarities, ids) if similarity >= self.threshold),
+            reverse=True
+        )
+
+    def search(self, context: str, vector: Sequence[float]) -> Optional[Dict[str, Any]]:
+        """Look up the answer of the closest question.
+
+        Args:
+            context (str): the context of the question.
+            vector (Sequence[float]): the question vector.
+
+        Returns:
+            Optional[Dict[str, Any]]: the entry: id, query, prompt, answer, documents, versions,
+                fingerprint and similarity. None if no question is similar enough.
+        """
+
+        with self._lock:
+            similar = self._similar(context, normalize(vector))
+            row = None
+            if similar:
+                row = self._connection.execute(
+                    'SELECT id, query, prompt, answer, documents, versions, fingerprint FROM answers WHERE id = ?',
+                    (similar[0][1],)
+                ).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        entry_id, query, prompt, answer, documents, versions, fingerprint = row
+        return {
+            'id': entry_id,
+            'query': query,
+            'prompt': prompt,
+            'answer': answer,
+            'documents': json.loads(documents),
+            'versions': json.loads(versions),
+            'fingerprint': fingerprint,
+            'similarity': similar[0][0],
+        }
+
+    def touch(self, entry_id: int, versions: Optional[Dict[str, str]] = None):
+        """Record that an answer was served.
+
+        Args:
+            entry_id (int): id of the entry.
+            versions (Optional[Dict[str, str]], optional): the collection versions the answer was checked against. Defaults to None.
+        """
+
+        self.hits += 1
+        with self._lock:
+            if versions is None:
+                self._connection.execute(
+                    'UPDATE answers SET last_used = ?, hits = hits + 1 WHERE id = ?',
+                    (time.time(), entry_id)
+                )
+            else:
+                self._connection.execute(
+                    'UPDATE answers SET last_used = ?, hits = hits + 1, versions = ? WHERE id = ?',
+                    (time.time(), json.dumps(versions, sort_keys=True), entry_id)
+                )
+            self._connection.commit()
+
+    def delete(self, entry_id: int):
+        """Delete an answer whose documents changed.
+
+        Args:
+            entry_id (int): id of the entry.
+        """
+
+        self.misses += 1
+        with self._lock:
+            self._connection.execute('DELETE FROM answers WHERE id = ?', (entry_id,))
+            self._connection.commit()
+            self._matrices = {}
+
+    def put(
+            self,
+            context: str,
+            query: str,
+            vector: Sequence[float],
+            prompt: str,
+            answer: str,
+            documents: List[List[str]],
+            versions: Dict[str, str],
+            fingerprint: str
+    ):
+        """Store an answer and evict the oldest entries if needed.
+
+        Args:
+            context (str): the context of the question.
+            query (str): the question.
+            vector (Sequence[float]): the question vector.
+            prompt (str): the prompt sent to the LLM.
+            answer (str): the answer of the LLM.
+            documents (List[List[str]]): the source and the id of the documents of the prompt.
+            versions (Dict[str, str]): the collection versions read before the retrieval.
+            fingerprint (str): hash of the documents of the prompt.
+        """
+
+        vector = normalize(vector)
+        size = len(prompt.encode('utf-8')) + len(answer.encode('utf-8')) + vector.nbytes
+
+        with self._lock:
+            # The question was asked again without the cache, the new answer replaces the old ones
+            replaced = [entry_id for _, entry_id in self._similar(context, vector)]
+            if replaced:
+                self._connection.execute(
+                    f'DELETE FROM answers WHERE id IN ({",".join("?" * len(replaced))})',
+                    replaced
+                )
+
+            self._connection.execute(
+                'INSERT INTO answers (context, query, vector, prompt, answer, documents, versions, fingerprint, size, last_used) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    context,
+                    query,
+                    array('f', vector).tobytes(),
+                    prompt,
+                    answer,
+                    json.dumps(documents),
+                    json.dumps(versions, sort_keys=True),
+                    fingerprint,
+                    size,
+                    time.time()
+                )
+            )
+            self._evict()
+            self._connection.commit()
+            self._matrices = {}
+
+    def _evict(self):
+        """Delete the least recently used entries above max_entries or max_bytes.
+        """
+
+        rows = self._connection.execute('SELECT id, size FROM answers ORDER BY last_used DESC').fetchall()
+
+        kept_bytes = 0
+        evicted = []
+        for position, (entry_id, size) in enumerate(rows):
+            kept_bytes += size
+            if position >= self.max_entries or kept_bytes > self.max_bytes:
+                evicted.append(entry_id)
+
+        # sqlite limits the number of bound parameters, we delete by chunks
+        for start in range(0, len(evicted), 500):
+            chunk = evicted[start:start + 500]
+            self._connection.execute(f'DELETE FROM answers WHERE id IN ({",".join("?" * len(chunk))})', chunk)
+        if evicted:
+            _logger.info(f'Evicted {len(evicted)} answers from the cache.')
+
+    def stats(self) -> Dict[str, int]:
+        """Get the hit and miss counters of the cache.
+
+        Returns:
+            Dict[str, int]: hits and misses since the cache was opened.
+        """
+
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def normalize(vector: Sequence[float]) -> np.ndarray:
+    """Bring a vector to unit length, the similarity of two questions is then a dot product.
+
+    Args:
+        vector (Sequence[float]): the question vector.
+
+    Returns:
+        np.ndarray: the float32 unit vector.
+    """
+
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def get_answer_cache(db_path: str) -> Optional[AnswerCache]:
+    """Open the answer cache configured by the env variables.
+
+    Args:
+        db_path (str): Location of the chroma db, the cache is stored next to it by default.
+
+    Returns:
+        Optional[AnswerCache]: the cache, None if ANSWER_CACHE is off.
+    """
+
+    if os.environ.get('ANSWER_CACHE', 'on') == 'off':
+        return None
+
+    return AnswerCache(
+        path=os.environ.get('ANSWER_CACHE_PATH', os.path.join(db_path, 'answer_cache.sqlite')),
+        max_entries=int(os.environ.get('ANSWER_CACHE_MAX_ENTRIES', 1000)),
+        max_bytes=int(os.environ.get('ANSWER_CACHE_MAX_BYTES', 50 * 1024 * 1024)),
+        threshold=float(os.environ.get('ANSWER_CACHE_SIMILARITY', 0.95))
+    )
@@ -0,0 +1,447 @@
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+import uvicorn
+
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Sequence
+
+from src.api.stats import LatencyStats
+from src.metadata import parse_filters
+from src.query import QueryEngine
+from src.retrieval import RETRIEVAL_MODES
+
+
+_logger = logging.getLogger(name='RAG_API')
+
+Receive = Callable[[], Awaitable[Dict[str, Any]]]
+Send = Callable[[Dict[str, Any]], Awaitable[None]]
+
+SYNC_SOURCES = ('notes', 'mails')
+
+
+class HttpError(Exception):
+
+    def __init__(self, status: int, message: str):
+        """Error returned to the client as a json body.
+
+        Args:
+            status (int): the http status.
+            message (str): the error message.
+        """
+
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class RagApp():
+
+    def __init__(self, engine: QueryEngine, max_concurrency: Optional[int] = None, max_queue: Optional[int] = None):
+        """ASGI application answering the questions over http. All the requests share the
+        engine, so the embedding model and the clients are loaded once.
+
+            POST /query   {"query": ..., "n_results": 3, "no_cache": false, "debug": false, "retrieval": null, "filters": {}}
+                          answer streamed as SSE
+            POST /search  {"query": ..., "n_results": 3, "retrieval": null, "filters": {}}  the documents, without the LLM
+
+        The filters are "after" and "before" (ISO dates or timestamps), "sender" and "folder".
+            POST /sync    {"sources": ["notes", "mails"]}  start an incremental sync
+            GET  /sync    state of the last sync
+            GET  /stats   latency percentiles and load
+            GET  /health
+
+        Args:
+            engine (QueryEngine): the query engine.
+            max_concurrency (Optional[int], optional): Number of questions answered at once.
+                Defaults to the RAG_SERVE_CONCURRENCY env variable, 4.
+            max_queue (Optional[int], optional): Number of questions waiting for a slot, the next ones are refused.
+                Defaults to the RAG_SERVE_QUEUE env variable, 32.
+        """
+
+        self.engine = engine
+        self.max_concurrency = max_concurrency or int(os.environ.get('RAG_SERVE_CONCURRENCY', 4))
+        self.max_queue = max_queue if max_queue is not None else int(os.environ.get('RAG_SERVE_QUEUE', 32))
+        self.stats = LatencyStats()
+
+        self.active = 0
+        self.waiting = 0
+        self._slots: Optional[asyncio.Semaphore] = None
+
+        self.sync_state: Dict[str, Any] = {'running': False}
+        self._sync_lock = threading.Lock()
+
+        self.routes = {
+            ('POST', '/query'): self.query,
+            ('POST', '/search'): self.search,
+            ('POST', '/sync'): self.start_sync,
+            ('GET', '/sync'): self.get_sync,
+            ('GET', '/stats'): self.get_stats,
+            ('GET', '/health'): self.health,
+        }
+
+    async def __call__(self, scope: Dict[str, Any], receive: Receive, send: Send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        handler = self.routes.get((scope['method'], scope['path']))
+        try:
+            if handler is None:
+                raise HttpError(404, f'No route {scope["method"]} {scope["path"]}.')
+            await handler(await read_json(receive), receive, send)
+        except HttpError as e:
+            await send_json(send, e.status, {'error': e.message})
+        except Exception as e:
+            _logger.exception(e)
+            await send_json(send, 500, {'error': str(e)})
+
+    async def lifespan(self, receive: Receive, send: Send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # The semaphore belongs to the loop of the server
+                self._slots = asyncio.Semaphore(self.max_concurrency)
+                await asyncio.to_thread(self.engine.warm_up)
+                _logger.info('Model and clients loaded.')
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @contextlib.asynccontextmanager
+    async def slot(self, metric: str) -> AsyncIterator[None]:
+        """Wait for a free slot, the requests above max_queue are refused.
+
+        Args:
+            metric (str): name of the endpoint, the waiting time is recorded as '<metric>.queue'.
+
+        Raises:
+            HttpError: 503 if too many requests are waiting.
+        """
+
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        if self.waiting >= self.max_queue:
+            raise HttpError(503, 'Too many requests waiting, retry later.')
+
+        start = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.stats.record(f'{metric}.queue', time.perf_counter() - start)
+
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._slots.release()
+
+    async def query(self, body: Dict[str, Any], receive: Receive, send: Send):
+        question = require(body, 'query')
+        n_results = int(body.get('n_results', 3))
+        retrieval = retrieval_mode(body)
+        filters = search_filters(body)
+
+        start = time.perf_counter()
+        async with self.slot('query'):
+            prompt, answer = await self.engine.answer_async(
+                question,
+                n_results,
+                use_cache=not body.get('no_cache', False),
+                retrieval=retrieval,
+                filters=filters
+            )
+
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache')],
+            })
+            if body.get('debug'):
+                await send_event(send, 'prompt', prompt)
+
+            # The answer is not streamed further once the client is gone
+            disconnected = asyncio.ensure_future(wait_disconnect(receive))
+            first_token = None
+            try:
+                async for content in answer:
+                    if disconnected.done():
+                        _logger.info('Client disconnected, the answer is stopped.')
+                        break
+                    if first_token is None:
+                        first_token = time.perf_counter() - start
+                        self.stats.record('query.ttft', first_token)
+                    await send_event(send, 'token', content)
+                else:
+                    await send_event(send, 'done', {
+                        'seconds': round(time.perf_counter() - start, 3),
+                        'ttft': round(first_token, 3) if first_token is not None else None,
+                    })
+            except Exception as e:
+                _logger.exception(e)
+                await send_event(send, 'error', str(e))
+            finally:
+                disconnected.cancel()
+                await answer.aclose() # type: ignore
+
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+        self.stats.record('query', time.perf_counter() - start)
+
+    async def search(self, body: Dict[str, Any], receive: Receive, send: Send):
+        question = require(body, 'query')
+        n_results = int(body.get('n_results', 3))
+        retrieval = retrieval_mode(body)
+        filters = search_filters(body)
+
+        start = time.perf_counter()
+        async with self.slot('search'):
+            documents, complete = await self.engine.retriever.retrieve_async(
+                question,
+                n_results,
+                timeout=float(os.environ.get('RAG_SEARCH_TIMEOUT', 2)),
+                mode=retrieval,
+                filters=filters
+            )
+
+        self.stats.record('search', time.perf_counter() - start)
+        await send_json(send, 200, {'documents': documents, 'complete': complete})
+
+    async def start_sync(self, body: Dict[str, Any], receive: Receive, send: Send):
+        sources = body.get('sources') or list(SYNC_SOURCES)
+        unknown = set(sources) - set(SYNC_SOURCES)
+        if unknown:
+            raise HttpError(400, f'Unknown sources {sorted(unknown)}, expected {list(SYNC_SOURCES)}.')
+
+        with self._sync_lock:
+            if self.sync_state['running']:
+                raise HttpError(409, 'A sync is already running.')
+            self.sync_state = {'running': True, 'sources': sources, 'started': time.time()}
+
+        threading.Thread(target=self.run_sync, args=(sources,), daemon=True).start()
+        await send_json(send, 202, self.sync_state)
+
+    def run_sync(self, sources: Sequence[str]):
+        """Sync the sources in a background thread, the questions are still answered meanwhile.
+
+        Args:
+            sources (Sequence[str]): 'notes' and/or 'mails'.
+        """
+
+        errors: Dict[str, str] = {}
+        for source in sources:
+            try:
+                # The ingestion modules are only imported when a sync is requested
+                if source == 'notes':
+                    from src.ingestion.notes.ingestion import sync_notes_data
+
+                    sync_notes_data(flush=False, db_path=self.engine.db_path)
+                else:
+                    from src.ingestion.mails.ingestion import sync_mails_data
+
+                    sync_mails_data(flush=False, db_path=self.engine.db_path)
+            except Exception as e:
+                _logger.error(f'Error syncing the {source}: {e}')
+                errors[source] = str(e)
+
+        # A collection created by the sync is found by the next questions
+        self.engine.retriever.reset()
+
+        with self._sync_lock:
+            self.sync_state = {
+                **self.sync_state,
+                'running': False,
+                'finished': time.time(),
+                'errors': errors,
+            }
+
+    async def get_sync(self, body: Dict[str, Any], receive: Receive, send: Send):
+        await send_json(send, 200, self.sync_state)
+
+    async def get_stats(self, body: Dict[str, Any], receive: Receive, send: Send):
+        await send_json(send, 200, {
+            'latency_ms': self.stats.summary(),
+            'active': self.active,
+            'waiting': self.waiting,
+            'max_concurrency': self.max_concurrency,
+            'max_queue': self.max_queue,
+            'answer_cache': self.engine.answer_cache.stats() if self.engine.answer_cache is not None else None,
+        })
+
+    async def health(self, body: Dict[str, Any], receive: Receive, send: Send):
+        await send_json(send, 200, {'status': 'ok', 'db_path': self.engine.db_path})
+
+
+def require(body: Dict[str, Any], key: str) -> Any:
+    """Get a required field of the request body.
+
+    Args:
+        body (Dict[str, Any]): the request body.
+        key (str): the field.
+
+    Raises:
+        HttpError: 400 if the field is missing.
+
+    Returns:
+        Any: the value.
+    """
+
+    if not body.get(key):
+        raise HttpError(400, f'Missing "{key}".')
+    return body[key]
+
+
+def retrieval_mode(body: Dict[str, Any]) -> Optional[str]:
+    """Get the retrieval mode of the request body.
+
+    Args:
+        body (Dict[str, Any]): the request body.
+
+    Raises:
+        HttpError: 400 if the mode is unknown.
+
+    Returns:
+        Optional[str]: 'vector', 'hybrid' or 'lexical', None for the mode of the retriever.
+    """
+
+    retrieval = body.get('retrieval')
+    if retrieval is not None and retrieval not in RETRIEVAL_MODES:
+        raise HttpError(400, f'Unknown retrieval {retrieval}, expected one of {list(RETRIEVAL_MODES)}.')
+    return retrieval
+
+
+def search_filters(body: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Get the filters of the request body.
+
+    Args:
+        body (Dict[str, Any]): the request body.
+
+    Raises:
+        HttpError: 400 if the filters are malformed.
+
+    Returns:
+        Optional[Dict[str, Any]]: the filters, see parse_filters.
+    """
+
+    filters = body.get('filters') or {}
+    if not isinstance(filters, dict):
+        raise HttpError(400, 'The filters must be a json object.')
+
+    unknown = set(filters) - {'after', 'before', 'sender', 'folder'}
+    if unknown:
+        raise HttpError(400, f'Unknown filters {sorted(unknown)}.')
+    try:
+        return parse_filters(**filters)
+    except ValueError as e:
+        raise HttpError(400, str(e))
+
+
+async def read_json(receive: Receive) -> Dict[str, Any]:
+    """Read the json body of a request.
+
+    Args:
+        receive (Receive): the ASGI receive channel.
+
+    Raises:
+        HttpError: 400 if the body is not a json object.
+
+    Returns:
+        Dict[str, Any]: the body, empty if there is none.
+    """
+
+    chunks: List[bytes] = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+
+    raw = b''.join(chunks)
+    if not raw.strip():
+        return {}
+    try:
+        body = json.loads(raw)
+    except ValueError:
+        raise HttpError(400, 'The body is not valid json.')
+    if not isinstance(body, dict):
+        raise HttpError(400, 'The body must be a json object.')
+    return body
+
+
+async def wait_disconnect(receive: Receive):
+    """Wait until the client closes the connection.
+
+    Args:
+        receive (Receive): the ASGI receive channel.
+    """
+
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def send_json(send: Send, status: int, body: Any):
+    """Send a complete json response.
+
+    Args:
+        send (Send): the ASGI send channel.
+        status (int): the http status.
+        body (Any): the json body.
+    """
+
+    payload = json.dumps(body).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(payload)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+async def send_event(send: Send, event: str, data: Any):
+    """Send a server-sent event, the data is json encoded.
+
+    Args:
+        send (Send): the ASGI send channel.
+        event (str): the event name, 'prompt', 'token', 'done' or 'error'.
+        data (Any): the event data.
+    """
+
+    message = f'event: {event}\ndata: {json.dumps(data)}\n\n'
+    await send({'type': 'http.response.body', 'body': message.encode('utf-8'), 'more_body': True})
+
+
+def serve(
+        db_path: str,
+        api_key: str,
+        base_url: str,
+        **kwargs: Dict
+):
+    """Run the http server until it is interrupted.
+
+    Args:
+        db_path (str): path to the database.
+        api_key (str): oai compatible api key.
+        base_url (str): oai compatible base url.
+    """
+
+    engine = QueryEngine(os.path.abspath(db_path), api_key, base_url)
+
+    uvicorn.run(
+        RagApp(engine),
+        host=os.environ.get('RAG_SERVE_HOST', '127.0.0.1'),
+        port=int(os.environ.get('RAG_SERVE_PORT', 8000)),
+        lifespan='on',
+        log_level='warning'
+    )
@@ -0,0 +1,54 @@
+import threading
+
+from collections import deque
+from typing import Deque, Dict, Sequence
+
+
+class LatencyStats():
+
+    def __init__(self, window: int = 1000, percentiles: Sequence[int] = (50, 90, 99)):
+        """Latencies of the last requests of each endpoint, in seconds.
+
+        Args:
+            window (int, optional): Number of latencies kept per metric. Defaults to 1000.
+            percentiles (Sequence[int], optional): the reported percentiles. Defaults to (50, 90, 99).
+        """
+
+        self.window = window
+        self.percentiles = percentiles
+        self.counts: Dict[str, int] = {}
+        self._latencies: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, metric: str, seconds: float):
+        """Record a latency.
+
+        Args:
+            metric (str): name of the metric, like 'query' or 'query.ttft'.
+            seconds (float): the latency.
+        """
+
+        with self._lock:
+            self._latencies.setdefault(metric, deque(maxlen=self.window)).append(seconds)
+            self.counts[metric] = self.counts.get(metric, 0) + 1
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Get the percentiles of each metric.
+
+        Returns:
+            Dict[str, Dict[str, float]]: the count and the percentiles of each metric, in milliseconds.
+        """
+
+        with self._lock:
+            latencies = {metric: sorted(values) for metric, values in self._latencies.items()}
+            counts = dict(self.counts)
+
+        summary = {}
+        for metric, values in latencies.items():
+            summary[metric] = {'count': counts[metric]}
+            for percentile in self.percentiles:
+                # Nearest rank percentile
+                rank = max(0, min(len(values) - 1, -(-percentile * len(values) // 100) - 1))
+                summary[metric][f'p{percentile}'] = round(values[rank] * 1000, 1)
+
+        return summary
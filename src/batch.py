@@ -0,0 +1,219 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+import openai
+
+from typing import Any, Dict, List, Optional, TextIO, Tuple
+
+from src.query import QueryEngine, document_refs
+
+
+_logger = logging.getLogger(name='BATCH')
+
+# Errors of the LLM server worth another try, the others fail the question at once
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+
+def read_questions(path: str) -> List[Dict[str, Any]]:
+    """Read the questions of a jsonl file. Each line is a json object with a "query"
+    (or "question") and an optional "id", or a json string.
+
+    Args:
+        path (str): path to the jsonl file.
+
+    Returns:
+        List[Dict[str, Any]]: the id and the query of each question, the id defaults to the line number.
+    """
+
+    questions = []
+    with open(path, 'r') as questions_file:
+        for line_number, line in enumerate(questions_file, start=1):
+            if not line.strip():
+                continue
+
+            item = json.loads(line)
+            if isinstance(item, str):
+                item = {'query': item}
+
+            query = item.get('query') or item.get('question')
+            if not query:
+                _logger.warning(f'Line {line_number} has no "query", it is skipped.')
+                continue
+            questions.append({'id': item.get('id', line_number), 'query': query})
+
+    return questions
+
+
+async def complete_with_retry(engine: QueryEngine, prompt: str, max_retries: int, retry_delay: float) -> Tuple[str, int]:
+    """Ask the LLM, with an exponential backoff on the overload and connection errors.
+
+    Args:
+        engine (QueryEngine): the query engine.
+        prompt (str): the prompt.
+        max_retries (int): Number of retries after the first attempt.
+        retry_delay (float): seconds before the first retry, doubled at each retry.
+
+    Raises:
+        openai.APIError: the last error, once the retries are exhausted.
+
+    Returns:
+        Tuple[str, int]: the answer and the number of attempts.
+    """
+
+    attempt = 1
+    while True:
+        try:
+            return await engine.complete_async(prompt), attempt
+        except RETRYABLE_ERRORS as e:
+            if attempt > max_retries:
+                raise
+
+            # The jitter spreads the retries of the questions that failed together
+            delay = retry_delay * 2 ** (attempt - 1) * random.uniform(1, 1.5)
+            _logger.warning(f'{e.__class__.__name__} from the LLM, retrying in {delay:.1f} s.')
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+async def run_batch(
+        engine: QueryEngine,
+        questions: List[Dict[str, Any]],
+        output: TextIO,
+        n_results: int,
+        use_cache: bool = True,
+        concurrency: Optional[int] = None,
+        max_retries: Optional[int] = None
+) -> Dict[str, Any]:
+    """Answer many questions. They are embedded in one call and each collection is searched once
+    for all of them, then the LLM is called for several questions at once.
+
+    Args:
+        engine (QueryEngine): the query engine.
+        questions (List[Dict[str, Any]]): the id and the query of each question, see read_questions.
+        output (TextIO): the jsonl output, one line per question, written as the answers arrive.
+        n_results (int): Number of document to get with rag.
+        use_cache (bool, optional): False to ask the LLM again instead of reusing the cached answers. Defaults to True.
+        concurrency (Optional[int], optional): Number of LLM calls at once. Defaults to the BATCH_CONCURRENCY env variable, 8.
+        max_retries (Optional[int], optional): retries of a failed LLM call. Defaults to the BATCH_MAX_RETRIES env variable, 4.
+
+    Returns:
+        Dict[str, Any]: the counters and the timings of the batch.
+    """
+
+    concurrency = concurrency or int(os.environ.get('BATCH_CONCURRENCY', 8))
+    max_retries = max_retries if max_retries is not None else int(os.environ.get('BATCH_MAX_RETRIES', 4))
+    retry_delay = float(os.environ.get('BATCH_RETRY_DELAY', 1))
+
+    start = time.perf_counter()
+    queries = [question['query'] for question in questions]
+
+    # The versions are read before the retrieval, see QueryEngine.cached_answer
+    versions = await asyncio.to_thread(engine.retriever.versions) if engine.answer_cache is not None else {}
+
+    embeddings = await asyncio.to_thread(engine.retriever.embed_many, queries)
+    embedding_ms = (time.perf_counter() - start) * 1000
+
+    all_documents = await asyncio.to_thread(engine.retriever.retrieve_many, queries, n_results, None, embeddings)
+    search_ms = (time.perf_counter() - start) * 1000 - embedding_ms
+    _logger.info(f'{len(questions)} questions embedded in {embedding_ms:.0f} ms and searched in {search_ms:.0f} ms.')
+
+    summary = {'questions': len(questions), 'answered': 0, 'cached': 0, 'failed': 0}
+    slots = asyncio.Semaphore(concurrency)
+
+    async def answer(index: int, question: Dict[str, Any], embedding: List[float], documents: List[Dict[str, Any]]):
+        record: Dict[str, Any] = {
+            'index': index,
+            'id': question['id'],
+            'query': question['query'],
+            'documents': document_refs(documents),
+        }
+        timings = {'embedding_ms': round(embedding_ms, 1), 'search_ms': round(search_ms, 1)}
+
+        entry = None
+        if engine.answer_cache is not None:
+            entry, _, _ = engine.cached_answer(question['query'], embedding, n_results, use_cache, documents, versions)
+
+        if entry is not None:
+            record.update(answer=entry['answer'], cached=True)
+            summary['cached'] += 1
+        else:
+            prompt = engine.format_prompt(question['query'], documents)
+            async with slots:
+                llm_start = time.perf_counter()
+                try:
+                    text, attempts = await complete_with_retry(engine, prompt, max_retries, retry_delay)
+                    record.update(answer=text, cached=False, attempts=attempts)
+                    summary['answered'] += 1
+                except Exception as e:
+                    _logger.error(f'Question {question["id"]} failed: {e}')
+                    record.update(answer=None, cached=False, error=str(e))
+                    summary['failed'] += 1
+                timings['llm_ms'] = round((time.perf_counter() - llm_start) * 1000, 1)
+
+            if engine.answer_cache is not None and record['answer'] is not None:
+                entry_fields = engine.cache_entry(question['query'], embedding, n_results, documents, versions)
+                await asyncio.to_thread(engine.answer_cache.put, prompt=prompt, answer=record['answer'], **entry_fields)
+
+        record['timings'] = timings
+        output.write(json.dumps(record, ensure_ascii=False) + '\n')
+        output.flush()
+
+    await asyncio.gather(*[
+        answer(index, question, embedding, documents)
+        for index, (question, embedding, documents) in enumerate(zip(questions, embeddings, all_documents))
+    ])
+
+    summary['embedding_ms'] = round(embedding_ms, 1)
+    summary['search_ms'] = round(search_ms, 1)
+    summary['total_s'] = round(time.perf_counter() - start, 2)
+    return summary
+
+
+def batch(
+        input: str,
+        output: Optional[str],
+        db_path: str,
+        n_results: int,
+        api_key: str,
+        base_url: str,
+        no_cache: bool = False,
+        **kwargs: Dict
+):
+    """Answer the questions of a jsonl file and write the answers, the retrieved ids and the timings to another.
+
+    Args:
+        input (str): path to the jsonl questions, see read_questions.
+        output (Optional[str]): path to the jsonl answers, stdout if None or '-'.
+        db_path (str): path to the database.
+        n_results (int): Number of document to get with rag.
+        api_key (str): oai compatible api key.
+        base_url (str): oai compatible base url.
+        no_cache (bool, optional): True to ask the LLM again instead of reusing the cached answers. Defaults to False.
+
+    Raises:
+        ValueError: if there is no input file.
+    """
+
+    if not input:
+        raise ValueError('The batch mode needs the questions file, set --input.')
+
+    questions = read_questions(input)
+    engine = QueryEngine(db_path, api_key, base_url)
+
+    output_file = sys.stdout if output in (None, '-') else open(output, 'w') # type: ignore
+    try:
+        summary = asyncio.run(run_batch(engine, questions, output_file, n_results, use_cache=not no_cache))
+    finally:
+        if output_file is not sys.stdout:
+            output_file.close()
+
+    _logger.info(f'Batch done: {summary}')
@@ -0,0 +1,194 @@
+import logging
+import os
+import time
+
+from typing import Any, Dict, Iterator, List, Optional
+
+from src.answer_cache import normalize
+from src.console import print_answer, print_prompt, print_turn
+from src.embedding.chunking import token_offsets
+from src.query import QueryEngine
+
+
+_logger = logging.getLogger(name='CHAT')
+
+EXIT_COMMANDS = ('/exit', '/quit')
+RESET_COMMAND = '/reset'
+
+
+def count_tokens(text: str) -> int:
+    """Count the tokens of a message, with the tokenizer of the embedding model.
+    It is an estimate of the LLM tokens, good enough to bound the history.
+
+    Args:
+        text (str): the message.
+
+    Returns:
+        int: the number of tokens.
+    """
+
+    return len(token_offsets(text))
+
+
+class ChatSession():
+
+    def __init__(
+            self,
+            engine: QueryEngine,
+            n_results: int,
+            history_tokens: Optional[int] = None,
+            topic_similarity: Optional[float] = None
+    ):
+        """Conversation with the LLM over the notes and mails. The clients and the model of the
+        engine stay warm between the turns.
+
+        Args:
+            engine (QueryEngine): the query engine.
+            n_results (int): Number of document to get with rag.
+            history_tokens (Optional[int], optional): Tokens of the previous messages sent with a question.
+                Defaults to the CHAT_HISTORY_TOKENS env variable, 2000.
+            topic_similarity (Optional[float], optional): Cosine similarity from which a question keeps the
+                documents of the previous one. Defaults to the CHAT_TOPIC_SIMILARITY env variable, 0.6.
+        """
+
+        self.engine = engine
+        self.n_results = n_results
+        self.history_tokens = history_tokens if history_tokens is not None else int(os.environ.get('CHAT_HISTORY_TOKENS', 2000))
+        self.topic_similarity = topic_similarity if topic_similarity is not None else float(os.environ.get('CHAT_TOPIC_SIMILARITY', 0.6))
+
+        # The questions and the answers, without the documents, with their number of tokens
+        self.history: List[Dict[str, Any]] = []
+
+        # The documents of the current topic and the embedding of the question that retrieved them
+        self.documents: List[Dict[str, Any]] = []
+        self.topic_embedding = None
+
+        self.last_turn: Dict[str, Any] = {}
+
+    def reset(self):
+        """Forget the history and the documents.
+        """
+
+        self.history = []
+        self.documents = []
+        self.topic_embedding = None
+
+    def prompt(self, question: str) -> str:
+        """Build the prompt of a question, the documents are retrieved again when the topic changes.
+
+        Args:
+            question (str): the question.
+
+        Returns:
+            str: the prompt.
+        """
+
+        # The lexical retrieval does not load the embedding model, the documents are searched at each question
+        if self.engine.retriever.mode == 'lexical':
+            self.documents = self.engine.retriever.retrieve(question, self.n_results)
+            self.last_turn['reused'] = False
+            return self.engine.format_prompt(question, self.documents)
+
+        embedding = normalize(self.engine.retriever.embed(question))
+
+        reused = self.topic_embedding is not None and float(embedding @ self.topic_embedding) >= self.topic_similarity
+        if not reused:
+            self.documents = self.engine.retriever.retrieve(question, self.n_results, embedding=embedding.tolist())
+            self.topic_embedding = embedding
+
+        self.last_turn['reused'] = reused
+        return self.engine.format_prompt(question, self.documents)
+
+    def ask(self, question: str) -> Iterator[str]:
+        """Answer a question with the previous messages of the conversation.
+
+        Args:
+            question (str): the question.
+
+        Yields:
+            Iterator[str]: the answer, chunk by chunk. The timings of the turn are in last_turn once it is complete.
+        """
+
+        start = time.perf_counter()
+        self.last_turn = {'question': question}
+
+        prompt = self.prompt(question)
+        self.last_turn['prompt'] = prompt
+        self.last_turn['retrieval'] = time.perf_counter() - start
+
+        answer = []
+        history = [{'role': message['role'], 'content': message['content']} for message in self.history]
+        for content in self.engine.stream_answer(prompt, history=history):
+            if not answer:
+                self.last_turn['ttft'] = time.perf_counter() - start
+            answer.append(content)
+            yield content
+
+        self.last_turn['total'] = time.perf_counter() - start
+        self.remember(question, ''.join(answer))
+
+    def remember(self, question: str, answer: str):
+        """Add a turn to the history and drop the oldest turns above the token budget.
+
+        Args:
+            question (str): the question, without the documents.
+            answer (str): the answer.
+        """
+
+        self.history.append({'role': 'user', 'content': question, 'tokens': count_tokens(question)})
+        self.history.append({'role': 'assistant', 'content': answer, 'tokens': count_tokens(answer)})
+
+        # We drop a question and its answer together
+        while self.history and sum(message['tokens'] for message in self.history) > self.history_tokens:
+            del self.history[:2]
+
+
+def chat(
+        db_path: str,
+        n_results: int,
+        debug: bool,
+        api_key: str,
+        base_url: str,
+        **kwargs: Dict
+):
+    """Interactive conversation, the questions are read from the terminal until /exit.
+
+    Args:
+        db_path (str): path to the database.
+        n_results (int): Number of document to get with rag.
+        debug (bool): True for debug mode.
+        api_key (str): oai compatible api key.
+        base_url (str): oai compatible base url.
+    """
+
+    engine = QueryEngine(db_path, api_key, base_url)
+    engine.warm_up(engine.retriever.mode != 'lexical')
+    session = ChatSession(engine, n_results)
+
+    _logger.info(f'Ready. {RESET_COMMAND} forgets the conversation, {EXIT_COMMANDS[0]} quits.')
+
+    while True:
+        try:
+            question = input('> ').strip()
+        except (EOFError, KeyboardInterrupt):
+            print()
+            return
+
+        if not question:
+            continue
+        if question in EXIT_COMMANDS:
+            return
+        if question == RESET_COMMAND:
+            session.reset()
+            continue
+
+        try:
+            print_answer(session.ask(question))
+        except KeyboardInterrupt:
+            # The answer is interrupted, the conversation goes on
+            print()
+            continue
+
+        if debug:
+            print_prompt(session.last_turn['prompt'])
+        print_turn(session.last_turn)
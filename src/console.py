@@ -0,0 +1,49 @@
+from colorama import Fore, Style
+from typing import Any, AsyncIterable, Dict, Iterable
+
+
+def print_prompt(prompt: str):
+    """Print the prompt sent to the LLM, in debug mode.
+
+    Args:
+        prompt (str): the prompt.
+    """
+
+    print(f'\n{Fore.YELLOW}Prompt: {Fore.CYAN}{prompt}')
+
+
+def print_answer(chunks: Iterable[str]):
+    """Print the answer of the LLM as it is streamed.
+
+    Args:
+        chunks (Iterable[str]): the streamed text.
+    """
+
+    for content in chunks:
+        print(f'{Fore.CYAN}{content}', end='', flush=True)
+
+    print(f'{Style.RESET_ALL}')
+
+
+def print_turn(turn: Dict[str, Any]):
+    """Print the timings of a chat turn.
+
+    Args:
+        turn (Dict[str, Any]): the turn, see ChatSession.last_turn.
+    """
+
+    documents = 'documents reused' if turn.get('reused') else f'retrieval {turn.get("retrieval", 0):.2f} s'
+    print(f'{Fore.YELLOW}[first token {turn.get("ttft", 0):.2f} s, total {turn.get("total", 0):.2f} s, {documents}]{Style.RESET_ALL}')
+
+
+async def print_answer_async(chunks: AsyncIterable[str]):
+    """Print the answer of the LLM as it is streamed by the async engine.
+
+    Args:
+        chunks (AsyncIterable[str]): the streamed text.
+    """
+
+    async for content in chunks:
+        print(f'{Fore.CYAN}{content}', end='', flush=True)
+
+    print(f'{Style.RESET_ALL}')
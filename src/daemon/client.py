@@ -0,0 +1,121 @@
+import logging
+import os
+import socket
+
+from typing import Dict, Iterator, Optional
+
+from src.console import print_answer, print_prompt
+from src.daemon.protocol import get_socket_path, read_messages, write_message
+
+
+_logger = logging.getLogger(name='RAG_CLIENT')
+
+
+class DaemonUnavailable(Exception):
+    """The daemon is not running, or cannot answer this request."""
+
+
+def request_events(
+        method: str,
+        params: Dict,
+        socket_path: Optional[str] = None,
+        connect_timeout: float = 0.5
+) -> Iterator[Dict]:
+    """Send a request to the daemon and yield its events.
+
+    Args:
+        method (str): the method, 'ping' or 'query'.
+        params (Dict): the parameters of the method.
+        socket_path (Optional[str], optional): path of the unix socket. Defaults to get_socket_path().
+        connect_timeout (float, optional): seconds to wait for the connection. Defaults to 0.5.
+
+    Raises:
+        DaemonUnavailable: if the daemon cannot be reached, or refuses the request before answering.
+
+    Yields:
+        Iterator[Dict]: the events, until the 'done' event.
+    """
+
+    socket_path = socket_path or get_socket_path()
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.settimeout(connect_timeout)
+        connection.connect(socket_path)
+        connection.settimeout(None)
+    except OSError as e:
+        connection.close()
+        raise DaemonUnavailable(f'No daemon on {socket_path} ({e}).')
+
+    with connection, connection.makefile('rwb') as stream:
+        write_message(stream, {'method': method, 'params': params}) # type: ignore
+
+        answered = False
+        for event in read_messages(stream): # type: ignore
+            if event['event'] == 'error':
+                if not answered:
+                    raise DaemonUnavailable(event['message'])
+                raise RuntimeError(event['message'])
+
+            answered = True
+            yield event
+            if event['event'] == 'done':
+                return
+
+    raise DaemonUnavailable('The daemon closed the connection.')
+
+
+def query_daemon(
+        query: str,
+        db_path: str,
+        n_results: int,
+        debug: bool,
+        no_cache: bool = False,
+        retrieval: Optional[str] = None,
+        after: Optional[str] = None,
+        before: Optional[str] = None,
+        sender: Optional[str] = None,
+        folder: Optional[str] = None,
+        **kwargs: Dict
+) -> bool:
+    """Ask a question to the daemon and print the answer.
+
+    Args:
+        query (str): Question for the LLM.
+        db_path (str): path to the database.
+        n_results (int): Number of document to get with rag.
+        debug (bool): True for debug mode.
+        no_cache (bool, optional): True to ask the LLM again instead of reusing a cached answer. Defaults to False.
+        retrieval (Optional[str], optional): 'vector', 'hybrid' or 'lexical'. Defaults to None, the mode of the daemon.
+        after (Optional[str], optional): only the documents of this date or later. Defaults to None.
+        before (Optional[str], optional): only the documents older than this date. Defaults to None.
+        sender (Optional[str], optional): only the mails of this address. Defaults to None.
+        folder (Optional[str], optional): only the notes of this folder and the mails of this mailbox. Defaults to None.
+
+    Returns:
+        bool: False if the daemon is not available, the question has to be answered in process.
+    """
+
+    events = request_events(
+        'query',
+        {
+            'query': query,
+            'db_path': os.path.abspath(db_path),
+            'n_results': n_results,
+            'no_cache': no_cache,
+            'retrieval': retrieval,
+            'filters': {'after': after, 'before': before, 'sender': sender, 'folder': folder}
+        }
+    )
+
+    try:
+        first = next(events)
+    except (DaemonUnavailable, StopIteration) as e:
+        _logger.info(f'Query daemon unavailable, answering in process. {e}')
+        return False
+
+    if first['event'] == 'prompt' and debug:
+        print_prompt(first['data'])
+
+    print_answer(event['data'] for event in events if event['event'] == 'token')
+    return True
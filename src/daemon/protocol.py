@@ -0,0 +1,48 @@
+import json
+import os
+
+from typing import Any, BinaryIO, Dict, Iterator
+
+
+# The client and the daemon exchange one json object per line. The client sends a
+# request {"method": ..., "params": {...}}, the daemon answers with events
+# {"event": ...} and ends with a "done" or an "error" event.
+
+DEFAULT_SOCKET_PATH = os.path.expanduser('~/.cache/apple-rag-system/rag.sock')
+
+
+def get_socket_path() -> str:
+    """Get the path of the daemon socket from the RAG_SOCKET_PATH env variable.
+
+    Returns:
+        str: the unix socket path, DEFAULT_SOCKET_PATH by default.
+    """
+
+    return os.path.expanduser(os.environ.get('RAG_SOCKET_PATH', DEFAULT_SOCKET_PATH))
+
+
+def write_message(stream: BinaryIO, message: Dict[str, Any]):
+    """Send a message.
+
+    Args:
+        stream (BinaryIO): the socket file.
+        message (Dict[str, Any]): the request or the event.
+    """
+
+    stream.write(json.dumps(message).encode() + b'\n')
+    stream.flush()
+
+
+def read_messages(stream: BinaryIO) -> Iterator[Dict[str, Any]]:
+    """Read the messages until the connection is closed.
+
+    Args:
+        stream (BinaryIO): the socket file.
+
+    Yields:
+        Iterator[Dict[str, Any]]: the requests or the events.
+    """
+
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
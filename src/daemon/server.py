@@ -0,0 +1,136 @@
+import logging
+import os
+import socket
+import socketserver
+
+from typing import Any, Dict, Optional
+
+from src.daemon.protocol import get_socket_path, read_messages, write_message
+from src.metadata import parse_filters
+from src.query import QueryEngine
+
+
+_logger = logging.getLogger(name='RAG_DAEMON')
+
+
+class RagRequestHandler(socketserver.StreamRequestHandler):
+
+    server: 'RagDaemon'
+
+    def handle(self):
+        for request in read_messages(self.rfile): # type: ignore
+            try:
+                self.dispatch(request.get('method'), request.get('params') or {})
+            except BrokenPipeError:
+                return
+            except Exception as e:
+                _logger.exception(e)
+                write_message(self.wfile, {'event': 'error', 'message': str(e)}) # type: ignore
+
+    def dispatch(self, method: Optional[str], params: Dict[str, Any]):
+        engine = self.server.engine
+
+        if method == 'ping':
+            write_message(self.wfile, {'event': 'done', 'db_path': engine.db_path}) # type: ignore
+
+        elif method == 'query':
+            # The client falls back to the in-process query if the daemon serves another database
+            if os.path.abspath(params.get('db_path', engine.db_path)) != os.path.abspath(engine.db_path):
+                write_message(self.wfile, {'event': 'error', 'code': 'db_path', 'message': f'The daemon serves {engine.db_path}.'}) # type: ignore
+                return
+
+            prompt, answer = engine.answer(
+                params['query'],
+                int(params.get('n_results', 3)),
+                use_cache=not params.get('no_cache', False),
+                retrieval=params.get('retrieval'),
+                filters=parse_filters(**(params.get('filters') or {}))
+            )
+            write_message(self.wfile, {'event': 'prompt', 'data': prompt}) # type: ignore
+            for content in answer:
+                write_message(self.wfile, {'event': 'token', 'data': content}) # type: ignore
+            write_message(self.wfile, {'event': 'done'}) # type: ignore
+
+        else:
+            write_message(self.wfile, {'event': 'error', 'message': f'Unknown method {method}.'}) # type: ignore
+
+
+class RagDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, engine: QueryEngine):
+        """Unix socket server answering the questions with warm clients and model.
+        Each connection is served by its own thread.
+
+        Args:
+            socket_path (str): path of the unix socket.
+            engine (QueryEngine): the query engine, shared by the connections.
+        """
+
+        self.engine = engine
+        self.socket_path = socket_path
+
+        os.makedirs(os.path.dirname(socket_path) or '.', exist_ok=True)
+        remove_stale_socket(socket_path)
+        super().__init__(socket_path, RagRequestHandler)
+
+        # Only the user can talk to the daemon
+        os.chmod(socket_path, 0o600)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+def remove_stale_socket(socket_path: str):
+    """Remove the socket file left by a daemon that did not stop cleanly.
+
+    Args:
+        socket_path (str): path of the unix socket.
+
+    Raises:
+        RuntimeError: if a daemon is already listening on the socket.
+    """
+
+    if not os.path.exists(socket_path):
+        return
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(socket_path)
+        except OSError:
+            os.unlink(socket_path)
+            return
+
+    raise RuntimeError(f'A daemon is already listening on {socket_path}.')
+
+
+def serve(
+        db_path: str,
+        api_key: str,
+        base_url: str,
+        socket_path: Optional[str] = None,
+        **kwargs: Dict
+):
+    """Run the query daemon until it is interrupted.
+
+    Args:
+        db_path (str): path to the database.
+        api_key (str): oai compatible api key.
+        base_url (str): oai compatible base url.
+        socket_path (Optional[str], optional): path of the unix socket. Defaults to get_socket_path().
+    """
+
+    socket_path = socket_path or get_socket_path()
+
+    engine = QueryEngine(os.path.abspath(db_path), api_key, base_url)
+    engine.warm_up()
+
+    with RagDaemon(socket_path, engine) as daemon:
+        _logger.info(f'Listening on {socket_path}.')
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            _logger.info('Daemon stopped.')
@@ -0,0 +1,262 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+from array import array
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+
+from src.embedding.service import EmbeddingService, get_embedding_service
+
+
+_logger = logging.getLogger(name='EMBEDDING_CACHE')
+
+
+def normalize_text(text: str) -> str:
+    """Normalize a text before hashing it, so that whitespace or unicode form
+    differences do not produce a new cache entry.
+
+    Args:
+        text (str): the text to embed.
+
+    Returns:
+        str: the normalized text.
+    """
+
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+
+def text_hash(text: str) -> str:
+    """Hash a text for the cache key.
+
+    Args:
+        text (str): the text to embed.
+
+    Returns:
+        str: the sha256 hex digest of the normalized text.
+    """
+
+    return hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache():
+
+    def __init__(self, path: str, max_entries: int = 100_000):
+        """Open (or create) the sqlite embedding cache.
+
+        Args:
+            path (str): Location of the sqlite file.
+            max_entries (int, optional): Number of vectors kept, the least recently used are evicted. Defaults to 100_000.
+        """
+
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            )
+            '''
+        )
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)'
+        )
+        self._connection.commit()
+
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        """Look up the vectors of a batch of texts.
+
+        Args:
+            model (str): Name of the embedding model.
+            texts (Sequence[str]): texts to look up.
+
+        Returns:
+            List[Optional[List[float]]]: the cached vectors, None for the misses.
+        """
+
+        hashes = [text_hash(text) for text in texts]
+        found: Dict[str, List[float]] = {}
+
+        with self._lock:
+            # sqlite limits the number of bound parameters, we query by chunks
+            unique_hashes = list(set(hashes))
+            for start in range(0, len(unique_hashes), 500):
+                chunk = unique_hashes[start:start + 500]
+                rows = self._connection.execute(
+                    f'SELECT text_hash, vector FROM embeddings WHERE model = ? '
+                    f'AND text_hash IN ({",".join("?" * len(chunk))})',
+                    [model, *chunk]
+                ).fetchall()
+                for row_hash, blob in rows:
+                    vector = array('f')
+                    vector.frombytes(blob)
+                    found[row_hash] = vector.tolist()
+
+            if found:
+                now = time.time()
+                self._connection.executemany(
+                    'UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?',
+                    [(now, model, row_hash) for row_hash in found]
+                )
+                self._connection.commit()
+
+            # The cache is shared by several threads, the counters are updated under the lock
+            results = [found.get(h) for h in hashes]
+            hits = sum(vector is not None for vector in results)
+            self.hits += hits
+            self.misses += len(results) - hits
+
+        return results
+
+    def put_many(self, model: str, texts: Sequence[str], vectors: Sequence[Sequence[float]]):
+        """Store the vectors of a batch of texts and evict the oldest entries if needed.
+
+        Args:
+            model (str): Name of the embedding model.
+            texts (Sequence[str]): the embedded texts.
+            vectors (Sequence[Sequence[float]]): their vectors.
+        """
+
+        now = time.time()
+        rows = [
+            (model, text_hash(text), array('f', vector).tobytes(), now)
+            for text, vector in zip(texts, vectors)
+        ]
+
+        with self._lock:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO embeddings (model, text_hash, vector, last_used) VALUES (?, ?, ?, ?)',
+                rows
+            )
+            self._evict()
+            self._connection.commit()
+
+    def _evict(self):
+        """Delete the least recently used entries above max_entries.
+        """
+
+        (count,) = self._connection.execute('SELECT COUNT(*) FROM embeddings').fetchone()
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self._connection.execute(
+                'DELETE FROM embeddings WHERE rowid IN '
+                '(SELECT rowid FROM embeddings ORDER BY last_used ASC LIMIT ?)',
+                (overflow,)
+            )
+            _logger.info(f'Evicted {overflow} embeddings from the cache.')
+
+    def dimension(self, model: str) -> Optional[int]:
+        """Get the dimension of the vectors cached for a model.
+
+        Args:
+            model (str): Name of the embedding model.
+
+        Returns:
+            Optional[int]: the dimension, None if no vector of the model is cached.
+        """
+
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT vector FROM embeddings WHERE model = ? LIMIT 1',
+                (model,)
+            ).fetchone()
+
+        return len(row[0]) // array('f').itemsize if row else None
+
+    def stats(self) -> Dict[str, int]:
+        """Get the hit and miss counters of the cache.
+
+        Returns:
+            Dict[str, int]: hits and misses since the cache was opened.
+        """
+
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+class CachedEmbeddingFunction(EmbeddingFunction[Documents]):
+
+    def __init__(self, service: EmbeddingService, cache: EmbeddingCache):
+        """Embedding function that reads the vectors from the cache before running the model.
+        The model is only loaded when a text is missing from the cache.
+
+        Args:
+            service (EmbeddingService): the shared embedding model.
+            cache (EmbeddingCache): the embedding cache.
+        """
+
+        self.service = service
+        self.model_name = service.model_name
+        self.cache_key = service.cache_key
+        self.cache = cache
+
+    def __call__(self, input: Documents) -> Embeddings:
+        vectors = self.cache.get_many(self.cache_key, input)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+
+        if missing:
+            texts = [input[i] for i in missing]
+            computed = self.service.embed(texts)
+            self.cache.put_many(self.cache_key, texts, computed)
+            for i, vector in zip(missing, computed):
+                vectors[i] = vector
+
+        return vectors # type: ignore
+
+    def known_dimension(self) -> Optional[int]:
+        """Get the dimension of the vectors without loading the model.
+
+        Returns:
+            Optional[int]: the dimension, None if the model is not loaded and nothing is cached.
+        """
+
+        if self.service.loaded:
+            return self.service.dimension
+        return self.cache.dimension(self.cache_key)
+
+
+_embedding_functions: Dict[Tuple[str, str], CachedEmbeddingFunction] = {}
+_embedding_functions_lock = threading.Lock()
+
+
+def get_cached_embedding_function(db_path: str) -> CachedEmbeddingFunction:
+    """Get the cached embedding function shared by the ingestion and the query.
+    It is built once per process, the model is loaded on the first cache miss.
+
+    Args:
+        db_path (str): Location of the chroma db, the cache is stored next to it by default.
+
+    Returns:
+        CachedEmbeddingFunction: the embedding function.
+    """
+
+    service = get_embedding_service()
+    path = os.environ.get('EMBEDDING_CACHE_PATH', os.path.join(db_path, 'embedding_cache.sqlite'))
+
+    with _embedding_functions_lock:
+        if (service.cache_key, path) not in _embedding_functions:
+            cache = EmbeddingCache(
+                path=path,
+                max_entries=int(os.environ.get('EMBEDDING_CACHE_MAX_ENTRIES', 100_000))
+            )
+            _embedding_functions[(service.cache_key, path)] = CachedEmbeddingFunction(
+                service=service,
+                cache=cache
+            )
+        return _embedding_functions[(service.cache_key, path)]
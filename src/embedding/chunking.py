@@ -0,0 +1,324 @@
+import logging
+import os
+import re
+
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from src.lexical import LexicalIndex
+
+
+_logger = logging.getLogger(name='CHUNKING')
+
+# Without the tokenizer the words and the punctuation marks are counted, close to the word pieces
+_WORD_RE = re.compile(r'\w+|[^\w\s]')
+
+# Characters after which a chunk can end cleanly
+_BOUNDARY_CHARS = '.!?;:\n'
+
+
+@lru_cache(maxsize=4)
+def get_tokenizer(model_name: str) -> Optional[Any]:
+    """Load the tokenizer of the embedding model, without loading the model itself.
+
+    Args:
+        model_name (str): Name of the sentence-transformers model.
+
+    Returns:
+        Optional[Any]: the tokenizers.Tokenizer, None if it cannot be loaded.
+    """
+
+    try:
+        from tokenizers import Tokenizer
+
+        tokenizer = Tokenizer.from_pretrained(model_name if '/' in model_name else f'sentence-transformers/{model_name}')
+        tokenizer.no_truncation()
+        tokenizer.no_padding()
+        return tokenizer
+    except Exception as e:
+        _logger.warning(f'Unable to load the tokenizer of {model_name} ({e}), the words are counted instead.')
+        return None
+
+
+def token_offsets(text: str, model_name: Optional[str] = None) -> List[Tuple[int, int]]:
+    """Get the character span of each token of a text.
+
+    Args:
+        text (str): the text.
+        model_name (Optional[str], optional): the embedding model. Defaults to the HF_EMBEDDING_MODEL env variable.
+
+    Returns:
+        List[Tuple[int, int]]: the start and end of the tokens.
+    """
+
+    tokenizer = get_tokenizer(model_name or os.environ.get('HF_EMBEDDING_MODEL', 'all-MiniLM-L6-v2'))
+    if tokenizer is None:
+        return [match.span() for match in _WORD_RE.finditer(text)]
+
+    # Several word pieces can share the span of a word, they are all kept
+    return [span for span in tokenizer.encode(text, add_special_tokens=False).offsets if span[1] > span[0]]
+
+
+def chunk_spans(
+        text: str,
+        max_tokens: Optional[int] = None,
+        overlap: Optional[int] = None,
+        model_name: Optional[str] = None
+) -> List[Tuple[int, int]]:
+    """Split a text in windows of at most max_tokens tokens of the embedding model,
+    two consecutive windows share overlap tokens. A window ends after a sentence or
+    a line when there is one in its last quarter.
+
+    Args:
+        text (str): the text.
+        max_tokens (Optional[int], optional): size of the windows. Defaults to the CHUNK_MAX_TOKENS env variable, or 250.
+        overlap (Optional[int], optional): tokens shared by two windows. Defaults to the CHUNK_OVERLAP_TOKENS env variable, or 32.
+        model_name (Optional[str], optional): the embedding model. Defaults to the HF_EMBEDDING_MODEL env variable.
+
+    Returns:
+        List[Tuple[int, int]]: the start and end character of the windows, a single one if the text is short enough.
+    """
+
+    max_tokens = max_tokens or int(os.environ.get('CHUNK_MAX_TOKENS', 250))
+    overlap = min(overlap if overlap is not None else int(os.environ.get('CHUNK_OVERLAP_TOKENS', 32)), max_tokens // 2)
+
+    offsets = token_offsets(text, model_name)
+    if len(offsets) <= max_tokens:
+        return [(0, len(text))]
+
+    spans = []
+    start = 0
+    while start < len(offsets):
+        end = min(start + max_tokens, len(offsets))
+
+        if end < len(offsets):
+            for i in range(end - 1, start + (3 * max_tokens) // 4, -1):
+                if text[offsets[i][1] - 1] in _BOUNDARY_CHARS or text[offsets[i][1]:offsets[i][1] + 1] == '\n':
+                    end = i + 1
+                    break
+
+        spans.append((offsets[start][0], offsets[end - 1][1]))
+        if end >= len(offsets):
+            break
+        start = max(end - overlap, start + 1)
+
+    return spans
+
+
+def chunk_text(
+        text: str,
+        max_tokens: Optional[int] = None,
+        overlap: Optional[int] = None,
+        model_name: Optional[str] = None
+) -> List[str]:
+    """Split a text in overlapping windows of tokens, see chunk_spans.
+
+    Args:
+        text (str): the text.
+        max_tokens (Optional[int], optional): size of the windows. Defaults to the CHUNK_MAX_TOKENS env variable, or 250.
+        overlap (Optional[int], optional): tokens shared by two windows. Defaults to the CHUNK_OVERLAP_TOKENS env variable, or 32.
+        model_name (Optional[str], optional): the embedding model. Defaults to the HF_EMBEDDING_MODEL env variable.
+
+    Returns:
+        List[str]: the chunks, a single one if the text is short enough.
+    """
+
+    return [text[start:end] for start, end in chunk_spans(text, max_tokens, overlap, model_name)]
+
+
+def make_chunk_id(parent_id: str, chunk: int) -> str:
+    """Build the id of a chunk, stable as long as the document and its chunk position do not change.
+
+    Args:
+        parent_id (str): id of the document.
+        chunk (int): position of the chunk in the document.
+
+    Returns:
+        str: the chunk id.
+    """
+
+    return f'{parent_id}#{chunk}'
+
+
+def chunk_documents(
+        ids: Sequence[str],
+        documents: Sequence[str],
+        metadatas: Sequence[Dict[str, Any]]
+) -> Tuple[List[str], List[str], List[Dict[str, Any]]]:
+    """Split the documents in chunks. Each chunk keeps the metadata of its document,
+    with its parent_id, its position, the number of chunks of the document and its
+    character span in the document.
+
+    Args:
+        ids (Sequence[str]): ids of the documents.
+        documents (Sequence[str]): the documents.
+        metadatas (Sequence[Dict[str, Any]]): metadata of the documents.
+
+    Returns:
+        Tuple[List[str], List[str], List[Dict[str, Any]]]: the ids, documents and metadatas of the chunks.
+    """
+
+    chunk_ids, chunk_docs, chunk_metadatas = [], [], []
+
+    for parent_id, document, metadata in zip(ids, documents, metadatas):
+        document = document or ''
+        spans = chunk_spans(document)
+        for position, (start, end) in enumerate(spans):
+            chunk_ids.append(make_chunk_id(parent_id, position))
+            chunk_docs.append(document[start:end])
+            chunk_metadatas.append({
+                **metadata,
+                'parent_id': parent_id,
+                'chunk': position,
+                'n_chunks': len(spans),
+                'chunk_start': start,
+                'chunk_end': end,
+            })
+
+    return chunk_ids, chunk_docs, chunk_metadatas
+
+
+def upsert_chunks(
+        index,
+        ids: Sequence[str],
+        documents: Sequence[str],
+        metadatas: Sequence[Dict[str, Any]],
+        lexical: Optional[LexicalIndex] = None
+) -> int:
+    """Chunk the documents and write them in a collection. The chunks of a previous
+    version of the documents that no longer exist are deleted.
+
+    Args:
+        index (chromadb.Collection): the collection.
+        ids (Sequence[str]): ids of the documents.
+        documents (Sequence[str]): the documents.
+        metadatas (Sequence[Dict[str, Any]]): metadata of the documents.
+        lexical (Optional[LexicalIndex], optional): the lexical index of the collection, updated the same way. Defaults to None.
+
+    Returns:
+        int: number of chunks written.
+    """
+
+    if not ids:
+        return 0
+
+    chunk_ids, chunk_docs, chunk_metadatas = chunk_documents(ids, documents, metadatas)
+
+    # A shorter document has less chunks, the extra ones are removed. The documents
+    # indexed before the chunking are stored under their own id.
+    previous_ids = index.get(where={'parent_id': {'$in': list(ids)}}, include=[])['ids']
+    new_ids = set(chunk_ids)
+    stale_ids = [chunk_id for chunk_id in previous_ids if chunk_id not in new_ids]
+    index.delete(ids=stale_ids + list(ids))
+
+    index.upsert(
+        ids=chunk_ids,
+        documents=chunk_docs,
+        metadatas=chunk_metadatas # type: ignore
+    )
+
+    if lexical is not None:
+        lexical.delete(stale_ids + list(ids))
+        lexical.add(chunk_ids, [metadata['parent_id'] for metadata in chunk_metadatas], chunk_docs)
+
+    return len(chunk_ids)
+
+
+def delete_documents(index, ids: Sequence[str], lexical: Optional[LexicalIndex] = None):
+    """Delete documents and all their chunks from a collection.
+
+    Args:
+        index (chromadb.Collection): the collection.
+        ids (Sequence[str]): ids of the documents.
+        lexical (Optional[LexicalIndex], optional): the lexical index of the collection. Defaults to None.
+    """
+
+    if ids:
+        index.delete(where={'parent_id': {'$in': list(ids)}})
+        index.delete(ids=list(ids))
+
+        if lexical is not None:
+            lexical.delete_documents(ids)
+            lexical.delete(ids)
+
+
+def get_document_ids(index) -> List[str]:
+    """List the ids of the documents stored in a collection, not the chunk ids.
+
+    Args:
+        index (chromadb.Collection): the collection.
+
+    Returns:
+        List[str]: the document ids.
+    """
+
+    stored = index.get(include=['metadatas'])
+    return list({
+        (metadata or {}).get('parent_id', chunk_id)
+        for chunk_id, metadata in zip(stored['ids'], stored['metadatas'])
+    })
+
+
+def regroup_chunks(
+        ids: Sequence[str],
+        documents: Sequence[str],
+        metadatas: Sequence[Dict[str, Any]],
+        distances: Sequence[float],
+        n_results: int
+) -> List[Dict[str, Any]]:
+    """Regroup the chunks returned by a query under their document. The documents
+    are ranked by their closest chunk, their chunks are kept in the document order
+    and the text shared by two consecutive chunks is kept once.
+
+    Args:
+        ids (Sequence[str]): ids of the chunks.
+        documents (Sequence[str]): the chunks.
+        metadatas (Sequence[Dict[str, Any]]): metadata of the chunks.
+        distances (Sequence[float]): distance of the chunks to the query.
+        n_results (int): maximum number of documents.
+
+    Returns:
+        List[Dict[str, Any]]: the id, metadata, content and distance of the documents.
+    """
+
+    groups: Dict[str, Dict[str, Any]] = {}
+
+    for chunk_id, document, metadata, distance in zip(ids, documents, metadatas, distances):
+        metadata = dict(metadata or {})
+        parent_id = metadata.pop('parent_id', chunk_id)
+        position = metadata.pop('chunk', 0)
+        n_chunks = metadata.pop('n_chunks', 1)
+        span = (metadata.pop('chunk_start', None), metadata.pop('chunk_end', None))
+
+        group = groups.setdefault(parent_id, {
+            'id': parent_id,
+            'metadata': metadata,
+            'distance': distance,
+            'n_chunks': n_chunks,
+            'chunks': {},
+        })
+        group['distance'] = min(group['distance'], distance)
+        group['chunks'][position] = (document, span)
+
+    results = sorted(groups.values(), key=lambda group: group['distance'])[:n_results]
+    for group in results:
+        chunks = group.pop('chunks')
+        positions = sorted(chunks)
+
+        # The skipped parts of a long document are marked, so the spans are not read as one text
+        parts: List[str] = []
+        for previous, position in zip([None] + positions, positions):
+            text, (start, _) = chunks[position]
+            if previous is not None and position == previous + 1:
+                previous_end = chunks[previous][1][1]
+                # A chunk starts inside the previous one, only the rest of it is appended.
+                # The chunks stored before the spans are joined whole.
+                if start is not None and previous_end is not None and start <= previous_end:
+                    parts[-1] += text[previous_end - start:]
+                    continue
+            elif previous is not None:
+                parts.append('[...]')
+            parts.append(text)
+        group['content'] = '\n'.join(parts)
+
+    return results
@@ -0,0 +1,155 @@
+import json
+import logging
+import os
+
+from typing import Any, List, Optional, Sequence
+
+
+_logger = logging.getLogger(name='ONNX_EMBEDDING')
+
+DEFAULT_ONNX_DIR = os.path.expanduser('~/.cache/apple-rag-system/onnx')
+
+
+def _hub_repo(model_name: str) -> str:
+    return model_name if '/' in model_name else f'sentence-transformers/{model_name}'
+
+
+def _read_json(path: Optional[str], default: Any) -> Any:
+    if path is None:
+        return default
+    with open(path, 'r') as json_file:
+        return json.load(json_file)
+
+
+def _download(repo: str, filename: str) -> Optional[str]:
+    from huggingface_hub import hf_hub_download
+
+    try:
+        return hf_hub_download(repo_id=repo, filename=filename)
+    except Exception:
+        return None
+
+
+class OnnxEmbeddingModel():
+
+    def __init__(
+            self,
+            model_name: str,
+            quantize: bool = False,
+            batch_size: int = 32,
+            threads: Optional[int] = None,
+            onnx_dir: str = DEFAULT_ONNX_DIR
+    ):
+        """Sentence-transformers model run with onnxruntime on the cpu. The onnx export
+        published with the model is used, and quantized to int8 on the first use if asked.
+        The texts are sorted by length and batched, so a batch carries little padding.
+
+        Args:
+            model_name (str): Name of the sentence-transformers model.
+            quantize (bool, optional): use int8 dynamic quantization of the weights. Defaults to False.
+            batch_size (int, optional): number of texts run at once. Defaults to 32.
+            threads (Optional[int], optional): intra-op threads of onnxruntime, all the cores by default. Defaults to None.
+            onnx_dir (str, optional): where the quantized model is stored. Defaults to DEFAULT_ONNX_DIR.
+        """
+
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        repo = _hub_repo(model_name)
+        model_path = _download(repo, 'onnx/model.onnx')
+        if model_path is None:
+            raise FileNotFoundError(f'{repo} does not publish an onnx export (onnx/model.onnx).')
+
+        if quantize:
+            model_path = self._quantize(model_path, os.path.join(onnx_dir, repo.replace('/', '--')))
+
+        # The same settings as the sentence-transformers pipeline of the model
+        config = _read_json(_download(repo, 'sentence_bert_config.json'), {})
+        modules = _read_json(_download(repo, 'modules.json'), [])
+
+        self.max_length = int(config.get('max_seq_length', 256))
+        self.normalize = any(module.get('type', '').endswith('Normalize') for module in modules)
+        self.batch_size = batch_size
+        self._dimension: Optional[int] = None
+
+        self.tokenizer = Tokenizer.from_pretrained(repo)
+        self.tokenizer.enable_truncation(max_length=self.max_length)
+        self.tokenizer.no_padding()
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+        _logger.info(f'Loaded {model_path} with onnxruntime.')
+
+    @staticmethod
+    def _quantize(model_path: str, directory: str) -> str:
+        quantized_path = os.path.join(directory, 'model_int8.onnx')
+        if not os.path.exists(quantized_path):
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            _logger.info(f'Quantizing {model_path} to int8.')
+            os.makedirs(directory, exist_ok=True)
+            tmp_path = quantized_path + '.tmp'
+            quantize_dynamic(model_path, tmp_path, weight_type=QuantType.QInt8)
+            os.replace(tmp_path, quantized_path)
+
+        return quantized_path
+
+    def get_sentence_embedding_dimension(self) -> int:
+        """Dimension of the vectors.
+
+        Returns:
+            int: the embedding dimension.
+        """
+
+        if self._dimension is None:
+            self._dimension = len(self.encode(['dimension'])[0])
+        return self._dimension
+
+    def encode(self, texts: Sequence[str], **kwargs: Any) -> List[List[float]]:
+        """Embed texts: mean pooling of the token vectors, normalized if the model does it.
+
+        Args:
+            texts (Sequence[str]): the texts.
+
+        Returns:
+            List[List[float]]: the vectors, in the order of the texts.
+        """
+
+        import numpy as np
+
+        encodings = self.tokenizer.encode_batch(list(texts))
+
+        # Length buckets: neighbours in the sorted order have close lengths
+        order = sorted(range(len(encodings)), key=lambda i: len(encodings[i].ids))
+        vectors: List[Any] = [None] * len(encodings)
+
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            length = max(len(encodings[i].ids) for i in batch)
+
+            input_ids = np.zeros((len(batch), length), dtype=np.int64)
+            attention_mask = np.zeros((len(batch), length), dtype=np.int64)
+            for row, i in enumerate(batch):
+                ids = encodings[i].ids
+                input_ids[row, :len(ids)] = ids
+                attention_mask[row, :len(ids)] = 1
+
+            inputs = {'input_ids': input_ids, 'attention_mask': attention_mask}
+            if 'token_type_ids' in self.input_names:
+                inputs['token_type_ids'] = np.zeros_like(input_ids)
+
+            token_vectors = self.session.run(None, inputs)[0]
+            mask = attention_mask[:, :, None].astype(token_vectors.dtype)
+            pooled = (token_vectors * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if self.normalize:
+                pooled = pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+            for row, i in enumerate(batch):
+                vectors[i] = pooled[row]
+
+        return [list(map(float, vector)) for vector in vectors]
@@ -0,0 +1,279 @@
+import logging
+import os
+import threading
+
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
+
+
+_logger = logging.getLogger(name='EMBEDDING_SERVICE')
+
+# Keys of the collection metadata describing the embedding model, the model is recorded
+# with its quantization like in the embedding cache (see EmbeddingService.cache_key)
+MODEL_KEY = 'embedding_model'
+DIMENSION_KEY = 'embedding_dimension'
+
+# Key of the collection metadata counting the syncs that changed the collection
+VERSION_KEY = 'index_version'
+
+BACKENDS = ('torch', 'onnx', 'onnx-int8')
+
+
+class EmbeddingModelMismatchError(ValueError):
+    """The collection was embedded with another model than the configured one."""
+
+
+def get_model_name() -> str:
+    """Get the name of the embedding model from the HF_EMBEDDING_MODEL env variable.
+
+    Returns:
+        str: Name of the sentence-transformers model, all-MiniLM-L6-v2 by default.
+    """
+
+    return os.environ.get('HF_EMBEDDING_MODEL', 'all-MiniLM-L6-v2')
+
+
+def get_backend() -> str:
+    """Get the embedding backend from the EMBEDDING_BACKEND env variable.
+
+    Returns:
+        str: 'torch' (sentence-transformers, the default), 'onnx' or 'onnx-int8' (onnxruntime on the cpu).
+    """
+
+    backend = os.environ.get('EMBEDDING_BACKEND', 'torch').lower()
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown EMBEDDING_BACKEND {backend}, expected one of {", ".join(BACKENDS)}.')
+    return backend
+
+
+class EmbeddingService():
+
+    def __init__(self, model_name: str, backend: str = 'torch'):
+        """Embedding model shared by the whole process. The model is only loaded
+        the first time a text is embedded.
+
+        Args:
+            model_name (str): Name of the sentence-transformers model.
+            backend (str, optional): 'torch', 'onnx' or 'onnx-int8'. Defaults to 'torch'.
+        """
+
+        self.model_name = model_name
+        self.backend = backend
+        self.batch_size = int(os.environ.get('EMBEDDING_BATCH_SIZE', 32))
+        self.threads = int(os.environ['EMBEDDING_THREADS']) if os.environ.get('EMBEDDING_THREADS') else None
+        self._model: Optional[Any] = None
+        self._lock = threading.Lock()
+
+    @property
+    def cache_key(self) -> str:
+        """Key of the vectors in the embedding cache. The quantized model produces
+        slightly different vectors, they are cached apart.
+
+        Returns:
+            str: the model name, with the quantization.
+        """
+
+        return f'{self.model_name}:int8' if self.backend == 'onnx-int8' else self.model_name
+
+    @property
+    def model(self) -> Any:
+        """The sentence-transformers model, loaded on the first access.
+
+        Returns:
+            Any: the SentenceTransformer model.
+        """
+
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    _logger.info(f'Loading the embedding model {self.model_name} ({self.backend}).')
+                    self._model = self._load()
+
+        return self._model
+
+    def _load(self) -> Any:
+        if self.backend.startswith('onnx'):
+            from src.embedding.onnx_backend import OnnxEmbeddingModel
+
+            return OnnxEmbeddingModel(
+                self.model_name,
+                quantize=self.backend == 'onnx-int8',
+                batch_size=self.batch_size,
+                threads=self.threads
+            )
+
+        from sentence_transformers import SentenceTransformer
+
+        if self.threads:
+            import torch
+            torch.set_num_threads(self.threads)
+        return SentenceTransformer(self.model_name)
+
+    @property
+    def loaded(self) -> bool:
+        """Check if the model is already loaded.
+
+        Returns:
+            bool: True once a text has been embedded.
+        """
+
+        return self._model is not None
+
+    @property
+    def dimension(self) -> int:
+        """Dimension of the vectors, loads the model.
+
+        Returns:
+            int: the embedding dimension.
+        """
+
+        return int(self.model.get_sentence_embedding_dimension())
+
+    def embed(self, texts: Sequence[str]) -> List[List[float]]:
+        """Embed a batch of texts, like chroma's SentenceTransformerEmbeddingFunction.
+
+        Args:
+            texts (Sequence[str]): the texts.
+
+        Returns:
+            List[List[float]]: their vectors.
+        """
+
+        vectors = self.model.encode(
+            list(texts),
+            batch_size=self.batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=False
+        )
+        return [list(map(float, vector)) for vector in vectors]
+
+
+_services: Dict[Tuple[str, str], EmbeddingService] = {}
+_services_lock = threading.Lock()
+
+
+def get_embedding_service(model_name: Optional[str] = None, backend: Optional[str] = None) -> EmbeddingService:
+    """Get the process-wide embedding service of a model.
+
+    Args:
+        model_name (Optional[str], optional): Name of the sentence-transformers model. Defaults to get_model_name().
+        backend (Optional[str], optional): 'torch', 'onnx' or 'onnx-int8'. Defaults to get_backend().
+
+    Returns:
+        EmbeddingService: the shared service.
+    """
+
+    key = (model_name or get_model_name(), backend or get_backend())
+    with _services_lock:
+        if key not in _services:
+            _services[key] = EmbeddingService(*key)
+        return _services[key]
+
+
+def check_collection_model(metadata: Optional[Mapping[str, Any]], model_key: str, dimension: Optional[int] = None):
+    """Refuse a collection embedded with another model, or with another quantization of the model.
+
+    Args:
+        metadata (Optional[Mapping[str, Any]]): the collection metadata.
+        model_key (str): the configured embedding model, with its quantization (see EmbeddingService.cache_key).
+        dimension (Optional[int], optional): the configured embedding dimension, if known. Defaults to None.
+
+    Raises:
+        EmbeddingModelMismatchError: if the recorded model or dimension differs.
+    """
+
+    metadata = metadata or {}
+    stored_model = metadata.get(MODEL_KEY)
+    stored_dimension = metadata.get(DIMENSION_KEY)
+
+    if stored_model is not None and stored_model != model_key:
+        stored_name, _, quantization = stored_model.partition(':')
+        backend = 'onnx-int8' if quantization == 'int8' else 'torch or onnx'
+        raise EmbeddingModelMismatchError(
+            f'The collection was embedded with {stored_model}, not {model_key}. '
+            f'Set HF_EMBEDDING_MODEL={stored_name} and EMBEDDING_BACKEND={backend}, or rebuild the database with --flush.'
+        )
+    if stored_dimension is not None and dimension is not None and stored_dimension != dimension:
+        raise EmbeddingModelMismatchError(
+            f'The collection vectors have {stored_dimension} dimensions, the model produces {dimension}.'
+        )
+
+
+def record_collection_model(index, model_key: str, dimension: Optional[int] = None):
+    """Write the embedding model and dimension in the collection metadata, if they are missing.
+
+    Args:
+        index (chromadb.Collection): the collection.
+        model_key (str): the embedding model, with its quantization (see EmbeddingService.cache_key).
+        dimension (Optional[int], optional): the embedding dimension, if known. Defaults to None.
+    """
+
+    metadata = dict(index.metadata or {})
+    if metadata.get(MODEL_KEY) == model_key and (dimension is None or metadata.get(DIMENSION_KEY) == dimension):
+        return
+
+    metadata[MODEL_KEY] = model_key
+    if dimension is not None:
+        metadata[DIMENSION_KEY] = dimension
+
+    # The hnsw settings cannot be modified once the collection exists
+    index.modify(metadata={key: value for key, value in metadata.items() if not key.startswith('hnsw:')})
+
+
+def get_collection_version(index) -> str:
+    """Get the version of a collection, it changes when a sync modifies the collection
+    or when the collection is rebuilt.
+
+    Args:
+        index (chromadb.Collection): the collection.
+
+    Returns:
+        str: the collection id and its version.
+    """
+
+    return f'{index.id}:{(index.metadata or {}).get(VERSION_KEY, 0)}'
+
+
+def bump_collection_version(index):
+    """Record that a sync modified the collection, so the answers built on it are checked again.
+
+    Args:
+        index (chromadb.Collection): the collection.
+    """
+
+    metadata = dict(index.metadata or {})
+    metadata[VERSION_KEY] = int(metadata.get(VERSION_KEY, 0)) + 1
+
+    # The hnsw settings cannot be modified once the collection exists
+    index.modify(metadata={key: value for key, value in metadata.items() if not key.startswith('hnsw:')})
+
+
+def open_collection(client, name: str, embedding_function, create: bool = True):
+    """Get a collection with the shared embedding function, after checking that it
+    was embedded with the same model.
+
+    Args:
+        client (chromadb.ClientAPI): the chroma client.
+        name (str): Name of the collection.
+        embedding_function (CachedEmbeddingFunction): the embedding function.
+        create (bool, optional): create the collection if it does not exist. Defaults to True.
+
+    Raises:
+        EmbeddingModelMismatchError: if the collection was embedded with another model.
+
+    Returns:
+        chromadb.Collection: the collection.
+    """
+
+    if create:
+        index = client.get_or_create_collection(name=name, embedding_function=embedding_function)
+    else:
+        index = client.get_collection(name=name, embedding_function=embedding_function)
+
+    check_collection_model(index.metadata, embedding_function.cache_key, embedding_function.known_dimension())
+
+    if create:
+        record_collection_model(index, embedding_function.cache_key, embedding_function.known_dimension())
+    elif MODEL_KEY not in (index.metadata or {}):
+        _logger.warning(f'The embedding model of the collection {name} is unknown, sync it to record it.')
+
+    return index
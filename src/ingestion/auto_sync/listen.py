@@ -1,13 +1,16 @@
 import chromadb
+import threading
 import time
 import logging
 import os
 
-from src.ingestion.notes.ingestion import get_all_notes, sync_notes_data
-from src.ingestion.mails.ingestion import get_mails, sync_mails_data
+from src.embedding.cache import get_cached_embedding_function
+from src.embedding.service import open_collection
+from src.ingestion.notes.ingestion import sync_notes_data
+from src.ingestion.mails.connection import CONNECTION_ERRORS, ImapSession
+from src.ingestion.mails.ingestion import get_mailboxes, sync_mails_data
 
 from colorama import Fore, Style
-from typing import Literal
 
 
 logging.basicConfig(
@@ -21,53 +24,57 @@ _logger = logging.getLogger(name='AUTO-SYNC')
 class Listerner():
 
     def __init__(self):
-        """Initialize the listener object. connect to the db and get the number of records.
-
-        Args:
-            index_name (str): Name of the collection.
+        """Initialize the listener object and connect to the db.
         """
         
         # Get db credentials
         self.connect_to_db()
 
-        # Get current number of elements in the notes
-        self.last_number_fetched = len(self.ids['notes']) # type: ignore
-
-        # Get the last id for the emails
-        self.last_email_db_id = max(self.ids['mails'])
-
 
     def connect_to_db(self):
-        """Connect to the chromadb database and get the index and ids.
-
-        Args:
-            index_name (str): Name of the collection.
+        """Connect to the chromadb database and open the notes and mails collections.
         """
         # Connect to the database
-        self.chroma_client = chromadb.PersistentClient(path=os.environ.get('DB_PATH', './chroma'))
+        db_path = os.environ.get('DB_PATH', './chroma')
+        self.chroma_client = chromadb.PersistentClient(path=db_path)
+        embedding_function = get_cached_embedding_function(db_path)
         self.indexes = {
-            index: self.chroma_client.get_collection(name=index)
-            for index in ['notes', 'mails']
-        }
-        self.ids = {
-            index: self.indexes[index].get(include=[])['ids']
+            index: open_collection(self.chroma_client, index, embedding_function, create=False)
             for index in ['notes', 'mails']
         }
 
-    def is_fetchable(self, index_name: Literal['notes', 'mails']):
-        """Get the current number of notes in the Note.app
-
-        Returns:
-            int: Number of notes
+    def watch_mails(self):
+        """Keep a single IMAP session open and sync the mails as soon as the server
+        reports a change (IDLE, or NOOP polling if the server does not support it).
         """
 
-        if index_name == 'notes':
-            notes_data = get_all_notes()
-            return not (self.last_number_fetched == len(notes_data)), len(notes_data)
-        
-        elif index_name == 'mails':
-            last_email_app_id = get_mails(n_emails=1)[0]['id']
-            return not (last_email_app_id == self.last_email_db_id), last_email_app_id
+        session = ImapSession()
+        needs_sync = True
+
+        # Only the inbox is watched with IDLE, the other mailboxes are synced when it times out
+        watches_all_mailboxes = get_mailboxes() == [session.mailbox]
+
+        while True:
+            if needs_sync:
+                _logger.info('Mails are not up to date.')
+                try:
+                    sync_mails_data(
+                        flush=False,
+                        db_path=os.environ.get('DB_PATH', './chroma'),
+                        mail=session.ensure_connected()
+                    )
+                    session.reset_backoff()
+                except CONNECTION_ERRORS as e:
+                    # The login may work while the sync keeps failing, the delay grows until a sync succeeds
+                    _logger.warning(f'Mail sync interrupted ({e}).')
+                    session.drop()
+                    session.wait_backoff()
+                    continue
+                except Exception as e:
+                    _logger.error(e)
+                    _logger.warning('Due to the error the mails have not been synced.')
+
+            needs_sync = session.wait_for_changes() or not watches_all_mailboxes
 
     def start(self):
         """Start and monitor the listening of the Note.app.
@@ -75,35 +82,21 @@ class Listerner():
         """
         
         _logger.info('Starting auto-sync')
+
+        # The mails are pushed by the IMAP server, they are watched in their own thread
+        self.mail_watcher = threading.Thread(target=self.watch_mails, daemon=True)
+        self.mail_watcher.start()
+
         try:
             while True:
                 
-                # Notes auto sync 
-                note_sync_flag, total_notes_number = self.is_fetchable('notes')
-
-                if not note_sync_flag:
-                    _logger.info('Notes are up to date.')
-                else:
-                    _logger.info('Notes are not up to date.')
-                    sync_notes_data(
-                        flush=True,
-                        db_path=os.environ.get('DB_PATH', './chroma'),
-                    )
-                    self.last_number_fetched = total_notes_number
+                # Notes auto sync, the notes are listed without their body and only
+                # the modified ones are exported and re-embedded.
+                sync_notes_data(
+                    flush=False,
+                    db_path=os.environ.get('DB_PATH', './chroma'),
+                )
 
-                # Mails  auto sync
-                mail_sync_flag, last_mail_id = self.is_fetchable('mails')
-
-                if not mail_sync_flag:
-                    _logger.info('Mails are up to date.')
-                else:
-                    _logger.info('Mails are not up to date.')
-                    sync_mails_data(
-                        flush=False,
-                        db_path=os.environ.get('DB_PATH', './chroma')
-                    )
-                    self.last_email_db_id = last_mail_id
-                
                 time.sleep(10)
 
 
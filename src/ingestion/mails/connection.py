@@ -0,0 +1,296 @@
+import imaplib
+import logging
+import os
+import queue
+import re
+import select
+import threading
+import time
+
+from contextlib import contextmanager
+from itertools import count
+from typing import Callable, Iterator, List, Optional
+
+
+_logger = logging.getLogger(name='IMAP_SESSION')
+
+_CHANGE_RE = re.compile(rb'^\* \d+ (EXISTS|RECENT|EXPUNGE)')
+
+# Errors after which the connection is dropped and re-opened. A NO or BAD reply
+# (imaplib.IMAP4.error) leaves the connection usable, it is not one of them.
+CONNECTION_ERRORS = (imaplib.IMAP4.abort, OSError, EOFError)
+
+
+class MailboxError(imaplib.IMAP4.error):
+    """The server refused to select a mailbox, it does not exist or cannot be read.
+    """
+
+
+def connect_imap() -> imaplib.IMAP4:
+    """Open an authenticated connection to the IMAP server.
+
+    Returns:
+        imaplib.IMAP4: the logged in connection.
+    """
+
+    host = os.environ.get('IMAP_HOST', 'imap.mail.me.com')
+    port = int(os.environ.get('IMAP_PORT', 993))
+
+    if os.environ.get('IMAP_SSL', 'true').lower() == 'false':
+        mail = imaplib.IMAP4(host, port)
+    else:
+        mail = imaplib.IMAP4_SSL(host, port)
+
+    mail.login(os.environ.get('APPLE_EMAIL', ''), os.environ.get('APPLE_MAIL_KEY', ''))
+    return mail
+
+
+def quote_mailbox(mailbox: str) -> str:
+    """Quote a mailbox name for the IMAP commands.
+
+    Args:
+        mailbox (str): Name of the mailbox.
+
+    Returns:
+        str: the quoted name.
+    """
+
+    return '"' + mailbox.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class ImapSession():
+
+    def __init__(
+            self,
+            connect: Callable[[], imaplib.IMAP4] = connect_imap,
+            mailbox: str = 'inbox',
+            max_backoff: float = 300,
+    ):
+        """Long-lived IMAP connection, re-opened with an exponential backoff when it drops.
+
+        Args:
+            connect (Callable[[], imaplib.IMAP4], optional): opens an authenticated connection. Defaults to connect_imap.
+            mailbox (str, optional): the mailbox watched for new messages. Defaults to 'inbox'.
+            max_backoff (float, optional): maximum delay between two reconnections, in seconds. Defaults to 300.
+        """
+
+        self.connect = connect
+        self.mailbox = mailbox
+        self.max_backoff = max_backoff
+        self.mail: Optional[imaplib.IMAP4] = None
+        self._backoff = 1.0
+        self._tags = count()
+        self._last_exists: Optional[int] = None
+
+    def ensure_connected(self) -> imaplib.IMAP4:
+        """Get the connection, opening it if needed. Retries until it succeeds.
+
+        Returns:
+            imaplib.IMAP4: the logged in connection, with the watched mailbox selected.
+        """
+
+        while self.mail is None:
+            try:
+                mail = self.connect()
+                status, data = mail.select(quote_mailbox(self.mailbox), readonly=True)
+                if status != 'OK':
+                    raise MailboxError(f'Unable to select the mailbox {self.mailbox}')
+                self._last_exists = int(data[0]) if data and data[0] else None
+                self.mail = mail
+                _logger.info(f'Connected to the IMAP server, watching {self.mailbox}.')
+            except (imaplib.IMAP4.error, *CONNECTION_ERRORS) as e:
+                _logger.warning(f'IMAP connection failed ({e}).')
+                self.wait_backoff()
+
+        return self.mail
+
+    def wait_backoff(self):
+        """Wait before the next reconnection. The delay doubles at each call, until a
+        sync succeeds and calls reset_backoff, so a login that works but a sync that keeps
+        failing does not hammer the server.
+        """
+
+        _logger.warning(f'Reconnecting to the IMAP server in {self._backoff:.0f}s.')
+        time.sleep(self._backoff)
+        self._backoff = min(self._backoff * 2, self.max_backoff)
+
+    def reset_backoff(self):
+        """Reset the reconnection delay, once a sync succeeded.
+        """
+
+        self._backoff = 1.0
+
+    def drop(self):
+        """Close the connection, the next call re-opens it.
+        """
+
+        if self.mail is not None:
+            try:
+                self.mail.logout()
+            except (imaplib.IMAP4.error, *CONNECTION_ERRORS):
+                pass
+        self.mail = None
+
+    def supports_idle(self) -> bool:
+        """Check if the server supports the IMAP IDLE extension.
+
+        Returns:
+            bool: True if IDLE is supported.
+        """
+
+        return 'IDLE' in self.ensure_connected().capabilities
+
+    def wait_for_changes(self, timeout: Optional[float] = None, poll_interval: Optional[float] = None) -> bool:
+        """Block until the watched mailbox changes or the timeout expires.
+        IDLE is used when the server supports it, otherwise the mailbox is polled with NOOP.
+
+        Args:
+            timeout (Optional[float], optional): maximum wait, in seconds. Defaults to the IMAP_IDLE_TIMEOUT env variable, or 300.
+            poll_interval (Optional[float], optional): delay between two NOOP. Defaults to the IMAP_POLL_INTERVAL env variable, or 30.
+
+        Returns:
+            bool: True if new messages may have arrived.
+        """
+
+        timeout = timeout or float(os.environ.get('IMAP_IDLE_TIMEOUT', 300))
+        poll_interval = poll_interval or float(os.environ.get('IMAP_POLL_INTERVAL', 30))
+
+        try:
+            if self.supports_idle():
+                return self._idle(timeout)
+            return self._poll(timeout, poll_interval)
+        except (imaplib.IMAP4.error, *CONNECTION_ERRORS) as e:
+            # We do not know what happened while we were disconnected
+            _logger.warning(f'IMAP connection lost ({e}).')
+            self.drop()
+            return True
+
+    def _idle(self, timeout: float) -> bool:
+        mail = self.ensure_connected()
+
+        # The connection may have been used to sync another mailbox in the meantime
+        mail.select(quote_mailbox(self.mailbox), readonly=True)
+        tag = f'IDLE{next(self._tags)}'.encode()
+
+        mail.send(tag + b' IDLE\r\n')
+        line = mail.readline()
+        if not line.startswith(b'+'):
+            raise imaplib.IMAP4.error(f'IDLE refused by the server: {line!r}')
+
+        # The socket is watched with select, a timeout on the socket file would break it
+        changed = False
+        deadline = time.monotonic() + timeout
+        while not changed:
+            remaining = deadline - time.monotonic()
+            pending = getattr(mail.sock, 'pending', lambda: 0)()
+            if remaining <= 0 or not (pending or select.select([mail.sock], [], [], remaining)[0]):
+                break
+
+            line = mail.readline()
+            if not line:
+                raise imaplib.IMAP4.abort('Connection closed during IDLE')
+            changed = bool(_CHANGE_RE.match(line))
+
+        mail.send(b'DONE\r\n')
+        while True:
+            line = mail.readline()
+            if not line:
+                raise imaplib.IMAP4.abort('Connection closed during IDLE')
+            if line.startswith(tag):
+                break
+            changed = changed or bool(_CHANGE_RE.match(line))
+
+        return changed
+
+    def _poll(self, timeout: float, poll_interval: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            mail = self.ensure_connected()
+            mail.noop()
+
+            _, exists = mail.response('EXISTS')
+            if exists and exists[-1] is not None:
+                current = int(exists[-1])
+                if current != self._last_exists:
+                    self._last_exists = current
+                    return True
+
+            time.sleep(min(poll_interval, max(deadline - time.monotonic(), 0)))
+
+        return False
+
+
+
+class ImapPool():
+
+    def __init__(
+            self,
+            size: int,
+            connect: Callable[[], imaplib.IMAP4] = connect_imap,
+            connections: Optional[List[imaplib.IMAP4]] = None
+    ):
+        """Small pool of IMAP connections. A connection is used by one thread at a time,
+        since the selected mailbox is a per-connection state.
+
+        Args:
+            size (int): maximum number of connections open at once.
+            connect (Callable[[], imaplib.IMAP4], optional): opens an authenticated connection. Defaults to connect_imap.
+            connections (Optional[List[imaplib.IMAP4]], optional): open connections to reuse, they are not closed by the pool. Defaults to None.
+        """
+
+        self.size = size
+        self.connect = connect
+        self._available: queue.LifoQueue = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._borrowed = {id(mail) for mail in connections or []}
+
+        for mail in (connections or [])[:size]:
+            self._available.put(mail)
+
+    @contextmanager
+    def connection(self) -> Iterator[imaplib.IMAP4]:
+        """Borrow a connection, waiting if all of them are in use.
+        A connection that fails is logged out instead of being given back.
+
+        Yields:
+            Iterator[imaplib.IMAP4]: the logged in connection.
+        """
+
+        with self._slots:
+            try:
+                mail = self._available.get_nowait()
+            except queue.Empty:
+                mail = self.connect()
+
+            reusable = False
+            try:
+                yield mail
+                reusable = True
+            except MailboxError:
+                # The connection still works, only the mailbox was refused
+                reusable = True
+                raise
+            finally:
+                # After any other error the state of the connection is unknown, a response may be left unread
+                if reusable:
+                    self._available.put(mail)
+                else:
+                    self._logout(mail)
+
+    def _logout(self, mail: imaplib.IMAP4):
+        if id(mail) in self._borrowed:
+            return
+        try:
+            mail.logout()
+        except (imaplib.IMAP4.error, *CONNECTION_ERRORS):
+            pass
+
+    def close(self):
+        """Log out of the connections opened by the pool.
+        """
+
+        while True:
+            try:
+                self._logout(self._available.get_nowait())
+            except queue.Empty:
+                return
@@ -0,0 +1,460 @@
+import imaplib
+import logging
+import os
+import re
+import time
+
+from collections import defaultdict
+from itertools import takewhile
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+_logger = logging.getLogger(name='MAIL_FETCH')
+
+_UID_RE = re.compile(rb'UID (\d+)')
+_SIZE_RE = re.compile(rb'RFC822\.SIZE (\d+)')
+_MESSAGE_START_RE = re.compile(rb'^\d+ \(')
+_SECTION_RE = re.compile(rb'BODY\[([^\]]*)\](?:<\d+>)? \{\d+\}$')
+_LITERAL_RE = re.compile(rb'\{\d+\}$')
+_TOKEN_RE = re.compile(rb'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"]+')
+
+HEADER_FIELDS = 'FROM SUBJECT DATE MESSAGE-ID'
+
+
+def compress_uid_set(uids: List[int]) -> str:
+    """Build a compact IMAP message set out of a list of UIDs, e.g. 1:5,7,9:12.
+
+    Args:
+        uids (List[int]): the UIDs.
+
+    Returns:
+        str: the message set.
+    """
+
+    ranges = []
+    for uid in sorted(set(uids)):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+
+    return ','.join(
+        str(start) if start == end else f'{start}:{end}'
+        for start, end in ranges
+    )
+
+
+def fetch_sizes(mail: imaplib.IMAP4, uids: List[int]) -> Dict[int, int]:
+    """Get the size of the messages in a single round trip.
+
+    Args:
+        mail (imaplib.IMAP4): the IMAP connection, with the mailbox selected.
+        uids (List[int]): the UIDs.
+
+    Returns:
+        Dict[int, int]: the size in bytes of each message, keyed by UID.
+    """
+
+    if not uids:
+        return {}
+
+    status, data = mail.uid('FETCH', compress_uid_set(uids), '(RFC822.SIZE)')
+    if status != 'OK':
+        return {}
+
+    sizes = {}
+    for item in data:
+        line = item[0] if isinstance(item, tuple) else item
+        if not isinstance(line, bytes):
+            continue
+        uid, size = _UID_RE.search(line), _SIZE_RE.search(line)
+        if uid and size:
+            sizes[int(uid.group(1))] = int(size.group(1))
+    return sizes
+
+
+def plan_batches(
+        uids: List[int],
+        batch_size: int,
+        max_batch_bytes: Optional[int] = None,
+        sizes: Optional[Dict[int, int]] = None
+) -> List[List[int]]:
+    """Split the UIDs into batches bounded in number of messages and in bytes.
+    A message bigger than the byte cap gets a batch of its own.
+
+    Args:
+        uids (List[int]): the UIDs.
+        batch_size (int): maximum number of messages per batch.
+        max_batch_bytes (Optional[int], optional): maximum size of a batch. Defaults to None.
+        sizes (Optional[Dict[int, int]], optional): size of each message, keyed by UID. Defaults to None.
+
+    Returns:
+        List[List[int]]: the batches.
+    """
+
+    batches: List[List[int]] = []
+    current: List[int] = []
+    current_bytes = 0
+
+    for uid in sorted(uids):
+        size = (sizes or {}).get(uid, 0)
+        if current and (
+            len(current) >= batch_size
+            or (max_batch_bytes is not None and current_bytes + size > max_batch_bytes)
+        ):
+            batches.append(current)
+            current, current_bytes = [], 0
+
+        current.append(uid)
+        current_bytes += size
+
+    if current:
+        batches.append(current)
+    return batches
+
+
+def iter_fetch_response(data: List) -> Iterator[Tuple[int, bytes]]:
+    """Walk a multi-message FETCH response.
+
+    Args:
+        data (List): the data returned by imaplib for the FETCH command.
+
+    Yields:
+        Iterator[Tuple[int, bytes]]: the UID and the literal of each message.
+    """
+
+    for position, item in enumerate(data):
+        if not (isinstance(item, tuple) and len(item) > 1 and isinstance(item[1], bytes)):
+            continue
+
+        # Some servers send the UID after the literal, imaplib then leaves it in the next element
+        uid = _UID_RE.search(item[0])
+        if uid is None and position + 1 < len(data) and isinstance(data[position + 1], bytes):
+            uid = _UID_RE.search(data[position + 1])
+        if uid is None:
+            _logger.warning(f'No UID in the fetch response {item[0][:80]!r}')
+            continue
+        yield int(uid.group(1)), item[1]
+
+
+def fetch_messages(
+        mail: imaplib.IMAP4,
+        uids: List[int],
+        batch_size: Optional[int] = None,
+        max_batch_bytes: Optional[int] = None,
+        item: str = 'BODY.PEEK[]'
+) -> Iterator[Tuple[int, bytes]]:
+    """Fetch the messages with a few bounded FETCH commands instead of one round trip per message.
+
+    Args:
+        mail (imaplib.IMAP4): the IMAP connection, with the mailbox selected.
+        uids (List[int]): the UIDs to fetch.
+        batch_size (Optional[int], optional): messages per FETCH. Defaults to the IMAP_FETCH_BATCH_SIZE env variable, or 50.
+        max_batch_bytes (Optional[int], optional): bytes per FETCH. Defaults to the IMAP_FETCH_MAX_BYTES env variable, or 20MB.
+        item (str, optional): the fetched data item. Defaults to 'BODY.PEEK[]'.
+
+    Yields:
+        Iterator[Tuple[int, bytes]]: the UID and the raw data of each message. The messages of a failed FETCH are left out.
+    """
+
+    if not uids:
+        return
+
+    batch_size = batch_size or int(os.environ.get('IMAP_FETCH_BATCH_SIZE', 50))
+    max_batch_bytes = max_batch_bytes or int(os.environ.get('IMAP_FETCH_MAX_BYTES', 20 * 1024 * 1024))
+
+    start = time.perf_counter()
+    n_messages = 0
+    n_bytes = 0
+
+    sizes = fetch_sizes(mail, uids)
+    for batch in plan_batches(uids, batch_size, max_batch_bytes, sizes):
+        status, data = mail.uid('FETCH', compress_uid_set(batch), f'(UID {item})')
+        if status != 'OK':
+            _logger.error(f'Error: the fetch of {len(batch)} messages failed')
+            continue
+
+        for uid, raw in iter_fetch_response(data):
+            n_messages += 1
+            n_bytes += len(raw)
+            yield uid, raw
+
+    _log_rate(n_messages, n_bytes, start)
+
+
+def _log_rate(n_messages: int, n_bytes: int, start: float):
+    elapsed = time.perf_counter() - start
+    _logger.info(
+        f'Fetched {n_messages} messages ({n_bytes / 1024:.0f} KB) in {elapsed:.2f}s '
+        f'({n_messages / elapsed if elapsed else 0:.1f} msg/s)'
+    )
+
+
+def group_fetch_response(data: List) -> List[List]:
+    """Group the elements of a FETCH response by message.
+
+    Args:
+        data (List): the data returned by imaplib for the FETCH command.
+
+    Returns:
+        List[List]: the elements (bytes or (prefix, literal) tuples) of each message.
+    """
+
+    groups: List[List] = []
+    for item in data:
+        head = item[0] if isinstance(item, tuple) else item
+        if not isinstance(head, bytes):
+            continue
+        if _MESSAGE_START_RE.match(head) or not groups:
+            groups.append([])
+        groups[-1].append(item)
+    return groups
+
+
+def parse_sexp(line: bytes) -> List[Any]:
+    """Parse an IMAP parenthesized list, NIL becomes None and the atoms become str.
+
+    Args:
+        line (bytes): the response line, without literals.
+
+    Returns:
+        List[Any]: the nested lists.
+    """
+
+    stack: List[List[Any]] = [[]]
+    for match in _TOKEN_RE.finditer(line):
+        token = match.group()
+        if token == b'(':
+            stack.append([])
+        elif token == b')':
+            if len(stack) > 1:
+                closed = stack.pop()
+                stack[-1].append(closed)
+        elif token.startswith(b'"'):
+            stack[-1].append(re.sub(rb'\\(.)', rb'\1', token[1:-1]).decode('utf-8', errors='replace'))
+        elif token.upper() == b'NIL':
+            stack[-1].append(None)
+        else:
+            stack[-1].append(token.decode('utf-8', errors='replace'))
+
+    while len(stack) > 1:
+        closed = stack.pop()
+        stack[-1].append(closed)
+    return stack[0]
+
+
+def find_text_part(structure: List[Any]) -> Optional[Dict[str, Any]]:
+    """Find the section of the text/plain part of a message, or text/html if there is none.
+    Attachments and forwarded messages are skipped.
+
+    Args:
+        structure (List[Any]): the parsed BODYSTRUCTURE.
+
+    Returns:
+        Optional[Dict[str, Any]]: the section, subtype, encoding, charset and size of the part, None if there is no text part.
+    """
+
+    def walk(part: List[Any], prefix: str) -> Iterator[Tuple[str, List[Any]]]:
+        if part and isinstance(part[0], list):
+            children = takewhile(lambda child: isinstance(child, list), part)
+            for position, child in enumerate(children, 1):
+                yield from walk(child, f'{prefix}.{position}' if prefix else str(position))
+        else:
+            yield prefix or '1', part
+
+    candidates = {}
+    for section, part in walk(structure, ''):
+        if len(part) < 7 or not isinstance(part[0], str) or part[0].lower() != 'text':
+            continue
+
+        is_attachment = any(
+            isinstance(field, list) and field and isinstance(field[0], str) and field[0].lower() == 'attachment'
+            for field in part[7:]
+        )
+        subtype = (part[1] or '').lower()
+        if is_attachment or subtype not in ('plain', 'html') or subtype in candidates:
+            continue
+
+        params = part[2] if isinstance(part[2], list) else []
+        params = {str(key).lower(): value for key, value in zip(params[::2], params[1::2])}
+        candidates[subtype] = {
+            'section': section,
+            'subtype': subtype,
+            'encoding': (part[5] or '7bit').lower(),
+            'charset': params.get('charset') or 'utf-8',
+            'size': int(part[6]) if str(part[6]).isdigit() else 0,
+        }
+
+    return candidates.get('plain') or candidates.get('html')
+
+
+def fetch_bodystructures(
+        mail: imaplib.IMAP4,
+        uids: List[int],
+        batch_size: Optional[int] = None
+) -> Dict[int, Optional[Dict[str, Any]]]:
+    """Get the text part of each message from its BODYSTRUCTURE, with one FETCH per batch of messages.
+
+    Args:
+        mail (imaplib.IMAP4): the IMAP connection, with the mailbox selected.
+        uids (List[int]): the UIDs.
+        batch_size (Optional[int], optional): messages per FETCH. Defaults to the IMAP_FETCH_BATCH_SIZE env variable, or 50.
+
+    Returns:
+        Dict[int, Optional[Dict[str, Any]]]: the text part of each message (see find_text_part), keyed by UID.
+            The messages whose structure could not be read are missing.
+    """
+
+    batch_size = batch_size or int(os.environ.get('IMAP_FETCH_BATCH_SIZE', 50))
+
+    structures: Dict[int, Optional[Dict[str, Any]]] = {}
+    for batch in plan_batches(uids, batch_size):
+        status, data = mail.uid('FETCH', compress_uid_set(batch), '(UID BODYSTRUCTURE)')
+        if status != 'OK':
+            _logger.error(f'Error: the structure of {len(batch)} messages could not be fetched')
+            continue
+        structures.update(parse_bodystructures(data))
+
+    return structures
+
+
+def parse_bodystructures(data: List) -> Dict[int, Optional[Dict[str, Any]]]:
+    """Read the text part of each message of a BODYSTRUCTURE FETCH response.
+
+    Args:
+        data (List): the data returned by imaplib for the FETCH command.
+
+    Returns:
+        Dict[int, Optional[Dict[str, Any]]]: the text part of each message (see find_text_part), keyed by UID.
+    """
+
+    structures = {}
+    for group in group_fetch_response(data):
+        # The literals are put back in the line as quoted strings
+        line = b''
+        for item in group:
+            if isinstance(item, tuple):
+                literal = item[1].replace(b'\\', b'\\\\').replace(b'"', b'\\"')
+                line += _LITERAL_RE.sub(b'', item[0]) + b'"' + literal + b'"'
+            else:
+                line += item
+
+        uid = _UID_RE.search(line)
+        start = line.find(b'BODYSTRUCTURE ')
+        if uid is None or start == -1:
+            continue
+
+        try:
+            parsed = parse_sexp(line[start + len(b'BODYSTRUCTURE '):])
+            structures[int(uid.group(1))] = find_text_part(parsed[0]) if parsed and isinstance(parsed[0], list) else None
+        except (IndexError, TypeError, ValueError) as e:
+            _logger.warning(f'Unable to read the structure of the message {uid.group(1)!r}: {e}')
+
+    return structures
+
+
+def build_text_message(header: bytes, body: Optional[bytes], text_part: Optional[Dict[str, Any]]) -> bytes:
+    """Build a single part message out of the fetched header fields and text part,
+    so it can be parsed like a full message.
+
+    Args:
+        header (bytes): the fetched header fields.
+        body (Optional[bytes]): the raw text part, still transfer-encoded.
+        text_part (Optional[Dict[str, Any]]): the text part description (see find_text_part).
+
+    Returns:
+        bytes: the raw message.
+    """
+
+    message = header.rstrip(b'\r\n') + b'\r\n'
+    if text_part is not None and body is not None:
+        message += (
+            f'Content-Type: text/{text_part["subtype"]}; charset="{text_part["charset"]}"\r\n'
+            f'Content-Transfer-Encoding: {text_part["encoding"]}\r\n'
+        ).encode()
+        return message + b'\r\n' + body
+
+    return message + b'Content-Type: text/plain\r\n\r\n'
+
+
+def fetch_text_messages(
+        mail: imaplib.IMAP4,
+        uids: List[int],
+        batch_size: Optional[int] = None,
+        max_batch_bytes: Optional[int] = None,
+        max_part_bytes: Optional[int] = None
+) -> Iterator[Tuple[int, bytes]]:
+    """Fetch only the header fields and the text part of the messages, the attachments are never downloaded.
+    The BODYSTRUCTURE of the messages is fetched first to find the text part.
+
+    Args:
+        mail (imaplib.IMAP4): the IMAP connection, with the mailbox selected.
+        uids (List[int]): the UIDs to fetch.
+        batch_size (Optional[int], optional): messages per FETCH. Defaults to the IMAP_FETCH_BATCH_SIZE env variable, or 50.
+        max_batch_bytes (Optional[int], optional): bytes per FETCH. Defaults to the IMAP_FETCH_MAX_BYTES env variable, or 20MB.
+        max_part_bytes (Optional[int], optional): bytes fetched per text part. Defaults to the IMAP_TEXT_PART_MAX_BYTES env variable, or no limit.
+
+    Yields:
+        Iterator[Tuple[int, bytes]]: the UID and a raw single part message holding the headers and the text.
+            The messages of a failed FETCH are left out.
+    """
+
+    if not uids:
+        return
+
+    batch_size = batch_size or int(os.environ.get('IMAP_FETCH_BATCH_SIZE', 50))
+    max_batch_bytes = max_batch_bytes or int(os.environ.get('IMAP_FETCH_MAX_BYTES', 20 * 1024 * 1024))
+    max_part_bytes = max_part_bytes or int(os.environ.get('IMAP_TEXT_PART_MAX_BYTES', 0)) or None
+
+    start = time.perf_counter()
+    n_messages = 0
+    n_bytes = 0
+
+    structures = fetch_bodystructures(mail, uids, batch_size)
+
+    # The messages are grouped by text section so a FETCH asks the same items for all of them
+    by_section = defaultdict(list)
+    for uid, text_part in structures.items():
+        by_section[text_part['section'] if text_part else None].append(uid)
+
+    for section, section_uids in by_section.items():
+        items = f'UID BODY.PEEK[HEADER.FIELDS ({HEADER_FIELDS})]'
+        if section is not None:
+            items += f' BODY.PEEK[{section}]' + (f'<0.{max_part_bytes}>' if max_part_bytes else '')
+
+        sizes = {
+            uid: min(structures[uid]['size'], max_part_bytes or structures[uid]['size']) # type: ignore
+            for uid in section_uids if structures[uid]
+        }
+
+        for batch in plan_batches(section_uids, batch_size, max_batch_bytes, sizes):
+            status, data = mail.uid('FETCH', compress_uid_set(batch), f'({items})')
+            if status != 'OK':
+                _logger.error(f'Error: the fetch of {len(batch)} messages failed')
+                continue
+
+            for group in group_fetch_response(data):
+                literals = {}
+                uid = None
+                for item in group:
+                    head = item[0] if isinstance(item, tuple) else item
+                    uid = uid or _UID_RE.search(head)
+                    key = _SECTION_RE.search(head) if isinstance(item, tuple) else None
+                    if key is not None:
+                        literals[key.group(1).split(b' ')[0]] = item[1]
+
+                if uid is None or int(uid.group(1)) not in structures:
+                    continue
+
+                header = literals.get(b'HEADER.FIELDS', b'')
+                body = literals.get(section.encode()) if section is not None else None
+                n_messages += 1
+                n_bytes += len(header) + len(body or b'')
+                yield int(uid.group(1)), build_text_message(header, body, structures[int(uid.group(1))])
+
+    _log_rate(n_messages, n_bytes, start)
+
+    # The messages with an unreadable structure are fetched in full
+    unknown_uids = [uid for uid in uids if uid not in structures]
+    if unknown_uids:
+        yield from fetch_messages(mail, unknown_uids, batch_size, max_batch_bytes)
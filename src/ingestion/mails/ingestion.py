@@ -1,176 +1,355 @@
 import imaplib
 import logging
 import os
+import re
 import chromadb
 
-from bs4 import BeautifulSoup
-from email import policy
-from email.parser import BytesParser
-from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from itertools import batched
+from typing import Dict, Iterator, List, Optional, Tuple
 import chromadb.errors
-from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
+
+from src.embedding.cache import get_cached_embedding_function
+from src.embedding.chunking import upsert_chunks
+from src.embedding.service import bump_collection_version, open_collection, record_collection_model
+from src.lexical import get_lexical_index
+from src.metadata import mail_metadata, upgrade_metadata
+from src.ingestion.mails.connection import CONNECTION_ERRORS, ImapPool, MailboxError, connect_imap, quote_mailbox
+from src.ingestion.mails.fetch import fetch_messages, fetch_text_messages
+from src.ingestion.mails.parsing import parse_raw_mail_data
+from src.ingestion.mails.pipeline import MailChannel, RawMail, get_parse_workers, parse_mails
+from src.ingestion.mails.state import MailSyncState
 
 
 _logger = logging.getLogger(name='MAIL_INGESTION')
 
 
-def get_mails(n_emails: int = 100) -> List[Dict[str, str]]:
-    """Fetch the emails from the mail app.
+def get_mailboxes() -> List[str]:
+    """Get the mailboxes to sync from the MAIL_MAILBOXES env variable, a comma separated list.
+
+    Returns:
+        List[str]: Names of the mailboxes, ['inbox'] by default.
+    """
+
+    return [
+        mailbox.strip()
+        for mailbox in os.environ.get('MAIL_MAILBOXES', 'inbox').split(',')
+        if mailbox.strip()
+    ]
+
+
+def make_mail_id(mailbox: str, uidvalidity: int, uid: int) -> str:
+    """Build the id of a mail. UIDs are stable within a UIDVALIDITY, unlike sequence numbers.
 
     Args:
-        n_emails (int): Number of mails to be fectched. starting at the last one.
+        mailbox (str): Name of the mailbox.
+        uidvalidity (int): UIDVALIDITY of the mailbox.
+        uid (int): UID of the message.
 
     Returns:
-        List[Dict[str, str]]: List of mail data.
+        str: the mail id.
+    """
+
+    return f'{mailbox}/{uidvalidity}/{uid}'
+
+
+def select_mailbox(mail: imaplib.IMAP4, mailbox: str) -> Tuple[int, Optional[int]]:
+    """Select a mailbox in read-only mode.
+
+    Args:
+        mail (imaplib.IMAP4): the IMAP connection.
+        mailbox (str): Name of the mailbox.
+
+    Raises:
+        MailboxError: if the server answers NO or BAD, the mailbox does not exist or cannot be read.
+
+    Returns:
+        Tuple[int, Optional[int]]: the UIDVALIDITY and the UIDNEXT of the mailbox, UIDNEXT is None if the server does not send it.
+    """
+
+    try:
+        status, _ = mail.select(quote_mailbox(mailbox), readonly=True)
+    except CONNECTION_ERRORS:
+        raise
+    except imaplib.IMAP4.error as e:
+        raise MailboxError(f'Unable to select the mailbox {mailbox}: {e}')
+    if status != 'OK':
+        raise MailboxError(f'Unable to select the mailbox {mailbox}')
+
+    _, uidvalidity = mail.response('UIDVALIDITY')
+    _, uidnext = mail.response('UIDNEXT')
+    return int(uidvalidity[0]), int(uidnext[0]) if uidnext and uidnext[0] else None
+
+
+def has_new_mails(state: MailSyncState, mailbox: str = 'inbox', mail: Optional[imaplib.IMAP4] = None) -> bool:
+    """Check with a single STATUS command if a mailbox received mails since the last sync.
+
+    Args:
+        state (MailSyncState): the sync state.
+        mailbox (str, optional): Name of the mailbox. Defaults to 'inbox'.
+        mail (Optional[imaplib.IMAP4], optional): an open connection to reuse, it is left open. Defaults to None.
+
+    Returns:
+        bool: True if a sync is needed.
+    """
+
+    own_connection = mail is None
+    if mail is None:
+        mail = connect_imap()
+    try:
+        status, data = mail.status(quote_mailbox(mailbox), '(UIDNEXT UIDVALIDITY)')
+    finally:
+        if own_connection:
+            mail.logout()
+
+    if status != 'OK' or not data or not data[0]:
+        return True
+
+    response = data[0].decode() if isinstance(data[0], bytes) else str(data[0])
+    uidnext = re.search(r'UIDNEXT (\d+)', response)
+    uidvalidity = re.search(r'UIDVALIDITY (\d+)', response)
+    if not uidnext or not uidvalidity:
+        return True
+
+    return int(uidnext.group(1)) > state.last_uid(mailbox, int(uidvalidity.group(1))) + 1
+
+
+def iter_raw_mails(
+        mailbox: str = 'inbox',
+        n_emails: int = 100,
+        state: Optional[MailSyncState] = None,
+        mail: Optional[imaplib.IMAP4] = None
+) -> Iterator[RawMail]:
+    """Fetch the new messages of a mailbox, without parsing them.
+    With a sync state only the messages above the last synced UID are fetched,
+    the whole mailbox is re-synced when its UIDVALIDITY changes.
+
+    Args:
+        mailbox (str, optional): Name of the mailbox. Defaults to 'inbox'.
+        n_emails (int, optional): Number of mails fetched on a full sync. starting at the last one. Defaults to 100.
+        state (Optional[MailSyncState], optional): the sync state, updated once the messages are fetched, up to the
+            first one a failed fetch left out. Defaults to None.
+        mail (Optional[imaplib.IMAP4], optional): an open connection to reuse, it is left open. Defaults to None.
+
+    Yields:
+        Iterator[RawMail]: the mailbox, the mail id and the raw email of each message.
     """
 
     # Connect to iCloud
-    _logger.info('Extracting raw emails.')
+    _logger.info(f'Extracting raw emails from {mailbox}.')
 
-    mail = imaplib.IMAP4_SSL("imap.mail.me.com")
-    mail.login(os.environ.get('APPLE_EMAIL', ''), os.environ.get('APPLE_MAIL_KEY', ''))
-    mail.select("inbox")
+    own_connection = mail is None
+    if mail is None:
+        mail = connect_imap()
 
-    # Fetch messages
-    status, messages = mail.search(None, "ALL")
-    if status != "OK" or not messages[0]:
-        logging.error("Error: No messages found or search failed")
-        mail.logout()
-        exit()
+    try:
+        uidvalidity, uidnext = select_mailbox(mail, mailbox)
+        last_uid = state.last_uid(mailbox, uidvalidity) if state else 0
 
-    email_ids = messages[0].split()
+        # Nothing arrived since the last sync, no need to search the mailbox
+        if last_uid and uidnext is not None and uidnext <= last_uid + 1:
+            _logger.info(f'No new emails in {mailbox}.')
+            return
 
-    mails = []
+        # Search the new messages, n:* always returns the last message so we filter it
+        status, messages = mail.uid('SEARCH', None, f'UID {last_uid + 1}:*') # type: ignore
+        if status != "OK":
+            _logger.error(f"Error: the search failed in {mailbox}")
+            return
 
-    # Print emails from the last
-    for num in email_ids[-n_emails:]:
-        try:
-            # Convert email ID to string if it's bytes
-            email_id = num.decode() if isinstance(num, bytes) else str(num)
-            
-            # Fetch email data with BODY[] to get full message
-            status, data = mail.fetch(email_id, "(BODY.PEEK[])")
-            
-            # Check if data is in the expected format
-            if not data or not isinstance(data, list) or len(data) == 0:
-                _logger.warning(f"Error: No data returned for email {email_id}")
-                continue
-        
-            # Extract raw email content
-            raw_email = None
-            for item in data:
-                if isinstance(item, tuple) and len(item) > 1 and isinstance(item[1], bytes):
-                    raw_email = item[1]  # Email content in bytes
+        uids = sorted(int(uid) for uid in messages[0].split() if int(uid) > last_uid)
+        if not last_uid:
+            uids = uids[-n_emails:]
+
+        # The messages are fetched by batches, not with one round trip per message.
+        # In text mode only the headers and the text part are downloaded, not the attachments.
+        if os.environ.get('IMAP_FETCH_MODE', 'text') == 'full':
+            fetched = fetch_messages(mail, uids)
+        else:
+            fetched = fetch_text_messages(mail, uids)
+
+        fetched_uids = set()
+        for uid, raw_email in fetched:
+            fetched_uids.add(uid)
+            yield mailbox, make_mail_id(mailbox, uidvalidity, uid), raw_email
+
+        if state is not None:
+            # A failed batch is fetched again by the next sync, the state stops before its first message
+            synced_uid = last_uid
+            for uid in uids:
+                if uid not in fetched_uids:
+                    _logger.warning(f'The messages of {mailbox} from UID {uid} were not all fetched, they are retried on the next sync.')
                     break
-            
-            if raw_email is None:
-                _logger.warning(f"Error: No valid email content found for {email_id}")
-                continue
-            
-            mails.append(parse_raw_mail_data(raw_email, email_id))
-
-            
-        except Exception as e:
-            print(f"Error processing email {num}: {str(e)}")
+                synced_uid = uid
+            state.update(mailbox, uidvalidity, synced_uid)
 
-    mail.logout()
-    return mails
+    finally:
+        if own_connection:
+            mail.logout()
 
 
-def parse_raw_mail_data(raw_email: bytes, email_id: str) -> Dict[str, str]:
-    """Parse a raw email into the correct format.
+def get_mails(
+        n_emails: int = 100,
+        mailbox: str = 'inbox',
+        state: Optional[MailSyncState] = None,
+        mail: Optional[imaplib.IMAP4] = None
+) -> List[Dict[str, str]]:
+    """Fetch the emails from the mail app.
+    With a sync state only the messages above the last synced UID are fetched,
+    the whole mailbox is re-synced when its UIDVALIDITY changes.
 
     Args:
-        raw_email (bytes): raw bytes text email.
-        email_id (str): mail id.
+        n_emails (int): Number of mails fetched on a full sync. starting at the last one.
+        mailbox (str, optional): Name of the mailbox. Defaults to 'inbox'.
+        state (Optional[MailSyncState], optional): the sync state, updated with the fetched UIDs. Defaults to None.
+        mail (Optional[imaplib.IMAP4], optional): an open connection to reuse, it is left open. Defaults to None.
 
     Returns:
-        Dict[str, str]: Parsed email.
+        List[Dict[str, str]]: List of mail data.
     """
-    
-    # Parse email
-    msg = BytesParser(policy=policy.default).parsebytes(raw_email)
-    
-    # Handling plain text or HTML body
-    content = ''
-    if msg.is_multipart():
-        for part in msg.walk():
-            if part.get_content_type() == "text/plain":
-                soup = BeautifulSoup(part.get_content(), "html.parser")
-                content += soup.get_text(separator=' ', strip=True)
-                break  # Only print the first plain text part
-    else:
-        soup = BeautifulSoup(msg.get_content(), "html.parser")
-        content = soup.get_text(separator=' ', strip=True)
-
-
-    # Format the mail
-    mail = {
-        'from': msg['From'],
-        'subject': msg['Subject'],
-        'date': msg['Date'],
-        'id':email_id,
-        'content': content
-    }
-
-    return mail
+
+    return list(parse_mails(iter_raw_mails(mailbox, n_emails, state, mail)))
+
 
 def sync_mails_data(
         flush: bool,
         db_path: str,
+        mailboxes: Optional[List[str]] = None,
+        mail: Optional[imaplib.IMAP4] = None,
         **kwargs: Dict
 ):
     """Synchronize the mails with the chroma database.
+    Only the messages received since the last sync are fetched, the last synced
+    UID is stored next to the database. The mailboxes are fetched concurrently
+    over a small pool of IMAP connections.
 
     Args:
-        index_name (str): Collection name in the chroma db.
         flush (bool): If we re-create the collections.
         db_path (str): Location of the chroma db file.
+        mailboxes (Optional[List[str]], optional): Names of the mailboxes. Defaults to get_mailboxes().
+        mail (Optional[imaplib.IMAP4], optional): an open connection to reuse. Defaults to None.
     """
 
-    # Fetch all the mails
-    mails = get_mails()
-    
-    # Prepare the data
-    _logger.info('Creating the docs, metadatas and ids...')
-
-    documents = [mail['content'] for mail in mails]
-    metadatas = [
-        {
-            'from': mail['from'],
-            'subject': mail['subject'],
-            'date': mail['date'],
-        }
-        for mail in mails
-    ]
-    ids = [mail['id'] for mail in mails]
-
     # Init the chroma client
-
     chroma_client = chromadb.PersistentClient(path=db_path)
+    embedding_function = get_cached_embedding_function(db_path)
+    state = MailSyncState(os.path.join(db_path, 'mails_state.json'))
+    lexical = get_lexical_index(db_path, 'mails')
 
     if flush:
         try:
             chroma_client.delete_collection(name='mails')
         except chromadb.errors.NotFoundError:
             _logger.info(f'the index -- mails -- does not exist.')
+        state.clear()
+        lexical.clear()
+
+    index = open_collection(chroma_client, 'mails', embedding_function)
+
+    # The mails synced before the typed metadata are filtered like the new ones
+    upgrade_metadata(index, 'mails')
 
-    index = chroma_client.get_or_create_collection(
-        name='mails',
-        embedding_function=SentenceTransformerEmbeddingFunction(
-            model_name=os.environ.get('HF_EMBEDDING_MODEL', 'all-MiniLM-L6-v2')
-        ) # type: ignore
+    mailboxes = mailboxes or get_mailboxes()
+
+    # The mails indexed before the UID sync were keyed on sequence numbers
+    previous_states = {mailbox: state.get(mailbox) for mailbox in mailboxes}
+    if not flush and not state.mailboxes:
+        legacy_ids = [mail_id for mail_id in index.get(include=[])['ids'] if '/' not in mail_id]
+        if legacy_ids:
+            index.delete(ids=legacy_ids)
+            lexical.delete(legacy_ids)
+
+    # Fetch the new mails, one mailbox per connection at a time. The fetching threads,
+    # the parsing processes and the embedding of the batches run at the same time.
+    pool = ImapPool(
+        size=min(len(mailboxes), int(os.environ.get('IMAP_MAX_CONNECTIONS', 3))),
+        connections=[mail] if mail is not None else None
+    )
+    workers = get_parse_workers()
+    channel = MailChannel(
+        producers=len(mailboxes),
+        maxsize=int(os.environ.get('MAIL_PARSE_QUEUE_DEPTH', 4 * workers))
     )
+    errors: Dict[str, Exception] = {}
+
+    def fetch_mailbox(mailbox: str):
+        try:
+            with pool.connection() as connection:
+                for item in iter_raw_mails(mailbox=mailbox, state=state, mail=connection):
+                    if not channel.put(item):
+                        return
+        except MailboxError as e:
+            # A misspelled or deleted mailbox of MAIL_MAILBOXES does not stop the other ones
+            _logger.error(f'{e}, check MAIL_MAILBOXES. The mailbox is skipped.')
+        except Exception as e:
+            _logger.error(f'Error fetching the mailbox {mailbox}: {e}')
+            errors[mailbox] = e
+        finally:
+            channel.done()
+
+    batch_size = int(os.environ.get('MAIL_UPSERT_BATCH_SIZE', 64))
+    n_mails = 0
+    n_chunks = 0
+    n_deleted = 0
 
-    # Update the index
     try:
-        index.add(
-            ids=ids,
-            documents=documents,
-            metadatas=metadatas # type: ignore
-        )
-    except Exception as e:
-        _logger.error(e)
-        _logger.error('Due to the error no element has been added to the database.')
-    
-    _logger.info('Chroma mails vector database is up to date.')
\ No newline at end of file
+        with ThreadPoolExecutor(max_workers=pool.size) as executor:
+            for mailbox in mailboxes:
+                executor.submit(fetch_mailbox, mailbox)
+
+            try:
+                for batch in batched(parse_mails(channel, workers=workers), batch_size):
+                    n_chunks += upsert_chunks(
+                        index,
+                        ids=[mail['id'] for mail in batch],
+                        documents=[mail['content'] for mail in batch],
+                        metadatas=[mail_metadata(mail) for mail in batch],
+                        lexical=lexical
+                    )
+                    n_mails += len(batch)
+
+            except Exception as e:
+                _logger.error(e)
+                _logger.error(f'Due to the error only {n_mails} mails have been added to the database.')
+                bump_collection_version(index)
+                return
+
+            finally:
+                channel.close()
+
+    finally:
+        pool.close()
+
+    for mailbox, error in errors.items():
+        if mail is not None and isinstance(error, CONNECTION_ERRORS):
+            raise error
+
+    # The UIDs of a mailbox have been reset, its old ids are meaningless
+    for mailbox, previous_state in previous_states.items():
+        current_state = state.get(mailbox)
+        if previous_state and current_state and previous_state['uidvalidity'] != current_state['uidvalidity']:
+            _logger.warning(f'UIDVALIDITY of {mailbox} changed, the mailbox is fully re-synced.')
+            stale_ids = [
+                mail_id for mail_id in index.get(where={'mailbox': mailbox}, include=[])['ids']
+                if mail_id.rsplit('/', 2)[1] != str(current_state['uidvalidity'])
+            ]
+            if stale_ids:
+                index.delete(ids=stale_ids)
+                lexical.delete(stale_ids)
+                n_deleted += len(stale_ids)
+
+    state.save()
+
+    # The answers cached on the mails are checked again
+    if n_mails or n_deleted:
+        bump_collection_version(index)
+
+    # The lexical index of a database synced before it existed is built from the collection
+    lexical.ensure_synced(index)
+
+    _logger.info(f'{n_mails} mails added to the database ({n_chunks} chunks).')
+    # The dimension is known once a vector has been computed or read from the cache
+    record_collection_model(index, embedding_function.cache_key, embedding_function.known_dimension())
+
+    _logger.info(f'Embedding cache: {embedding_function.cache.stats()}')
+    _logger.info('Chroma mails vector database is up to date.')
@@ -0,0 +1,58 @@
+from email import policy
+from email.parser import BytesParser
+from typing import Dict, Tuple
+
+from src.ingestion.text import normalize_mail
+
+
+# This module is imported by the parsing worker processes, it must stay light:
+# no chromadb nor embedding model import here.
+
+
+def parse_raw_mail_data(raw_email: bytes, email_id: str) -> Dict[str, str]:
+    """Parse a raw email into the correct format.
+
+    Args:
+        raw_email (bytes): raw bytes text email.
+        email_id (str): mail id.
+
+    Returns:
+        Dict[str, str]: Parsed email.
+    """
+
+    # Parse email
+    msg = BytesParser(policy=policy.default).parsebytes(raw_email)
+
+    # Handling plain text or HTML body, the plain text part is preferred
+    body = msg.get_body(preferencelist=('plain', 'html'))
+    content = ''
+    if body is not None:
+        content = normalize_mail(body.get_content(), is_html=body.get_content_subtype() == 'html')
+
+
+    # Format the mail
+    mail = {
+        'from': msg['From'],
+        'subject': msg['Subject'],
+        'date': msg['Date'],
+        'id':email_id,
+        'content': content
+    }
+
+    return mail
+
+
+def parse_raw_mail_item(item: Tuple[str, str, bytes]) -> Dict[str, str]:
+    """Parse a fetched message, used as the task of the parsing pool.
+
+    Args:
+        item (Tuple[str, str, bytes]): the mailbox, the mail id and the raw email.
+
+    Returns:
+        Dict[str, str]: Parsed email, with its mailbox.
+    """
+
+    mailbox, email_id, raw_email = item
+    mail = parse_raw_mail_data(raw_email, email_id)
+    mail['mailbox'] = mailbox
+    return mail
@@ -0,0 +1,150 @@
+import logging
+import os
+import queue
+import threading
+
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Deque, Dict, Iterable, Iterator, Optional, Tuple
+
+from src.ingestion.mails.parsing import parse_raw_mail_item
+
+
+_logger = logging.getLogger(name='MAIL_PIPELINE')
+
+# A fetched message: its mailbox, its mail id and the raw email
+RawMail = Tuple[str, str, bytes]
+
+
+def get_parse_workers() -> int:
+    """Get the number of parsing processes from the MAIL_PARSE_WORKERS env variable.
+
+    Returns:
+        int: number of worker processes, the number of cpus by default.
+    """
+
+    return max(1, int(os.environ.get('MAIL_PARSE_WORKERS', os.cpu_count() or 1)))
+
+
+def parse_mails(
+        raw_mails: Iterable[RawMail],
+        workers: Optional[int] = None,
+        max_pending: Optional[int] = None
+) -> Iterator[Dict[str, str]]:
+    """Parse the fetched messages in a pool of processes.
+    The mails are yielded in the order of the input, and at most max_pending
+    messages are held by the pool so the memory stays flat on a large backfill.
+
+    Args:
+        raw_mails (Iterable[RawMail]): the fetched messages, consumed lazily.
+        workers (Optional[int], optional): number of worker processes, the messages are parsed inline with 1. Defaults to get_parse_workers().
+        max_pending (Optional[int], optional): maximum number of messages submitted and not yet yielded. Defaults to the MAIL_PARSE_QUEUE_DEPTH env variable, or 4 per worker.
+
+    Yields:
+        Iterator[Dict[str, str]]: the parsed mails, the messages that cannot be parsed are skipped.
+    """
+
+    workers = workers or get_parse_workers()
+
+    if workers <= 1:
+        for item in raw_mails:
+            mail = _parse_or_log(item)
+            if mail is not None:
+                yield mail
+        return
+
+    max_pending = max_pending or int(os.environ.get('MAIL_PARSE_QUEUE_DEPTH', 4 * workers))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending: Deque[Tuple[str, Future]] = deque()
+
+        for item in raw_mails:
+            pending.append((item[1], executor.submit(parse_raw_mail_item, item)))
+
+            # We wait for the oldest message, the next ones keep the workers busy
+            if len(pending) >= max_pending:
+                mail = _result_or_log(*pending.popleft())
+                if mail is not None:
+                    yield mail
+
+        while pending:
+            mail = _result_or_log(*pending.popleft())
+            if mail is not None:
+                yield mail
+
+
+def _parse_or_log(item: RawMail) -> Optional[Dict[str, str]]:
+    try:
+        return parse_raw_mail_item(item)
+    except Exception as e:
+        _logger.error(f"Error processing email {item[1]}: {str(e)}")
+        return None
+
+
+def _result_or_log(mail_id: str, future: Future) -> Optional[Dict[str, str]]:
+    try:
+        return future.result()
+    except Exception as e:
+        _logger.error(f"Error processing email {mail_id}: {str(e)}")
+        return None
+
+
+class MailChannel():
+
+    def __init__(self, producers: int, maxsize: int):
+        """Bounded queue between the fetching threads and the parsing pool.
+        A full channel blocks the producers, so the IMAP fetch never runs far
+        ahead of the parsing and the embedding.
+
+        Args:
+            producers (int): number of producers, the channel ends when all of them are done.
+            maxsize (int): maximum number of queued messages.
+        """
+
+        self.producers = producers
+        self._queue: queue.Queue = queue.Queue(maxsize=maxsize)
+        self._closed = threading.Event()
+
+    def put(self, item: RawMail) -> bool:
+        """Queue a message, waiting while the channel is full.
+
+        Args:
+            item (RawMail): the fetched message.
+
+        Returns:
+            bool: False if the consumer stopped, the producer should stop as well.
+        """
+
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def done(self):
+        """Signal that a producer has no more messages.
+        """
+
+        while not self._closed.is_set():
+            try:
+                self._queue.put(None, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def close(self):
+        """Stop the channel, the waiting producers are released.
+        """
+
+        self._closed.set()
+
+    def __iter__(self) -> Iterator[RawMail]:
+        remaining = self.producers
+        while remaining and not self._closed.is_set():
+            item = self._queue.get()
+            if item is None:
+                remaining -= 1
+            else:
+                yield item
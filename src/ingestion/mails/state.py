@@ -0,0 +1,85 @@
+import json
+import logging
+import os
+
+from typing import Dict, Optional
+
+
+_logger = logging.getLogger(name='MAIL_STATE')
+
+
+class MailSyncState():
+
+    def __init__(self, path: str):
+        """Load the IMAP sync state from the disk: the UIDVALIDITY and the last
+        synced UID of each mailbox.
+
+        Args:
+            path (str): Location of the json state file.
+        """
+
+        self.path = path
+        self.mailboxes: Dict[str, Dict[str, int]] = {}
+
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as state_file:
+                    self.mailboxes = json.load(state_file)
+            except (OSError, json.JSONDecodeError) as e:
+                _logger.error(e)
+                _logger.warning('The mail sync state is unreadable, the mailboxes will be fully re-synced.')
+
+    def get(self, mailbox: str) -> Optional[Dict[str, int]]:
+        """Get the state of a mailbox.
+
+        Args:
+            mailbox (str): Name of the mailbox.
+
+        Returns:
+            Optional[Dict[str, int]]: its uidvalidity and last_uid, None if it was never synced.
+        """
+
+        return self.mailboxes.get(mailbox)
+
+    def last_uid(self, mailbox: str, uidvalidity: int) -> int:
+        """Get the last synced UID of a mailbox, 0 if the mailbox must be fully re-synced.
+
+        Args:
+            mailbox (str): Name of the mailbox.
+            uidvalidity (int): the current UIDVALIDITY of the mailbox.
+
+        Returns:
+            int: the last synced UID.
+        """
+
+        state = self.mailboxes.get(mailbox)
+        if state is None or state['uidvalidity'] != uidvalidity:
+            return 0
+        return state['last_uid']
+
+    def update(self, mailbox: str, uidvalidity: int, last_uid: int):
+        """Record the last synced UID of a mailbox.
+
+        Args:
+            mailbox (str): Name of the mailbox.
+            uidvalidity (int): the UIDVALIDITY the UID belongs to.
+            last_uid (int): the highest UID written to the collection.
+        """
+
+        self.mailboxes[mailbox] = {'uidvalidity': uidvalidity, 'last_uid': last_uid}
+
+    def clear(self):
+        """Forget every mailbox, used when the collection is rebuilt from scratch.
+        """
+
+        self.mailboxes = {}
+
+    def save(self):
+        """Write the state on the disk, the file is replaced atomically.
+        """
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as state_file:
+            json.dump(self.mailboxes, state_file)
+        os.replace(tmp_path, self.path)
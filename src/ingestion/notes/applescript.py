@@ -0,0 +1,86 @@
+import logging
+import os
+import subprocess
+
+from typing import Callable, Iterator, Sequence
+
+
+_logger = logging.getLogger('APPLESCRIPT')
+
+# A script runner takes the path of an osascript and its arguments, and yields
+# the |||END||| delimited records written by the script.
+ScriptRunner = Callable[[str, Sequence[str]], Iterator[str]]
+
+
+def split_records(chunks: Iterator[str]) -> Iterator[str]:
+    """Split a stream of text chunks into |||END||| delimited records.
+
+    Args:
+        chunks (Iterator[str]): the text, in chunks of any size.
+
+    Yields:
+        Iterator[str]: the raw records, without the delimiter.
+    """
+
+    buffer = ''
+    for chunk in chunks:
+        buffer += chunk
+        *records, buffer = buffer.split('|||END|||')
+        yield from records
+
+    if buffer.strip():
+        yield buffer
+
+
+def read_osascript_stream(script_path: str, args: Sequence[str] = (), chunk_size: int = 1 << 16) -> Iterator[str]:
+    """Run an osascript and yield the |||END||| delimited records as soon as they are written.
+    The scripts write their records with log, which osascript sends to stderr.
+
+    Args:
+        script_path (str): path of the osascript to run.
+        args (Sequence[str], optional): arguments given to the run handler of the script. Defaults to ().
+        chunk_size (int, optional): number of characters read from the pipe at once. Defaults to 65536.
+
+    Raises:
+        subprocess.CalledProcessError: if the script exits with an error, once its records are read.
+
+    Yields:
+        Iterator[str]: the raw records, without the delimiter.
+    """
+
+    process = subprocess.Popen(
+        ['osascript', script_path, *args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True
+    )
+
+    try:
+        yield from split_records(iter(lambda: process.stderr.read(chunk_size), '')) # type: ignore
+    finally:
+        process.stderr.close() # type: ignore
+        returncode = process.wait()
+
+    # A failed script may have written part of the notes only, it must not look like a complete export
+    if returncode != 0:
+        _logger.error(f'osascript {script_path} exited with code {returncode}')
+        raise subprocess.CalledProcessError(returncode, ['osascript', script_path, *args])
+
+
+class RecordedScriptRunner():
+
+    def __init__(self, directory: str):
+        """Script runner replaying outputs recorded on a mac, used to run the parsing
+        and the diff logic on other platforms.
+        The output of `applescripts/<name>.scpt` is read from `<directory>/<name>.txt`.
+
+        Args:
+            directory (str): directory of the recorded outputs.
+        """
+
+        self.directory = directory
+
+    def __call__(self, script_path: str, args: Sequence[str] = ()) -> Iterator[str]:
+        name = os.path.splitext(os.path.basename(script_path))[0]
+        with open(os.path.join(self.directory, f'{name}.txt'), 'r') as recording:
+            yield from split_records(iter(lambda: recording.read(1 << 16), ''))
@@ -1,170 +1,422 @@
-import subprocess
 import chromadb
 import logging
-import re
 import os
 
-from typing import List, Dict, Optional
+from functools import partial
+from itertools import batched
+from typing import Dict, Iterable, Iterator, List, Optional
 import chromadb.errors
-from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
+
+from src.embedding.cache import get_cached_embedding_function
+from src.embedding.chunking import delete_documents, get_document_ids, regroup_chunks, upsert_chunks
+from src.embedding.service import bump_collection_version, open_collection, record_collection_model
+from src.lexical import get_lexical_index
+from src.metadata import build_where, note_metadata, parse_date, parse_filters, upgrade_metadata
+from src.ingestion.notes.applescript import ScriptRunner, read_osascript_stream
+from src.ingestion.notes.manifest import NotesManifest, get_note_id
+from src.ingestion.notes.notestore import DEFAULT_NOTESTORE_PATH, NoteStoreReader
+from src.ingestion.text import normalize_note
 
 
 _logger = logging.getLogger('NOTE_INGESTION')
 
 
-def get_all_notes(ignore_empty_title: bool = True) -> List[Dict[str, str]]:
+def stream_notes(
+        ignore_empty_title: bool = True,
+        runner: ScriptRunner = read_osascript_stream
+) -> Iterator[Dict[str, str]]:
+    """Run the osascript that get all the notes from the note app and yield them one at a time.
+
+    Args:
+        ignore_empty_title (bool, optional): Ignore the notes that don't have a title. Defaults to True.
+        runner (ScriptRunner, optional): runs the osascript. Defaults to read_osascript_stream.
+
+    Yields:
+        Iterator[Dict[str, str]]: the notes, each dict represents a note and its data.
+    """
+
+    _logger.info('Extracting raw notes.')
+
+    yield from iter_parsed_notes(
+        runner('./applescripts/fetch_notes.scpt', ()),
+        ignore_empty_title
+    )
+
+
+def get_all_notes(
+        ignore_empty_title: bool = True,
+        runner: ScriptRunner = read_osascript_stream
+) -> List[Dict[str, str]]:
     """Run the osascript that get all the notes from the note app.
 
     Args:
         ignore_empty_title (bool, optional): Ignore the notes that don't have a title. Defaults to True.
+        runner (ScriptRunner, optional): runs the osascript. Defaults to read_osascript_stream.
 
     Returns:
         List[Dict[str, str]]: a list of dict, each dict represents a note and its data.
     """
 
-    _logger.info('Extracting raw notes.')
+    return list(stream_notes(ignore_empty_title, runner))
+
+
+def list_notes(
+        ignore_empty_title: bool = True,
+        runner: ScriptRunner = read_osascript_stream
+) -> Dict[str, Dict[str, str]]:
+    """Run the cheap osascript that lists the notes without their body.
+
+    Args:
+        ignore_empty_title (bool, optional): Ignore the notes that don't have a title. Defaults to True.
+        runner (ScriptRunner, optional): runs the osascript. Defaults to read_osascript_stream.
+
+    Returns:
+        Dict[str, Dict[str, str]]: the notes app id, modification date and folder of each note, keyed by note id.
+    """
+
+    _logger.info('Listing the notes.')
+
+    listing = {}
+    for block in runner('./applescripts/list_notes.scpt', ()):
+        if block.strip() == "":
+            continue
+        fields = block.split("|||SEP|||")
+
+        if len(fields) < 4:
+            _logger.warning(f'Malformed note listing ignored: {block[:80]!r}')
+            continue
+
+        if ignore_empty_title and not fields[3].strip():
+            continue
+
+        entry = {
+            "id": fields[0].strip(),
+            "modified": fields[1].strip(),
+            "folder": fields[2].strip()
+        }
+        listing[get_note_id(entry)] = entry
+
+    return listing
 
-    # We run the fetching script
-    result = subprocess.run(['osascript', './applescripts/fetch_notes.scpt'], capture_output=True, text=True)
-    return parse_raw_notes_data(result.stdout.strip(), ignore_empty_title)
 
+def fetch_notes_by_id(
+        app_ids: List[str],
+        ignore_empty_title: bool = True,
+        runner: ScriptRunner = read_osascript_stream,
+        chunk_size: int = 200
+) -> Iterator[Dict[str, str]]:
+    """Fetch the full data of the given notes only.
 
-def get_notes(initial_date: str = '2023-01-01-00-00-00', ignore_empty_title: bool = True) -> List[Dict[str, str]]:
+    Args:
+        app_ids (List[str]): Notes.app ids of the notes to fetch.
+        ignore_empty_title (bool, optional): Ignore the notes that don't have a title. Defaults to True.
+        runner (ScriptRunner, optional): runs the osascript. Defaults to read_osascript_stream.
+        chunk_size (int, optional): Number of ids given to one osascript call. Defaults to 200.
+
+    Yields:
+        Iterator[Dict[str, str]]: the notes, each dict represents a note and its data.
+    """
+
+    _logger.info(f'Extracting {len(app_ids)} raw notes.')
+
+    requested = set(app_ids)
+    for chunk in batched(app_ids, chunk_size):
+        for note in iter_parsed_notes(runner('./applescripts/fetch_notes_by_id.scpt', chunk), ignore_empty_title):
+            if note.get('id') in requested:
+                yield note
+
+
+def get_notes(
+        initial_date: str = '2023-01-01-00-00-00',
+        ignore_empty_title: bool = True,
+        db_path: Optional[str] = None
+) -> List[Dict[str, str]]:
     """Get all the notes starting at a given initial date.
 
     Args:
         initial_date (str, optional): the date the fetching start from. Defaults to '2023-01-01-00-00-00'.
         ignore_empty_title (bool, optional): Ignore the notes that don't have a title. Defaults to True.
+        db_path (Optional[str], optional): read the synced notes from this database, filtered by chroma on
+            their creation timestamp, instead of exporting every note from the app. Defaults to None.
 
     Returns:
         List[Dict[str, str]]: a list of dict, each dict represents a note and its data.
     """
 
-    # Get all the notes and filter it
-    notes = get_all_notes(ignore_empty_title)
+    if db_path is None:
+        # Get all the notes and filter it
+        notes = get_all_notes(ignore_empty_title)
+        notes = [
+            note for note in notes
+            if note.get('created', '') > initial_date
+        ]
+        return notes
+
+    chroma_client = chromadb.PersistentClient(path=db_path)
+    index = open_collection(chroma_client, 'notes', get_cached_embedding_function(db_path), create=False)
+    # The notes created strictly after the initial date, the dates are whole seconds
+    stored = index.get(
+        where=build_where(parse_filters(after=parse_date(initial_date) + 1), 'notes'),
+        include=['documents', 'metadatas']
+    )
+
+    # The chunks of each note are joined back in their order
+    documents = regroup_chunks(
+        ids=stored['ids'],
+        documents=stored['documents'], # type: ignore
+        metadatas=stored['metadatas'], # type: ignore
+        distances=[0.0] * len(stored['ids']),
+        n_results=len(stored['ids'])
+    )
+
     notes = [
-        note for note in notes
-        if note.get('created', '') > initial_date
+        {
+            'title': document['metadata'].get('title', ''),
+            'content': document['content'],
+            'created': document['metadata'].get('created', ''),
+            'modified': document['metadata'].get('modified', ''),
+            'folder': document['metadata'].get('folder', ''),
+            'id': document['id'],
+        }
+        for document in documents
     ]
-    return notes
+    return [note for note in notes if note['title'] or not ignore_empty_title]
 
-def parse_raw_notes_data(data: str, ignore_empty_title: bool = True) -> List[Dict[str, str]]:
-    """Use the raw text output from the applescript and parse it into a dict.
+def parse_note_block(block: str, ignore_empty_title: bool = True) -> Optional[Dict[str, str]]:
+    """Parse one |||END||| delimited block of the applescript output.
 
     Args:
-        data (str): the raw data coming from the output of the apple script.
+        block (str): the raw block, without the delimiter.
         ignore_empty_title (bool, optional): Ignore the notes that don't have a title. Defaults to True.
 
     Returns:
-        List[Dict[str, str]]: a list of dict, each dict represents a note and its data
+        Optional[Dict[str, str]]: the note, None if the block is empty or ignored.
     """
 
-    notes = []
-    ids = []
+    if block.strip() == "":
+        return None
+    fields = block.split("|||SEP|||")
 
-    # We iterate over the blocks and extract data from it
-    for block in data.split("|||END|||"):
-        if block.strip() == "":
-            continue
-        fields = block.split("|||SEP|||")
-    
-        if ignore_empty_title and not fields[0].strip():
+    if len(fields) < 5:
+        _logger.warning(f'Malformed note block ignored: {block[:80]!r}')
+        return None
+
+    if ignore_empty_title and not fields[0].strip():
+        return None
+
+    # We create a dict for the note, the html content is converted to text.
+    # date format : '%Y-%m-%d-%H-%M-%S'
+    return {
+        "title": fields[0].strip(),
+        "content": fields[0].strip() + '\n' + normalize_note(fields[1]),
+        "created": fields[2].strip(),
+        "modified": fields[3].strip(),
+        "folder": fields[4].strip(),
+        "id": fields[5].strip() if len(fields) > 5 else ""
+    }
+
+
+def iter_parsed_notes(blocks: Iterable[str], ignore_empty_title: bool = True) -> Iterator[Dict[str, str]]:
+    """Parse the raw blocks one at a time and drop the duplicated notes.
+
+    Args:
+        blocks (Iterable[str]): the raw blocks, without the delimiter.
+        ignore_empty_title (bool, optional): Ignore the notes that don't have a title. Defaults to True.
+
+    Yields:
+        Iterator[Dict[str, str]]: the notes, each dict represents a note and its data.
+    """
+
+    ids = set()
+
+    for block in blocks:
+        note = parse_note_block(block, ignore_empty_title)
+        if note is None:
             continue
-        
+
         # We create a unique id
-        note_id = str(hash((fields[0].strip(), fields[2].strip())))
+        note_id = get_note_id(note)
         if note_id in ids:
             continue
-        
-        # We create a dict for the note, we remove the html-like tag in the content.
-        # date format : '%Y-%m-%d-%H-%M-%S'
-        note = {
-            "title": fields[0].strip(),
-            "content": fields[0].strip() + '\n' + re.sub('<.*?>', '', fields[1].strip()),
-            "created": fields[2].strip(),
-            "modified": fields[3].strip(),
-            "folder": fields[4].strip()
-        }
-        notes.append(note)
-        ids.append(note_id)
 
-    return notes
+        ids.add(note_id)
+        yield note
+
+
+def parse_raw_notes_data(data: str, ignore_empty_title: bool = True) -> List[Dict[str, str]]:
+    """Use the raw text output from the applescript and parse it into a dict.
+
+    Args:
+        data (str): the raw data coming from the output of the apple script.
+        ignore_empty_title (bool, optional): Ignore the notes that don't have a title. Defaults to True.
+
+    Returns:
+        List[Dict[str, str]]: a list of dict, each dict represents a note and its data
+    """
+
+    return list(iter_parsed_notes(data.split("|||END|||"), ignore_empty_title))
 
 def sync_notes_data(
         flush: bool,
         db_path: str,
         notes_data: Optional[List[Dict[str, str]]] | None = None,
+        prune: bool = True,
+        batch_size: int = 256,
+        runner: ScriptRunner = read_osascript_stream,
+        backend: Optional[str] = None,
         **kwargs: Dict,
 ):
     """Fetch the notes data and create a database out of it.
+    Only the new or modified notes are embedded, the manifest stored next to the
+    database keeps track of what is already indexed. When the manifest is complete,
+    the notes are listed without their body first and only the modified notes are
+    exported. Otherwise the notes are streamed from the app and written by batches
+    while the export is still running.
 
     Args:
-        index_name (str): the index/collection name in the chroma database.
         flush (bool): If we want to delete the current index and completely rebuild the database.
         db_path (str): The path in wich the db will be stored.
         notes_data (Optional[List[Dict[str, str]]] | None) : If you want to update the db with some data.
+        prune (bool, optional): Delete the indexed notes missing from the data. Set it to False
+            when notes_data is a partial update. Defaults to True.
+        batch_size (int, optional): Number of notes embedded and upserted at once. Defaults to 256.
+        runner (ScriptRunner, optional): runs the osascripts. Defaults to read_osascript_stream.
+        backend (Optional[str], optional): 'applescript' or 'sqlite' to read NoteStore.sqlite directly.
+            Defaults to the NOTES_BACKEND env variable, or 'applescript'.
     """
 
-    # Fetch all the notes
-    if not notes_data:
-        notes = get_all_notes()
+    # Init the chroma client
+    _logger.info('ChromaDB vector database creation or update...')
+
+    chroma_client = chromadb.PersistentClient(path=db_path)
+    manifest = NotesManifest(os.path.join(db_path, 'notes_manifest.json'))
+    embedding_function = get_cached_embedding_function(db_path)
+    lexical = get_lexical_index(db_path, 'notes')
+
+    if flush:
+        try:
+            chroma_client.delete_collection('notes')
+        except chromadb.errors.NotFoundError:
+            _logger.info(f'The index --{'notes'}-- do not exist, we continue forward')
+        manifest.clear()
+        lexical.clear()
+
+    index = open_collection(chroma_client, 'notes', embedding_function)
+
+    # The notes synced before the typed metadata are filtered like the new ones
+    upgrade_metadata(index, 'notes')
+
+    # Without a manifest we do not know what the collection holds, so every
+    # stored id is re-checked against the current notes.
+    if not flush and not manifest.exists:
+        manifest.seed(get_document_ids(index))
+
+    # Pick the notes backend
+    if (backend or os.environ.get('NOTES_BACKEND', 'applescript')) == 'sqlite':
+        store = NoteStoreReader(os.environ.get('NOTESTORE_PATH', DEFAULT_NOTESTORE_PATH))
+        list_fn, fetch_fn, stream_fn = store.list_notes, store.fetch_notes_by_id, store.stream_notes
     else:
+        list_fn = partial(list_notes, runner=runner)
+        fetch_fn = partial(fetch_notes_by_id, runner=runner)
+        stream_fn = partial(stream_notes, runner=runner)
+
+    # Fetch the notes
+    listing = None
+    complete = True
+    if notes_data:
         notes = notes_data
+    elif not flush and manifest.supports_listing():
+        # Without the listing the deleted notes are unknown, nothing is pruned
+        try:
+            listing = list_fn()
+            notes = fetch_fn(manifest.changed_in_listing(listing))
+        except Exception as e:
+            _logger.error(e)
+            _logger.warning('The notes could not be listed, the sync is skipped.')
+            listing, notes, complete = None, [], False
+    else:
+        notes = stream_fn()
 
-    # Parse them for chromadb
-    _logger.info('Creating the docs, metadatas and ids...')
+    seen_ids = set()
+    n_upserted = 0
+    n_chunks = 0
 
-    documents = [
-        note.get('content', '')
-        for note in notes
-    ]
-
-    metadatas = [
-        {
-            'title': note.get('title'),
-            'created': note.get('created'),
-            'folder': note.get('folder'),
+    batches = batched(notes, batch_size)
+    while True:
+        # The export raises when the script fails, the notes it did not emit must not be deleted
+        try:
+            batch = next(batches, None)
+        except Exception as e:
+            _logger.error(e)
+            _logger.warning('The notes export failed, the deleted notes are not pruned.')
+            complete = False
+            break
+        if batch is None:
+            break
+
+        notes_by_id = {
+            get_note_id(note): note
+            for note in batch
         }
-        for note in notes
-    ]
+        seen_ids.update(notes_by_id)
 
-    ids = [
-        str(hash((note.get('title'), note.get('created'))))
-        for note in notes
-    ]
+        ids = manifest.changed(notes_by_id)
 
+        # Parse them for chromadb
+        documents = [
+            notes_by_id[note_id].get('content', '')
+            for note_id in ids
+        ]
 
-    # Init the chroma client
-    _logger.info('ChromaDB vector database creation or update...')
+        metadatas = [
+            note_metadata(notes_by_id[note_id])
+            for note_id in ids
+        ]
 
-    chroma_client = chromadb.PersistentClient(path=db_path)
-    
-    if flush:
+        # Update the index, the long notes are split in chunks
         try:
-            chroma_client.delete_collection('notes')
-        except chromadb.errors.NotFoundError:
-            _logger.info(f'The index --{'notes'}-- do not exist, we continue forward')
+            n_chunks += upsert_chunks(index, ids, documents, metadatas, lexical=lexical)
+        except Exception as e:
+            _logger.error(e)
+            _logger.warning('Due to the error the remaining notes have not been added to the vector database.')
+            complete = False
+            break
+
+        # Unchanged notes are recorded too, so their new modification date is not listed again
+        manifest.update(notes_by_id)
+        n_upserted += len(ids)
+
+    # The deleted notes are only known once the whole export has been read
+    if listing is not None:
+        seen_ids = set(listing)
+
+    # An empty listing or export of a non-empty manifest is much more likely a failure of Notes.app than an empty account
+    can_prune = prune and complete
+    if can_prune and not seen_ids and manifest.entries:
+        _logger.warning('No note was exported, the indexed notes are kept.')
+        can_prune = False
+
+    deleted_ids = manifest.missing(seen_ids) if can_prune else []
+    if deleted_ids:
+        try:
+            delete_documents(index, deleted_ids, lexical=lexical)
+            manifest.remove(deleted_ids)
+        except Exception as e:
+            _logger.error(e)
+            _logger.warning('Due to the error the deleted notes are still in the vector database.')
 
-    chroma_client.get_or_create_collection(
-        name='notes',
-        embedding_function=SentenceTransformerEmbeddingFunction(
-            model_name=os.environ.get('HF_EMBEDDING_MODEL', 'all-MiniLM-L6-v2')
-        ) # type: ignore
-    )
+    manifest.save()
 
-    # Update the index
-    index = chroma_client.get_collection(
-        name='notes'
-    )
+    # A failed batch may have been partly written, the answers cached on the notes are checked again
+    if n_upserted or deleted_ids or not complete:
+        bump_collection_version(index)
+
+    # The lexical index of a database synced before it existed is built from the collection
+    lexical.ensure_synced(index)
+
+    _logger.info(f'{n_upserted} new or modified notes ({n_chunks} chunks), {len(deleted_ids)} deleted notes.')
+    # The dimension is known once a vector has been computed or read from the cache
+    record_collection_model(index, embedding_function.cache_key, embedding_function.known_dimension())
 
-    try:
-        index.add(
-            documents=documents,
-            metadatas=metadatas, # type: ignore
-            ids=ids
-        )
-    except Exception as e:
-        _logger.error(e)
-        _logger.warning('Due to the error no element has been added to the vector database.')
-
-    _logger.info('Chromadb notes vector database up to date.')
\ No newline at end of file
+    _logger.info(f'Embedding cache: {embedding_function.cache.stats()}')
+    _logger.info('Chromadb notes vector database up to date.')
@@ -0,0 +1,179 @@
+import hashlib
+import json
+import logging
+import os
+
+from typing import Dict, List, Set
+
+
+_logger = logging.getLogger(name='NOTE_MANIFEST')
+
+
+def get_note_id(note: Dict[str, str]) -> str:
+    """Build the id of a note. It is stable across runs, unlike the builtin hash.
+    The Notes.app id is used when we have it, so a renamed note keeps its id.
+
+    Args:
+        note (Dict[str, str]): the note, or a note listing entry.
+
+    Returns:
+        str: the note id.
+    """
+
+    if note.get('id'):
+        key = note['id']
+    else:
+        key = f"{note.get('title', '')}\x1f{note.get('created', '')}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def note_fingerprint(note: Dict[str, str]) -> str:
+    """Compute the hash of everything we store in the vector database for a note.
+
+    Args:
+        note (Dict[str, str]): a parsed note.
+
+    Returns:
+        str: the sha256 hex digest of the note content and metadata.
+    """
+
+    payload = '\x1f'.join(
+        note.get(field, '') or ''
+        for field in ('title', 'content', 'created', 'folder')
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class NotesManifest():
+
+    def __init__(self, path: str):
+        """Load the manifest of the indexed notes from the disk.
+
+        Args:
+            path (str): Location of the json manifest file.
+        """
+
+        self.path = path
+        self.entries: Dict[str, Dict[str, str]] = {}
+        self.exists = os.path.exists(path)
+
+        if self.exists:
+            try:
+                with open(path, 'r') as manifest_file:
+                    self.entries = json.load(manifest_file)
+            except (OSError, json.JSONDecodeError) as e:
+                _logger.error(e)
+                _logger.warning('The notes manifest is unreadable, every note will be re-indexed.')
+                self.exists = False
+
+    def seed(self, ids: List[str]):
+        """Register ids already present in the collection but unknown to the manifest.
+        Their hash is empty, so they are re-indexed or deleted on the next diff.
+
+        Args:
+            ids (List[str]): ids currently stored in the collection.
+        """
+
+        for note_id in ids:
+            self.entries.setdefault(note_id, {'hash': '', 'modified': ''})
+
+    def clear(self):
+        """Forget every entry, used when the collection is rebuilt from scratch.
+        """
+
+        self.entries = {}
+
+    def changed(self, notes: Dict[str, Dict[str, str]]) -> List[str]:
+        """Compare a batch of notes with the manifest.
+
+        Args:
+            notes (Dict[str, Dict[str, str]]): the current notes, keyed by note id.
+
+        Returns:
+            List[str]: the ids of the new or modified notes.
+        """
+
+        return [
+            note_id for note_id, note in notes.items()
+            if self.entries.get(note_id, {}).get('hash') != note_fingerprint(note)
+        ]
+
+    def supports_listing(self) -> bool:
+        """Check if the manifest can be diffed against a note listing, it needs the
+        Notes.app id of every indexed note.
+
+        Returns:
+            bool: True if a two-phase sync is possible.
+        """
+
+        return self.exists and all(entry.get('app_id') for entry in self.entries.values())
+
+    def changed_in_listing(self, listing: Dict[str, Dict[str, str]]) -> List[str]:
+        """Compare a note listing with the manifest.
+
+        Args:
+            listing (Dict[str, Dict[str, str]]): the id, modification date and folder of the notes, keyed by note id.
+
+        Returns:
+            List[str]: the Notes.app ids of the new or modified notes.
+        """
+
+        changed = []
+        for note_id, entry in listing.items():
+            known = self.entries.get(note_id)
+            if (
+                known is None
+                or known.get('modified') != entry['modified']
+                or known.get('folder') != entry['folder']
+            ):
+                changed.append(entry['id'])
+        return changed
+
+    def missing(self, seen_ids: Set[str]) -> List[str]:
+        """Get the indexed notes that are no longer in the app.
+
+        Args:
+            seen_ids (Set[str]): ids of every note currently in the app.
+
+        Returns:
+            List[str]: the ids to delete.
+        """
+
+        return [note_id for note_id in self.entries if note_id not in seen_ids]
+
+    def update(self, notes: Dict[str, Dict[str, str]]):
+        """Record the notes that have been written to the collection.
+
+        Args:
+            notes (Dict[str, Dict[str, str]]): the upserted notes, keyed by note id.
+        """
+
+        for note_id, note in notes.items():
+            self.entries[note_id] = {
+                'hash': note_fingerprint(note),
+                'modified': note.get('modified', ''),
+                'folder': note.get('folder', ''),
+                'app_id': note.get('id', ''),
+            }
+
+    def remove(self, ids: List[str]):
+        """Forget the notes deleted from the collection.
+
+        Args:
+            ids (List[str]): the ids removed from the collection.
+        """
+
+        for note_id in ids:
+            self.entries.pop(note_id, None)
+
+    def save(self):
+        """Write the manifest on the disk. The file is replaced atomically so a crash
+        never leaves a half written manifest behind.
+        """
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as manifest_file:
+            json.dump(self.entries, manifest_file)
+        os.replace(tmp_path, self.path)
+        self.exists = True
@@ -0,0 +1,261 @@
+import gzip
+import logging
+import os
+import sqlite3
+import zlib
+
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from src.ingestion.notes.manifest import get_note_id
+
+
+_logger = logging.getLogger('NOTESTORE')
+
+DEFAULT_NOTESTORE_PATH = os.path.expanduser(
+    '~/Library/Group Containers/group.com.apple.notes/NoteStore.sqlite'
+)
+
+# Core Data stores the dates as seconds since 2001-01-01 UTC
+COREDATA_EPOCH = 978307200
+
+
+def coredata_to_str(timestamp: Optional[float]) -> str:
+    """Format a Core Data timestamp like the applescript does.
+
+    Args:
+        timestamp (Optional[float]): seconds since 2001-01-01.
+
+    Returns:
+        str: the local date, format '%Y-%m-%d-%H-%M-%S', empty if there is no date.
+    """
+
+    if timestamp is None:
+        return ''
+    return datetime.fromtimestamp(timestamp + COREDATA_EPOCH).strftime('%Y-%m-%d-%H-%M-%S')
+
+
+def _read_varint(buffer: bytes, pos: int) -> Tuple[int, int]:
+    """Read a protobuf varint.
+
+    Args:
+        buffer (bytes): the protobuf message.
+        pos (int): position of the varint.
+
+    Returns:
+        Tuple[int, int]: the value and the position after the varint.
+    """
+
+    result = 0
+    shift = 0
+    while True:
+        byte = buffer[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _first_field(buffer: bytes, field_number: int) -> Optional[bytes]:
+    """Get the first length-delimited field of a protobuf message.
+
+    Args:
+        buffer (bytes): the protobuf message.
+        field_number (int): the field we are looking for.
+
+    Returns:
+        Optional[bytes]: the field payload, None if it is missing.
+    """
+
+    pos = 0
+    while pos < len(buffer):
+        key, pos = _read_varint(buffer, pos)
+        number, wire_type = key >> 3, key & 0x7
+
+        if wire_type == 0:
+            _, pos = _read_varint(buffer, pos)
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 2:
+            length, pos = _read_varint(buffer, pos)
+            if number == field_number:
+                return buffer[pos:pos + length]
+            pos += length
+        elif wire_type == 5:
+            pos += 4
+        else:
+            return None
+
+    return None
+
+
+def extract_note_text(data: Optional[bytes]) -> str:
+    """Extract the plain text of a note from the ZDATA column.
+    The column holds a gzipped protobuf: NoteStoreProto.document(2).note(3).note_text(2).
+
+    Args:
+        data (Optional[bytes]): the ZDATA blob.
+
+    Returns:
+        str: the note text, empty if it cannot be decoded.
+    """
+
+    if not data:
+        return ''
+
+    try:
+        if data[:2] == b'\x1f\x8b':
+            data = gzip.decompress(data)
+        document = _first_field(data, 2)
+        note = _first_field(document, 3) if document is not None else None
+        text = _first_field(note, 2) if note is not None else None
+    except (OSError, EOFError, IndexError, zlib.error) as e:
+        _logger.warning(f'Unable to decode a note body: {e}')
+        return ''
+
+    return text.decode('utf-8', errors='replace') if text is not None else ''
+
+
+class NoteStoreReader():
+
+    def __init__(self, path: str = DEFAULT_NOTESTORE_PATH):
+        """Read the notes straight from the Notes.app sqlite store, opened read-only.
+
+        Args:
+            path (str, optional): Location of NoteStore.sqlite. Defaults to DEFAULT_NOTESTORE_PATH.
+        """
+
+        self.path = path
+        self.connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+
+        # The creation date column depends on the macOS version
+        columns = {
+            row[1] for row in self.connection.execute('PRAGMA table_info(ZICCLOUDSYNCINGOBJECT)')
+        }
+        created_columns = [f'n.{c}' for c in ('ZCREATIONDATE3', 'ZCREATIONDATE1', 'ZCREATIONDATE') if c in columns]
+        if len(created_columns) > 1:
+            self.created_column = f'COALESCE({", ".join(created_columns)})'
+        else:
+            self.created_column = created_columns[0] if created_columns else 'NULL'
+
+        # The ids are rebuilt the way the applescript returns them
+        self.store_uuid = self.connection.execute('SELECT Z_UUID FROM Z_METADATA').fetchone()[0]
+
+    def _app_id(self, primary_key: int) -> str:
+        return f'x-coredata://{self.store_uuid}/ICNote/p{primary_key}'
+
+    def _query(self, select: str, where: str = '', params: Tuple = ()) -> sqlite3.Cursor:
+        return self.connection.execute(
+            f'''
+            SELECT {select}
+            FROM ZICCLOUDSYNCINGOBJECT AS n
+            LEFT JOIN ZICCLOUDSYNCINGOBJECT AS f ON f.Z_PK = n.ZFOLDER
+            LEFT JOIN ZICNOTEDATA AS d ON d.Z_PK = n.ZNOTEDATA
+            WHERE n.ZNOTEDATA IS NOT NULL
+            AND COALESCE(n.ZMARKEDFORDELETION, 0) = 0
+            {where}
+            ''',
+            params
+        )
+
+    def _iter_notes(self, where: str = '', params: Tuple = (), ignore_empty_title: bool = True) -> Iterator[Dict[str, str]]:
+        rows = self._query(
+            f'n.Z_PK, n.ZTITLE1, d.ZDATA, {self.created_column}, n.ZMODIFICATIONDATE1, f.ZTITLE2',
+            where,
+            params
+        )
+
+        for primary_key, title, data, created, modified, folder in rows:
+            title = (title or '').strip()
+            if ignore_empty_title and not title:
+                continue
+
+            yield {
+                "title": title,
+                "content": title + '\n' + extract_note_text(data).strip(),
+                "created": coredata_to_str(created),
+                "modified": coredata_to_str(modified),
+                "folder": (folder or '').strip(),
+                "id": self._app_id(primary_key)
+            }
+
+    def stream_notes(self, ignore_empty_title: bool = True) -> Iterator[Dict[str, str]]:
+        """Yield all the notes, with the same shape as the applescript export.
+
+        Args:
+            ignore_empty_title (bool, optional): Ignore the notes that don't have a title. Defaults to True.
+
+        Yields:
+            Iterator[Dict[str, str]]: the notes, each dict represents a note and its data.
+        """
+
+        _logger.info(f'Reading the notes from {self.path}.')
+        yield from self._iter_notes(ignore_empty_title=ignore_empty_title)
+
+    def notes_changed_since(self, timestamp: float, ignore_empty_title: bool = True) -> Iterator[Dict[str, str]]:
+        """Yield the notes modified after a given time.
+
+        Args:
+            timestamp (float): unix timestamp.
+            ignore_empty_title (bool, optional): Ignore the notes that don't have a title. Defaults to True.
+
+        Yields:
+            Iterator[Dict[str, str]]: the notes, each dict represents a note and its data.
+        """
+
+        yield from self._iter_notes(
+            'AND n.ZMODIFICATIONDATE1 > ?',
+            (timestamp - COREDATA_EPOCH,),
+            ignore_empty_title
+        )
+
+    def list_notes(self, ignore_empty_title: bool = True) -> Dict[str, Dict[str, str]]:
+        """List the notes without decompressing their body.
+
+        Args:
+            ignore_empty_title (bool, optional): Ignore the notes that don't have a title. Defaults to True.
+
+        Returns:
+            Dict[str, Dict[str, str]]: the Notes.app id, modification date and folder of each note, keyed by note id.
+        """
+
+        listing = {}
+        for primary_key, title, modified, folder in self._query('n.Z_PK, n.ZTITLE1, n.ZMODIFICATIONDATE1, f.ZTITLE2'):
+            if ignore_empty_title and not (title or '').strip():
+                continue
+
+            entry = {
+                "id": self._app_id(primary_key),
+                "modified": coredata_to_str(modified),
+                "folder": (folder or '').strip()
+            }
+            listing[get_note_id(entry)] = entry
+
+        return listing
+
+    def fetch_notes_by_id(self, app_ids: List[str], ignore_empty_title: bool = True) -> Iterator[Dict[str, str]]:
+        """Yield the full data of the given notes only.
+
+        Args:
+            app_ids (List[str]): Notes.app ids of the notes to fetch.
+            ignore_empty_title (bool, optional): Ignore the notes that don't have a title. Defaults to True.
+
+        Yields:
+            Iterator[Dict[str, str]]: the notes, each dict represents a note and its data.
+        """
+
+        prefix = self._app_id(0)[:-1]
+        primary_keys = [
+            int(app_id[len(prefix):]) for app_id in app_ids
+            if app_id.startswith(prefix)
+        ]
+
+        # sqlite limits the number of bound parameters, we query by chunks
+        for start in range(0, len(primary_keys), 500):
+            chunk = primary_keys[start:start + 500]
+            yield from self._iter_notes(
+                f'AND n.Z_PK IN ({",".join("?" * len(chunk))})',
+                tuple(chunk),
+                ignore_empty_title
+            )
@@ -0,0 +1,195 @@
+import re
+
+from html import unescape
+from typing import List
+
+
+# Tokens of the single pass over the html: comments, script and style blocks, tags and text
+_HTML_TOKEN_RE = re.compile(
+    r'<!--.*?-->'
+    r'|<(script|style|head|title)\b[^>]*>.*?</\1\s*>'
+    r'|<(/?)([a-zA-Z][a-zA-Z0-9]*)([^>]*)>'
+    r'|[^<]+'
+    r'|<',
+    re.DOTALL | re.IGNORECASE
+)
+
+# Tags rendered on their own line, and tags separated from the rest by an empty line
+_BLOCK_TAGS = frozenset({
+    'address', 'article', 'aside', 'dd', 'div', 'dl', 'dt', 'fieldset', 'figcaption',
+    'figure', 'footer', 'form', 'header', 'hr', 'li', 'main', 'nav', 'pre', 'section', 'tr',
+})
+_PARAGRAPH_TAGS = frozenset({
+    'blockquote', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'ol', 'p', 'table', 'ul',
+})
+
+# Containers of the quoted message in the html replies of the common mail clients
+_QUOTE_ATTRIBUTES_RE = re.compile(
+    r'type\s*=\s*["\']?cite|gmail_quote|moz-cite-prefix|yahoo_quoted|divRplyFwdMsg|OutlookMessageHeader',
+    re.IGNORECASE
+)
+
+_SPACES_RE = re.compile(r'[ \t\r\f\v\xa0]+')
+_ALL_SPACES_RE = re.compile(r'\s+')
+
+# First line of a quoted reply or of a forwarded message in plain text
+_REPLY_HEADER_RE = re.compile(
+    r'^(On .{1,200} wrote:'
+    r'|Le .{1,200} a écrit\s?:'
+    r'|-{2,} ?(Original Message|Forwarded message|Message d\'origine|Message transféré) ?-{2,}'
+    r'|Begin forwarded message:'
+    r'|_{10,})$',
+    re.IGNORECASE
+)
+
+# First line of a signature, '-- ' is the usenet delimiter (RFC 3676)
+_SIGNATURE_RE = re.compile(
+    r'^(-- ?|Sent from my \w+.*|Envoyé de mon \w+.*|Get Outlook for \w+.*)$',
+    re.IGNORECASE
+)
+
+
+def html_to_text(html: str, strip_quotes: bool = False) -> str:
+    """Convert html to text in a single pass, without building a tree.
+    The entities are decoded, the paragraphs and the list items are kept on their own line.
+
+    Args:
+        html (str): the html.
+        strip_quotes (bool, optional): drop the quoted messages of a mail reply (blockquote cite, gmail_quote, ...). Defaults to False.
+
+    Returns:
+        str: the text.
+    """
+
+    parts: List[str] = []
+    quote_depth = 0
+    quote_stack: List[bool] = []
+
+    # Number of line breaks at the end of the text, so nested blocks do not stack them
+    breaks = 2
+
+    def line_break(count: int):
+        nonlocal breaks
+        if breaks < count:
+            parts.append('\n' * (count - breaks))
+            breaks = count
+
+    for match in _HTML_TOKEN_RE.finditer(html):
+        token = match.group(0)
+
+        if match.group(3) is None:
+            # Text, or a comment, script or style block that is dropped
+            if not quote_depth and (token[0] != '<' or token == '<'):
+                text = _ALL_SPACES_RE.sub(' ', unescape(token))
+                parts.append(text)
+                if text.strip():
+                    breaks = 0
+            continue
+
+        tag = match.group(3).lower()
+        closing = match.group(2) == '/'
+
+        # We track the quote containers, their content is skipped
+        if strip_quotes and tag in ('blockquote', 'div'):
+            if closing:
+                if quote_stack and quote_stack.pop():
+                    quote_depth -= 1
+            elif not match.group(4).rstrip().endswith('/'):
+                is_quote = bool(_QUOTE_ATTRIBUTES_RE.search(match.group(4)))
+                quote_stack.append(is_quote)
+                quote_depth += is_quote
+
+        if quote_depth:
+            continue
+
+        if tag == 'br':
+            parts.append('\n')
+            breaks += 1
+        elif tag == 'li' and not closing:
+            line_break(1)
+            parts.append('- ')
+        elif tag in _PARAGRAPH_TAGS:
+            line_break(2)
+        elif tag in _BLOCK_TAGS:
+            line_break(1)
+        elif tag in ('td', 'th') and not closing:
+            parts.append(' ')
+
+    return clean_text(''.join(parts))
+
+
+def clean_text(text: str) -> str:
+    """Normalize the spaces of a text: the lines are stripped and there is at most
+    one empty line between two paragraphs.
+
+    Args:
+        text (str): the text.
+
+    Returns:
+        str: the cleaned text.
+    """
+
+    lines = []
+    empty = True
+    for line in text.splitlines():
+        line = _SPACES_RE.sub(' ', line).strip()
+        if line or not empty:
+            lines.append(line)
+        empty = not line
+
+    return '\n'.join(lines).strip()
+
+
+def strip_reply(text: str) -> str:
+    """Remove the quoted message and the signature of a plain text mail.
+
+    Args:
+        text (str): the mail body.
+
+    Returns:
+        str: the new content of the mail only.
+    """
+
+    lines = []
+    for line in text.splitlines():
+        stripped = line.strip()
+
+        # Everything below the reply header or the signature is not part of the new content
+        if _REPLY_HEADER_RE.match(stripped) or _SIGNATURE_RE.match(line.rstrip('\r\n')):
+            break
+        if stripped.startswith('>'):
+            continue
+        lines.append(line)
+
+    # A reply made of quotes only keeps its body
+    return '\n'.join(lines) if any(line.strip() for line in lines) else text
+
+
+def normalize_note(body: str) -> str:
+    """Convert the html body of a note into text.
+
+    Args:
+        body (str): the note body, as exported by Notes.app.
+
+    Returns:
+        str: the text of the note.
+    """
+
+    return html_to_text(body)
+
+
+def normalize_mail(body: str, is_html: bool = False) -> str:
+    """Convert the body of a mail into text, without the quoted reply and the signature.
+
+    Args:
+        body (str): the text or html part of the mail.
+        is_html (bool, optional): if the body is html. Defaults to False.
+
+    Returns:
+        str: the text of the mail.
+    """
+
+    if is_html:
+        body = html_to_text(body, strip_quotes=True)
+    return clean_text(strip_reply(body))
+
@@ -0,0 +1,265 @@
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+
+from collections import Counter
+from typing import Dict, List, Sequence, Tuple
+
+
+_logger = logging.getLogger(name='LEXICAL_INDEX')
+
+# A word, or words joined by the punctuation of addresses, numbers and codes (john.doe@acme.com, INV-2024-117)
+_TOKEN_RE = re.compile(r"\w+(?:[.@+\-/:']\w+)*")
+_PART_RE = re.compile(r'\w+')
+
+# The terms found in more than this share of the chunks barely change the ranking, they are skipped
+MAX_TERM_FREQUENCY = 0.5
+
+
+def tokenize(text: str) -> List[str]:
+    """Split a text in lowercase terms. An address or a code is kept whole, and its parts
+    are added, so 'acme' finds 'john.doe@acme.com'.
+
+    Args:
+        text (str): the text.
+
+    Returns:
+        List[str]: the terms, with repetitions.
+    """
+
+    terms = []
+    for match in _TOKEN_RE.finditer(unicodedata.normalize('NFKC', text).casefold()):
+        term = match.group()
+        terms.append(term)
+        parts = _PART_RE.findall(term)
+        if len(parts) > 1:
+            terms.extend(parts)
+    return terms
+
+
+class LexicalIndex():
+
+    def __init__(self, path: str, k1: float = 1.2, b: float = 0.75):
+        """Open (or create) the sqlite inverted index of the chunks of a collection, searched with BM25.
+
+        Args:
+            path (str): Location of the sqlite file.
+            k1 (float, optional): BM25 term frequency saturation. Defaults to 1.2.
+            b (float, optional): BM25 length normalization. Defaults to 0.75.
+        """
+
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS chunks (
+                chunk_id TEXT PRIMARY KEY,
+                parent_id TEXT NOT NULL,
+                length INTEGER NOT NULL
+            )
+            '''
+        )
+        self._connection.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS postings (
+                term TEXT NOT NULL,
+                chunk_id TEXT NOT NULL,
+                tf INTEGER NOT NULL,
+                PRIMARY KEY (term, chunk_id)
+            ) WITHOUT ROWID
+            '''
+        )
+        self._connection.execute('CREATE INDEX IF NOT EXISTS chunks_parent_id ON chunks (parent_id)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS postings_chunk_id ON postings (chunk_id)')
+        self._connection.commit()
+
+    def add(self, chunk_ids: Sequence[str], parent_ids: Sequence[str], texts: Sequence[str]):
+        """Index chunks, replacing their previous version.
+
+        Args:
+            chunk_ids (Sequence[str]): ids of the chunks.
+            parent_ids (Sequence[str]): ids of their documents.
+            texts (Sequence[str]): the chunks.
+        """
+
+        chunks = []
+        postings = []
+        for chunk_id, parent_id, text in zip(chunk_ids, parent_ids, texts):
+            terms = Counter(tokenize(text or ''))
+            chunks.append((chunk_id, parent_id, sum(terms.values())))
+            postings.extend((term, chunk_id, tf) for term, tf in terms.items())
+
+        with self._lock:
+            self._delete(chunk_ids)
+            self._connection.executemany('INSERT INTO chunks (chunk_id, parent_id, length) VALUES (?, ?, ?)', chunks)
+            self._connection.executemany('INSERT INTO postings (term, chunk_id, tf) VALUES (?, ?, ?)', postings)
+            self._connection.commit()
+
+    def delete(self, chunk_ids: Sequence[str]):
+        """Remove chunks from the index.
+
+        Args:
+            chunk_ids (Sequence[str]): ids of the chunks.
+        """
+
+        with self._lock:
+            self._delete(chunk_ids)
+            self._connection.commit()
+
+    def delete_documents(self, parent_ids: Sequence[str]):
+        """Remove all the chunks of documents from the index.
+
+        Args:
+            parent_ids (Sequence[str]): ids of the documents.
+        """
+
+        with self._lock:
+            chunk_ids = []
+            for start in range(0, len(parent_ids), 500):
+                chunk = list(parent_ids[start:start + 500])
+                chunk_ids.extend(row[0] for row in self._connection.execute(
+                    f'SELECT chunk_id FROM chunks WHERE parent_id IN ({",".join("?" * len(chunk))})',
+                    chunk
+                ))
+            self._delete(chunk_ids)
+            self._connection.commit()
+
+    def _delete(self, chunk_ids: Sequence[str]):
+        # sqlite limits the number of bound parameters, we delete by chunks
+        for start in range(0, len(chunk_ids), 500):
+            chunk = list(chunk_ids[start:start + 500])
+            placeholders = ','.join('?' * len(chunk))
+            self._connection.execute(f'DELETE FROM postings WHERE chunk_id IN ({placeholders})', chunk)
+            self._connection.execute(f'DELETE FROM chunks WHERE chunk_id IN ({placeholders})', chunk)
+
+    def clear(self):
+        """Remove every chunk, when the collection is rebuilt.
+        """
+
+        with self._lock:
+            self._connection.execute('DELETE FROM postings')
+            self._connection.execute('DELETE FROM chunks')
+            self._connection.commit()
+
+    def count(self) -> int:
+        """Get the number of indexed chunks.
+
+        Returns:
+            int: the number of chunks.
+        """
+
+        with self._lock:
+            (count,) = self._connection.execute('SELECT COUNT(*) FROM chunks').fetchone()
+        return count
+
+    def search(self, query: str, limit: int) -> List[Tuple[str, float]]:
+        """Rank the chunks containing the terms of a query with BM25.
+
+        Args:
+            query (str): the query.
+            limit (int): maximum number of chunks.
+
+        Returns:
+            List[Tuple[str, float]]: the chunk ids and their score, the best first.
+        """
+
+        terms = sorted(set(tokenize(query)))
+        if not terms:
+            return []
+
+        with self._lock:
+            n_chunks, average_length = self._connection.execute('SELECT COUNT(*), AVG(length) FROM chunks').fetchone()
+            if not n_chunks:
+                return []
+
+            dfs: Dict[str, int] = {}
+            for term in terms:
+                (df,) = self._connection.execute('SELECT COUNT(*) FROM postings WHERE term = ?', (term,)).fetchone()
+                if df:
+                    dfs[term] = df
+            if not dfs:
+                return []
+
+            # A query made only of common terms keeps its rarest one
+            kept = [term for term, df in dfs.items() if df <= MAX_TERM_FREQUENCY * n_chunks] or [min(dfs, key=dfs.__getitem__)]
+            idfs = {term: math.log(1 + (n_chunks - dfs[term] + 0.5) / (dfs[term] + 0.5)) for term in kept}
+
+            rows = self._connection.execute(
+                f'SELECT p.term, p.chunk_id, p.tf, c.length FROM postings p JOIN chunks c ON c.chunk_id = p.chunk_id '
+                f'WHERE p.term IN ({",".join("?" * len(idfs))})',
+                list(idfs)
+            ).fetchall()
+
+        scores: Dict[str, float] = {}
+        for term, chunk_id, tf, length in rows:
+            norm = self.k1 * (1 - self.b + self.b * length / (average_length or 1))
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + idfs[term] * tf * (self.k1 + 1) / (tf + norm)
+
+        return sorted(scores.items(), key=lambda item: -item[1])[:limit]
+
+    def rebuild(self, index, page_size: int = 1000):
+        """Index again all the chunks of a collection, read from chroma without running the model.
+
+        Args:
+            index (chromadb.Collection): the collection.
+            page_size (int, optional): Number of chunks read at once. Defaults to 1000.
+        """
+
+        self.clear()
+        offset = 0
+        while True:
+            page = index.get(include=['documents', 'metadatas'], limit=page_size, offset=offset)
+            if not page['ids']:
+                break
+
+            self.add(
+                page['ids'],
+                [(metadata or {}).get('parent_id', chunk_id) for chunk_id, metadata in zip(page['ids'], page['metadatas'])],
+                page['documents']
+            )
+            offset += len(page['ids'])
+
+        _logger.info(f'Lexical index of {index.name} rebuilt, {offset} chunks.')
+
+    def ensure_synced(self, index):
+        """Rebuild the index if it does not hold as many chunks as the collection, like after
+        an upgrade or an interrupted sync.
+
+        Args:
+            index (chromadb.Collection): the collection.
+        """
+
+        if self.count() != index.count():
+            self.rebuild(index)
+
+
+_lexical_indexes: Dict[str, LexicalIndex] = {}
+_lexical_indexes_lock = threading.Lock()
+
+
+def get_lexical_index(db_path: str, name: str) -> LexicalIndex:
+    """Get the lexical index of a collection, opened once per process.
+
+    Args:
+        db_path (str): Location of the chroma db, the index is stored next to it.
+        name (str): Name of the collection.
+
+    Returns:
+        LexicalIndex: the index.
+    """
+
+    path = os.path.join(db_path, f'lexical_{name}.sqlite')
+    with _lexical_indexes_lock:
+        if path not in _lexical_indexes:
+            _lexical_indexes[path] = LexicalIndex(path)
+        return _lexical_indexes[path]
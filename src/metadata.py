@@ -0,0 +1,266 @@
+import logging
+
+from datetime import datetime
+from email.utils import parseaddr, parsedate_to_datetime
+from typing import Any, Dict, List, Optional
+
+
+_logger = logging.getLogger(name='METADATA')
+
+# Format of the dates exported from Notes.app
+NOTE_DATE_FORMAT = '%Y-%m-%d-%H-%M-%S'
+
+# The typed metadata of the chunks, bumped when the keys change so the stored chunks are upgraded
+METADATA_VERSION = 1
+METADATA_VERSION_KEY = 'metadata_version'
+
+# The metadata a search is filtered on, per source
+DATE_KEYS = {'notes': 'created_ts', 'mails': 'date_ts'}
+FOLDER_KEYS = {'notes': 'folder', 'mails': 'mailbox'}
+SENDER_KEY = 'sender'
+
+# Only used by the filters, they are not shown in the prompt
+FILTER_KEYS = ('created_ts', 'modified_ts', 'date_ts', SENDER_KEY, 'source')
+
+
+def note_date_to_timestamp(value: Optional[str]) -> Optional[int]:
+    """Convert a Notes.app date to a timestamp.
+
+    Args:
+        value (Optional[str]): the local date, format NOTE_DATE_FORMAT.
+
+    Returns:
+        Optional[int]: seconds since the epoch, None if the date is missing or malformed.
+    """
+
+    if not value:
+        return None
+    try:
+        return int(datetime.strptime(value, NOTE_DATE_FORMAT).timestamp())
+    except ValueError:
+        _logger.debug(f'Malformed note date {value!r}.')
+        return None
+
+
+def mail_date_to_timestamp(value: Optional[str]) -> Optional[int]:
+    """Convert the Date header of a mail to a timestamp.
+
+    Args:
+        value (Optional[str]): the RFC 2822 date.
+
+    Returns:
+        Optional[int]: seconds since the epoch, None if the date is missing or malformed.
+    """
+
+    if not value:
+        return None
+    try:
+        return int(parsedate_to_datetime(str(value)).timestamp())
+    except (TypeError, ValueError):
+        _logger.debug(f'Malformed mail date {value!r}.')
+        return None
+
+
+def normalize_sender(value: Optional[str]) -> Optional[str]:
+    """Get the address of the From header of a mail, without the display name.
+
+    Args:
+        value (Optional[str]): the From header, like 'John Doe <John.Doe@acme.com>'.
+
+    Returns:
+        Optional[str]: the lowercase address, None if there is none.
+    """
+
+    if not value:
+        return None
+    address = parseaddr(str(value))[1]
+    return address.casefold() if address else None
+
+
+def note_metadata(note: Dict[str, str]) -> Dict[str, Any]:
+    """Build the metadata of a note, with the typed fields used by the filters.
+
+    Args:
+        note (Dict[str, str]): the note.
+
+    Returns:
+        Dict[str, Any]: the metadata, without the missing values that chroma refuses.
+    """
+
+    metadata = {
+        'title': note.get('title'),
+        'created': note.get('created'),
+        'modified': note.get('modified'),
+        'folder': note.get('folder'),
+        'created_ts': note_date_to_timestamp(note.get('created')),
+        'modified_ts': note_date_to_timestamp(note.get('modified')),
+        'source': 'notes',
+    }
+    return {key: value for key, value in metadata.items() if value is not None}
+
+
+def mail_metadata(mail: Dict[str, str]) -> Dict[str, Any]:
+    """Build the metadata of a mail, with the typed fields used by the filters.
+
+    Args:
+        mail (Dict[str, str]): the parsed mail, with its mailbox.
+
+    Returns:
+        Dict[str, Any]: the metadata, without the missing values that chroma refuses.
+    """
+
+    metadata = {
+        'from': mail.get('from'),
+        'subject': mail.get('subject'),
+        'date': mail.get('date'),
+        'mailbox': mail.get('mailbox'),
+        'date_ts': mail_date_to_timestamp(mail.get('date')),
+        SENDER_KEY: normalize_sender(mail.get('from')),
+        'source': 'mails',
+    }
+    return {key: value for key, value in metadata.items() if value is not None}
+
+
+def parse_date(value: Any) -> int:
+    """Parse the date of a filter.
+
+    Args:
+        value (Any): a timestamp, an ISO date like '2024-03-01' or '2024-03-01T08:00:00+01:00',
+            or a Notes.app date. The dates without time zone are local.
+
+    Raises:
+        ValueError: if the date is not understood.
+
+    Returns:
+        int: seconds since the epoch.
+    """
+
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return int(value)
+
+    value = str(value).strip()
+    if value.lstrip('-').isdigit():
+        return int(value)
+
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        pass
+    try:
+        return int(datetime.strptime(value, NOTE_DATE_FORMAT).timestamp())
+    except ValueError:
+        raise ValueError(f'Unknown date {value!r}, expected an ISO date like 2024-03-01 or a timestamp.')
+
+
+def parse_filters(
+        after: Any = None,
+        before: Any = None,
+        sender: Optional[str] = None,
+        folder: Any = None
+) -> Optional[Dict[str, Any]]:
+    """Check and normalize the filters of a search.
+
+    Args:
+        after (Any, optional): only the documents of this date or later, see parse_date. Defaults to None.
+        before (Any, optional): only the documents older than this date, see parse_date. Defaults to None.
+        sender (Optional[str], optional): only the mails of this address. Defaults to None.
+        folder (Any, optional): a note folder or a mailbox, or a list of them. Defaults to None.
+
+    Raises:
+        ValueError: if a date is not understood.
+
+    Returns:
+        Optional[Dict[str, Any]]: the filters, None if there is none.
+    """
+
+    filters: Dict[str, Any] = {}
+    if after not in (None, ''):
+        filters['after'] = parse_date(after)
+    if before not in (None, ''):
+        filters['before'] = parse_date(before)
+    if sender:
+        filters['sender'] = normalize_sender(sender) or sender.casefold()
+    if folder:
+        filters['folder'] = [str(name) for name in folder] if isinstance(folder, (list, tuple)) else str(folder)
+
+    return filters or None
+
+
+def build_where(filters: Optional[Dict[str, Any]], source: str) -> Optional[Dict[str, Any]]:
+    """Translate the filters in a chroma where clause for a collection, so the collection
+    is narrowed before the similarity search. A note has no sender, a sender filter leaves
+    no note.
+
+    Args:
+        filters (Optional[Dict[str, Any]]): the filters, see parse_filters.
+        source (str): Name of the collection.
+
+    Returns:
+        Optional[Dict[str, Any]]: the where clause, None if there is no filter.
+    """
+
+    if not filters:
+        return None
+
+    conditions: List[Dict[str, Any]] = []
+    date_key = DATE_KEYS.get(source, 'date_ts')
+    if filters.get('after') is not None:
+        conditions.append({date_key: {'$gte': filters['after']}})
+    if filters.get('before') is not None:
+        conditions.append({date_key: {'$lt': filters['before']}})
+    if filters.get('sender'):
+        conditions.append({SENDER_KEY: filters['sender']})
+    if filters.get('folder'):
+        folder = filters['folder']
+        folder_key = FOLDER_KEYS.get(source, 'folder')
+        conditions.append({folder_key: {'$in': folder}} if isinstance(folder, list) else {folder_key: folder})
+
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {'$and': conditions}
+
+
+def upgrade_metadata(index, source: str, page_size: int = 1000) -> bool:
+    """Add the typed metadata to the chunks stored before it existed. The chunks are
+    rewritten without their embeddings, the model does not run.
+
+    Args:
+        index (chromadb.Collection): the collection.
+        source (str): 'notes' or 'mails'.
+        page_size (int, optional): Number of chunks read at once. Defaults to 1000.
+
+    Returns:
+        bool: True if chunks were upgraded.
+    """
+
+    collection_metadata = dict(index.metadata or {})
+    if int(collection_metadata.get(METADATA_VERSION_KEY, 0)) >= METADATA_VERSION:
+        return False
+
+    build = note_metadata if source == 'notes' else mail_metadata
+    n_upgraded = 0
+    offset = 0
+    while True:
+        page = index.get(include=['metadatas'], limit=page_size, offset=offset)
+        if not page['ids']:
+            break
+        offset += len(page['ids'])
+
+        ids, metadatas = [], []
+        for chunk_id, metadata in zip(page['ids'], page['metadatas']):
+            metadata = dict(metadata or {})
+            if metadata.get('source') == source:
+                continue
+            ids.append(chunk_id)
+            metadatas.append({**metadata, **build(metadata)})
+
+        if ids:
+            index.update(ids=ids, metadatas=metadatas) # type: ignore
+            n_upgraded += len(ids)
+
+    # The hnsw settings cannot be modified once the collection exists
+    collection_metadata[METADATA_VERSION_KEY] = METADATA_VERSION
+    index.modify(metadata={key: value for key, value in collection_metadata.items() if not key.startswith('hnsw:')})
+
+    _logger.info(f'Typed metadata added to {n_upgraded} chunks of {source}.')
+    return n_upgraded > 0
@@ -1,13 +1,559 @@
+import asyncio
 import chromadb
+import hashlib
+import json
 import openai
+import os
 import logging
+import time
 
-from colorama import Fore, Style
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple
 
-from typing import Dict, Literal
+from src.answer_cache import get_answer_cache
+from src.console import print_answer_async, print_prompt
+from src.metadata import parse_filters
+from src.retrieval import Retriever, format_documents
 
 _logger = logging.getLogger(name='QUERY')
 
+PROMPT_PATH = './prompts/rag_prompt.txt'
+LLM_MODEL = 'deepseek-chat'
+
+# Seconds an idle connection to the LLM stays in the pool of the async client
+LLM_KEEPALIVE = 5.0
+
+
+class QueryEngine():
+
+    def __init__(self, db_path: str, api_key: str, base_url: str):
+        """Clients used to answer the questions. They are created once and can be kept warm
+        to answer several questions (see the query daemon).
+
+        Args:
+            db_path (str): path to the database.
+            api_key (str): oai compatible api key.
+            base_url (str): oai compatible base url.
+        """
+
+        self.db_path = db_path
+        self.api_key = api_key
+        self.base_url = base_url
+
+        # We initialize the ai client, the async one is created by the event loop that uses it
+        self.ai_client = openai.OpenAI(
+            api_key=api_key,
+            base_url=base_url
+        )
+        self._async_ai_client: Optional[openai.AsyncOpenAI] = None
+        self._http_client = None
+        self._llm_used = 0.0
+
+        # We initialize the chroma client, the question is embedded once for all the collections
+        self.chroma_client = chromadb.PersistentClient(
+            path=db_path
+        )
+        self.retriever = Retriever(self.chroma_client, db_path)
+
+        with open(PROMPT_PATH, 'r') as prompt_template:
+            self.prompt_template = prompt_template.read()
+
+        # We open the cache of the answers, None if it is disabled
+        self.answer_cache = get_answer_cache(db_path)
+
+    def warm_up(self, load_model: bool = True):
+        """Load the embedding model and open the collections before the first question,
+        so the deadlines of the questions only time the questions.
+
+        Args:
+            load_model (bool, optional): False for the lexical retrieval, that does not use the model. Defaults to True.
+        """
+
+        # A first call also warms up the kernels of the model
+        vector = self.retriever.embedding_function.service.embed(['warm up'])[0] if load_model else None
+        for source in self.retriever.sources:
+            try:
+                index = self.retriever.index(source)
+                # The first query loads the vector index of the collection from the disk
+                if vector is not None:
+                    index.query(query_embeddings=[vector], n_results=1, include=['distances'])
+            except Exception as e:
+                _logger.warning(f'Unable to open the {source} collection, sync it first ({e}).')
+
+    def build_prompt(self, query: str, n_results: int) -> str:
+        """Retrieve the documents and inject them with the question in the prompt.
+
+        Args:
+            query (str): Question for the LLM.
+            n_results (int): Number of document to get with rag.
+
+        Returns:
+            str: the prompt.
+        """
+
+        # We get the rag content, the notes and the mails in one ranked list
+        return self.format_prompt(query, self.retriever.retrieve(query, n_results))
+
+    def format_prompt(self, query: str, documents: List[Dict[str, Any]]) -> str:
+        """Inject the retrieved documents and the question in the prompt.
+
+        Args:
+            query (str): Question for the LLM.
+            documents (List[Dict[str, Any]]): the documents, see Retriever.retrieve.
+
+        Returns:
+            str: the prompt.
+        """
+
+        return self.prompt_template.format(
+            user_query=query,
+            documents=format_documents(documents)
+        )
+
+    def cache_context(self, n_results: int) -> str:
+        """Hash what, besides the question, decides the answer. Only the answers of the same context are reused.
+
+        Args:
+            n_results (int): Number of document to get with rag.
+
+        Returns:
+            str: the context hash.
+        """
+
+        context = [
+            LLM_MODEL,
+            self.retriever.embedding_function.cache_key,
+            n_results,
+            os.environ.get('RAG_SOURCE_QUOTAS', ''),
+            self.retriever.mode,
+            self.prompt_template
+        ]
+        return hashlib.sha256(json.dumps(context).encode('utf-8')).hexdigest()
+
+    def cached_answer(
+            self,
+            query: str,
+            embedding: List[float],
+            n_results: int,
+            use_cache: bool = True,
+            documents: Optional[List[Dict[str, Any]]] = None,
+            versions: Optional[Dict[str, str]] = None
+    ) -> Tuple[Optional[Dict[str, Any]], Optional[List[Dict[str, Any]]], Dict[str, str]]:
+        """Look up the answer of a similar question. It is reused if the collections did not change,
+        or if the same documents are still retrieved.
+
+        Args:
+            query (str): Question for the LLM.
+            embedding (List[float]): the question vector.
+            n_results (int): Number of document to get with rag.
+            use_cache (bool, optional): False to only read the collection versions. Defaults to True.
+            documents (Optional[List[Dict[str, Any]]], optional): the documents of the question, if they are
+                already retrieved. Defaults to None, they are retrieved if the entry has to be checked.
+            versions (Optional[Dict[str, str]], optional): the collection versions read before the retrieval
+                of the documents. Defaults to None, they are read.
+
+        Returns:
+            Tuple[Optional[Dict[str, Any]], Optional[List[Dict[str, Any]]], Dict[str, str]]: the cache entry
+                (None on a miss), the documents if they were retrieved to check the entry, and the collection versions.
+        """
+
+        # The versions are read before the retrieval, a sync running meanwhile invalidates the new answer
+        if versions is None:
+            versions = self.retriever.versions()
+
+        entry = self.answer_cache.search(self.cache_context(n_results), embedding) if use_cache else None # type: ignore
+        if entry is not None and entry['versions'] != versions:
+            # The collections changed since the answer, it is still valid if its documents did not change
+            if documents is None:
+                documents = self.retriever.retrieve(query, n_results, embedding=embedding)
+            if document_refs(documents) != entry['documents'] or documents_fingerprint(documents) != entry['fingerprint']:
+                _logger.info('The documents of the cached answer changed, the LLM is asked again.')
+                self.answer_cache.delete(entry['id']) # type: ignore
+                entry = None
+
+        if entry is not None:
+            _logger.info(f'Answer of "{entry["query"]}" served from the cache (similarity {entry["similarity"]:.3f}).')
+            self.answer_cache.touch(entry['id'], versions if entry['versions'] != versions else None) # type: ignore
+
+        return entry, documents, versions
+
+    def cache_entry(
+            self,
+            query: str,
+            embedding: List[float],
+            n_results: int,
+            documents: List[Dict[str, Any]],
+            versions: Dict[str, str]
+    ) -> Dict[str, Any]:
+        """Get the fields of the cache entry of a new answer, see AnswerCache.put.
+
+        Args:
+            query (str): Question for the LLM.
+            embedding (List[float]): the question vector.
+            n_results (int): Number of document to get with rag.
+            documents (List[Dict[str, Any]]): the documents of the prompt.
+            versions (Dict[str, str]): the collection versions read before the retrieval.
+
+        Returns:
+            Dict[str, Any]: the fields, without the prompt and the answer.
+        """
+
+        return {
+            'context': self.cache_context(n_results),
+            'query': query,
+            'vector': embedding,
+            'documents': document_refs(documents),
+            'versions': versions,
+            'fingerprint': documents_fingerprint(documents),
+        }
+
+    def answer(
+            self,
+            query: str,
+            n_results: int,
+            use_cache: bool = True,
+            retrieval: Optional[str] = None,
+            filters: Optional[Dict[str, Any]] = None
+    ) -> Tuple[str, Iterator[str]]:
+        """Get the prompt and the answer of a question, from the answer cache if possible.
+
+        Args:
+            query (str): Question for the LLM.
+            n_results (int): Number of document to get with rag.
+            use_cache (bool, optional): False to ask the LLM again, the new answer replaces the cached one. Defaults to True.
+            retrieval (Optional[str], optional): 'vector', 'hybrid' or 'lexical' for this question.
+                Defaults to None, the mode of the retriever.
+            filters (Optional[Dict[str, Any]], optional): date range, sender and folder of the documents,
+                see parse_filters. Defaults to None.
+
+        Returns:
+            Tuple[str, Iterator[str]]: the prompt and the streamed answer.
+        """
+
+        retrieval = retrieval or self.retriever.mode
+        if retrieval == 'lexical':
+            # The embedding model is not loaded, and the answer cache that needs the embeddings is skipped
+            prompt = self.format_prompt(query, self.retriever.retrieve(query, n_results, mode=retrieval, filters=filters))
+            return prompt, self.stream_answer(prompt)
+
+        # The question is embedded once, for the cache and for the retrieval
+        embedding = self.retriever.embed(query)
+
+        # The cached answers are those of the mode of the retriever, without filters
+        if self.answer_cache is None or retrieval != self.retriever.mode or filters:
+            prompt = self.format_prompt(
+                query,
+                self.retriever.retrieve(query, n_results, embedding=embedding, mode=retrieval, filters=filters)
+            )
+            return prompt, self.stream_answer(prompt)
+
+        entry, documents, versions = self.cached_answer(query, embedding, n_results, use_cache)
+        if entry is not None:
+            return entry['prompt'], iter([entry['answer']])
+
+        if documents is None:
+            documents = self.retriever.retrieve(query, n_results, embedding=embedding)
+        prompt = self.format_prompt(query, documents)
+
+        return prompt, self._stream_and_cache(prompt, **self.cache_entry(query, embedding, n_results, documents, versions))
+
+    def _stream_and_cache(self, prompt: str, **entry: Any) -> Iterator[str]:
+        """Stream the answer of the LLM and cache it once it is complete.
+
+        Args:
+            prompt (str): the prompt.
+            entry (Any): the other fields of the cache entry, see AnswerCache.put.
+
+        Yields:
+            Iterator[str]: the answer, chunk by chunk.
+        """
+
+        answer = []
+        for content in self.stream_answer(prompt):
+            answer.append(content)
+            yield content
+
+        # An interrupted answer is never reached here, so it is not cached
+        try:
+            self.answer_cache.put(prompt=prompt, answer=''.join(answer), **entry) # type: ignore
+        except Exception as e:
+            _logger.error(f'Unable to cache the answer: {e}')
+
+    def stream_answer(self, prompt: str, history: Optional[List[Dict[str, str]]] = None) -> Iterator[str]:
+        """Stream the answer of the LLM.
+
+        Args:
+            prompt (str): the prompt.
+            history (Optional[List[Dict[str, str]]], optional): the previous messages of a chat. Defaults to None.
+
+        Yields:
+            Iterator[str]: the answer, chunk by chunk.
+        """
+
+        stream = self.ai_client.chat.completions.create(
+            model=LLM_MODEL,
+            messages=build_messages(prompt, history), # type: ignore
+            stream=True
+        )
+
+        for chunk in stream:
+            content = getattr(chunk.choices[0].delta, 'content', None)
+            if content:
+                yield content
+
+    @property
+    def async_ai_client(self) -> openai.AsyncOpenAI:
+        """The async ai client, created on first use so that it belongs to the running event loop.
+
+        Returns:
+            openai.AsyncOpenAI: the client.
+        """
+
+        if self._async_ai_client is None:
+            self._http_client = openai.DefaultAsyncHttpxClient()
+            self._async_ai_client = openai.AsyncOpenAI(
+                api_key=self.api_key,
+                base_url=self.base_url,
+                http_client=self._http_client
+            )
+        return self._async_ai_client
+
+    async def connect_llm(self):
+        """Open the connection to the LLM server, so the TCP and TLS handshakes are done
+        while the documents are retrieved. Any answer of the server leaves the connection in the pool.
+        """
+
+        client = self.async_ai_client
+        try:
+            await self._http_client.head(str(client.base_url)) # type: ignore
+        except Exception as e:
+            _logger.debug(f'Unable to open the connection to the LLM early: {e}')
+
+    async def answer_async(
+            self,
+            query: str,
+            n_results: int,
+            use_cache: bool = True,
+            retrieval: Optional[str] = None,
+            filters: Optional[Dict[str, Any]] = None
+    ) -> Tuple[str, AsyncIterator[str]]:
+        """Get the prompt and the answer of a question, like answer. The connection to the LLM is opened
+        while the collections are searched concurrently, and a stage that misses its deadline gives
+        fewer documents instead of delaying the answer.
+
+        Args:
+            query (str): Question for the LLM.
+            n_results (int): Number of document to get with rag.
+            use_cache (bool, optional): False to ask the LLM again, the new answer replaces the cached one. Defaults to True.
+            retrieval (Optional[str], optional): 'vector', 'hybrid' or 'lexical' for this question.
+                Defaults to None, the mode of the retriever.
+            filters (Optional[Dict[str, Any]], optional): date range, sender and folder of the documents,
+                see parse_filters. Defaults to None.
+
+        Returns:
+            Tuple[str, AsyncIterator[str]]: the prompt and the streamed answer.
+        """
+
+        # An idle connection is closed by the pool after a few seconds, it is opened again
+        connection = None
+        if time.monotonic() - self._llm_used > LLM_KEEPALIVE:
+            connection = asyncio.create_task(self.connect_llm())
+
+        embed_timeout = float(os.environ.get('RAG_EMBED_TIMEOUT', 5))
+        search_timeout = float(os.environ.get('RAG_SEARCH_TIMEOUT', 2))
+
+        retrieval = retrieval or self.retriever.mode
+        if retrieval == 'lexical':
+            # The embedding model is not loaded, and the answer cache that needs the embeddings is skipped
+            documents, _ = await self.retriever.retrieve_async(
+                query,
+                n_results,
+                timeout=search_timeout,
+                mode=retrieval,
+                filters=filters
+            )
+            prompt = self.format_prompt(query, documents)
+            return prompt, self._stream_and_cache_async(prompt, connection, None)
+
+        try:
+            embedding = await asyncio.wait_for(asyncio.to_thread(self.retriever.embed, query), embed_timeout)
+        except asyncio.TimeoutError:
+            _logger.warning(f'The question was not embedded within {embed_timeout} s, it is answered without documents.')
+            prompt = self.format_prompt(query, [])
+            return prompt, self._stream_and_cache_async(prompt, connection, None)
+
+        # The cached answers are those of the mode of the retriever, without filters
+        use_answer_cache = self.answer_cache is not None and retrieval == self.retriever.mode and not filters
+
+        entry, documents, versions = None, None, {}
+        if use_answer_cache:
+            entry, documents, versions = await asyncio.to_thread(self.cached_answer, query, embedding, n_results, use_cache)
+        if entry is not None:
+            return entry['prompt'], iterate_async([entry['answer']])
+
+        complete = True
+        if documents is None:
+            documents, complete = await self.retriever.retrieve_async(
+                query,
+                n_results,
+                embedding=embedding,
+                timeout=search_timeout,
+                mode=retrieval,
+                filters=filters
+            )
+        prompt = self.format_prompt(query, documents)
+
+        # An answer built on fewer documents is not cached
+        entry = self.cache_entry(query, embedding, n_results, documents, versions) if use_answer_cache and complete else None
+        return prompt, self._stream_and_cache_async(prompt, connection, entry)
+
+    async def _stream_and_cache_async(
+            self,
+            prompt: str,
+            connection: Optional['asyncio.Task'],
+            entry: Optional[Dict[str, Any]]
+    ) -> AsyncIterator[str]:
+        """Stream the answer of the LLM and cache it once it is complete.
+
+        Args:
+            prompt (str): the prompt.
+            connection (Optional[asyncio.Task]): the early connection to the LLM, if it was opened.
+            entry (Optional[Dict[str, Any]]): the other fields of the cache entry, None to not cache the answer.
+
+        Yields:
+            AsyncIterator[str]: the answer, chunk by chunk.
+        """
+
+        # The request reuses the connection opened during the retrieval
+        if connection is not None:
+            await connection
+
+        answer = []
+        async for content in self.stream_answer_async(prompt):
+            answer.append(content)
+            yield content
+
+        if entry is not None and self.answer_cache is not None:
+            try:
+                await asyncio.to_thread(self.answer_cache.put, prompt=prompt, answer=''.join(answer), **entry)
+            except Exception as e:
+                _logger.error(f'Unable to cache the answer: {e}')
+
+    async def complete_async(self, prompt: str) -> str:
+        """Get the whole answer of the LLM at once, without streaming. The retries are left to the caller.
+
+        Args:
+            prompt (str): the prompt.
+
+        Returns:
+            str: the answer.
+        """
+
+        response = await self.async_ai_client.with_options(max_retries=0).chat.completions.create(
+            model=LLM_MODEL,
+            messages=build_messages(prompt), # type: ignore
+        )
+        self._llm_used = time.monotonic()
+
+        return response.choices[0].message.content or ''
+
+    async def stream_answer_async(self, prompt: str, history: Optional[List[Dict[str, str]]] = None) -> AsyncIterator[str]:
+        """Stream the answer of the LLM with the async client.
+
+        Args:
+            prompt (str): the prompt.
+            history (Optional[List[Dict[str, str]]], optional): the previous messages of a chat. Defaults to None.
+
+        Yields:
+            AsyncIterator[str]: the answer, chunk by chunk.
+        """
+
+        stream = await self.async_ai_client.chat.completions.create(
+            model=LLM_MODEL,
+            messages=build_messages(prompt, history), # type: ignore
+            stream=True
+        )
+
+        try:
+            async for chunk in stream:
+                content = getattr(chunk.choices[0].delta, 'content', None)
+                if content:
+                    yield content
+        finally:
+            self._llm_used = time.monotonic()
+            await stream.close()
+
+
+async def iterate_async(chunks: Iterable[str]) -> AsyncIterator[str]:
+    """Turn a text already known, like a cached answer, into a stream.
+
+    Args:
+        chunks (Iterable[str]): the text.
+
+    Yields:
+        AsyncIterator[str]: the text, chunk by chunk.
+    """
+
+    for content in chunks:
+        yield content
+
+
+def build_messages(prompt: str, history: Optional[List[Dict[str, str]]] = None) -> List[Dict[str, str]]:
+    """Get the messages sent to the LLM.
+
+    Args:
+        prompt (str): the prompt.
+        history (Optional[List[Dict[str, str]]], optional): the previous messages of a chat. Defaults to None.
+
+    Returns:
+        List[Dict[str, str]]: the system message, the history and the prompt.
+    """
+
+    return [
+        {'role': 'system', 'content': 'You are a helpul ai assistant.'},
+        *(history or []),
+        {'role': 'user', 'content': prompt}
+    ]
+
+
+async def query_async(
+        query: str,
+        db_path: str,
+        n_results: int,
+        debug: bool,
+        api_key: str,
+        base_url: str,
+        no_cache: bool = False,
+        retrieval: Optional[str] = None,
+        filters: Optional[Dict[str, Any]] = None
+):
+    """Answer a question in process, the answer is printed as it is streamed.
+
+    Args:
+        query (str): Question for the LLM.
+        db_path (str): path to the database.
+        n_results (int): Number of document to get with rag.
+        debug (bool): True for debug mode.
+        api_key (str): oai compatible api key.
+        base_url (str): oai compatible base url.
+        no_cache (bool, optional): True to ask the LLM again instead of reusing a cached answer. Defaults to False.
+        retrieval (Optional[str], optional): 'vector', 'hybrid' or 'lexical'. Defaults to None, the RAG_RETRIEVAL env variable.
+        filters (Optional[Dict[str, Any]], optional): date range, sender and folder, see parse_filters. Defaults to None.
+    """
+
+    engine = QueryEngine(db_path, api_key, base_url)
+
+    # The model and the collections are loaded before the deadlines of RAG_EMBED_TIMEOUT and RAG_SEARCH_TIMEOUT start
+    await asyncio.to_thread(engine.warm_up, (retrieval or engine.retriever.mode) != 'lexical')
+
+    prompt, answer = await engine.answer_async(query, n_results, use_cache=not no_cache, retrieval=retrieval, filters=filters)
+
+    if debug:
+        print_prompt(prompt)
+
+    _logger.info(f'API response : \n')
+    await print_answer_async(answer)
+
+
 def query(
         query: str,
         db_path: str,
@@ -15,105 +561,61 @@ def query(
         debug: bool,
         api_key: str,
         base_url: str,
+        no_cache: bool = False,
+        retrieval: Optional[str] = None,
+        after: Optional[str] = None,
+        before: Optional[str] = None,
+        sender: Optional[str] = None,
+        folder: Optional[str] = None,
         **kwargs: Dict
 
 ):
-    """_summary_
+    """Answer a question in process, with the notes and mails retrieved from the database.
 
     Args:
-        index_name (str): Name of the collection 
         query (str): Question for the LLM.
         db_path (str): path to the database.
         n_results (int): Number of document to get with rag.
         debug (bool): True for debug mode.
         api_key (str): oai compatible api key.
         base_url (str): oai compatible base url.
+        no_cache (bool, optional): True to ask the LLM again instead of reusing a cached answer. Defaults to False.
+        retrieval (Optional[str], optional): 'vector', 'hybrid' or 'lexical'. Defaults to None, the RAG_RETRIEVAL env variable.
+        after (Optional[str], optional): only the documents of this date or later, see parse_date. Defaults to None.
+        before (Optional[str], optional): only the documents older than this date. Defaults to None.
+        sender (Optional[str], optional): only the mails of this address. Defaults to None.
+        folder (Optional[str], optional): only the notes of this folder and the mails of this mailbox. Defaults to None.
     """
 
-    # We initialize the ai client
-    ai_client = openai.OpenAI(
-        api_key=api_key,
-        base_url=base_url
-    )
+    filters = parse_filters(after=after, before=before, sender=sender, folder=folder)
+    asyncio.run(query_async(query, db_path, n_results, debug, api_key, base_url, no_cache, retrieval, filters))
 
-    # We initialize the chroma client and get the index
-    chroma_client = chromadb.PersistentClient(
-        path=db_path
-    )
 
-    # We get the rag content
-    rag_content = '========= Notes =========\n'
-    rag_content += get_rag_content(chroma_client, 'notes', query, n_results)
+def document_refs(documents: List[Dict[str, Any]]) -> List[List[str]]:
+    """Get the source and the id of the retrieved documents, in a stable order.
 
-    rag_content += '========= Mails =========\n'
-    rag_content += get_rag_content(chroma_client, 'mails', query, n_results)
+    Args:
+        documents (List[Dict[str, Any]]): the documents, see Retriever.retrieve.
 
-    # We inject the rag output and the user question in the prompt
-    with open('./prompts/rag_prompt.txt', 'r') as prompt_template:
-        prompt = prompt_template.read().format(
-            user_query=query,
-            documents=rag_content
-        )
+    Returns:
+        List[List[str]]: the source and the id of each document.
+    """
 
-    # We stream the answer from the ai client
-    stream = ai_client.chat.completions.create(
-        model='deepseek-chat',
-        messages=[
-            {'role': 'system', 'content': 'You are a helpul ai assistant.'},
-            {'role': 'user', 'content': prompt}
-        ],
-        stream=True
-    )
+    return sorted([document['source'], document['id']] for document in documents)
 
-    if debug:
-        print(f'\n{Fore.YELLOW}Prompt: {Fore.CYAN}{prompt}')
-    
-    # print(f'{Fore.YELLOW}Response: \n{Fore.CYAN}')
-    _logger.info(f'API response : \n')
-    for chunk in stream:
-        content = getattr(chunk.choices[0].delta, 'content', None)
-        if content:
-            print(f'{Fore.CYAN}{content}', end='', flush=True)
-            
-    print(f'{Style.RESET_ALL}')
-
-def get_rag_content(
-        client,
-        index_name: Literal['notes', 'mails'],
-        query: str,
-        n_results: int) -> str:
 
-    index = client.get_collection(
-        name=index_name
-    )
-    
-    results = index.query(
-        query_texts=[query],
-        n_results=n_results
+def documents_fingerprint(documents: List[Dict[str, Any]]) -> str:
+    """Hash the content of the retrieved documents, a cached answer is only reused on the same content.
+
+    Args:
+        documents (List[Dict[str, Any]]): the documents, see Retriever.retrieve.
+
+    Returns:
+        str: the sha256 hex digest.
+    """
+
+    contents = sorted(
+        (document['source'], document['id'], document['content'], json.dumps(document['metadata'], sort_keys=True))
+        for document in documents
     )
-    
-    try:
-        rag_result = ''
-        for i in range(n_results):
-            metadata = results['metadatas'][0][i] # type: ignore
-            content = results['documents'][0][i] # type: ignore
-            
-            rag_result += f'------- document number {i} ------'
-            rag_result += f'Metadata: {metadata}\n'
-            rag_result += f'Content :\n         {content}\n\n\n'
-
-    except IndexError as e:
-        _logger.error(e)
-        _logger.warning('Recollecting less documents.')
-
-    finally:
-        rag_result = ''
-        for i in range(len(results['ids'][0])):
-            metadata = results['metadatas'][0][i] # type: ignore
-            content = results['documents'][0][i] # type: ignore
-            
-            rag_result += f'------- document number {i} ------'
-            rag_result += f'Metadata: {metadata}\n'
-            rag_result += f'Content :\n         {content}\n\n\n'
-
-    return rag_result
\ No newline at end of file
+    return hashlib.sha256(json.dumps(contents).encode('utf-8')).hexdigest()
@@ -0,0 +1,583 @@
+import asyncio
+import logging
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from src.embedding.cache import get_cached_embedding_function
+from src.embedding.chunking import regroup_chunks
+from src.embedding.service import get_collection_version, open_collection
+from src.lexical import get_lexical_index
+from src.metadata import FILTER_KEYS, build_where
+
+
+_logger = logging.getLogger(name='RETRIEVAL')
+
+SOURCES = ('notes', 'mails')
+
+# Number of BM25 hits checked against the filters of a search, they are filtered by chroma
+MAX_FILTERED_HITS = 1000
+
+# vector: embeddings only, lexical: BM25 only (the model is not loaded), hybrid: both, fused by rank
+RETRIEVAL_MODES = ('vector', 'hybrid', 'lexical')
+
+# Largest distance of each chroma space between unit vectors, used to bring them to [0, 1]
+_MAX_DISTANCES = {'l2': 4.0, 'cosine': 2.0, 'ip': 2.0}
+
+
+def parse_quotas(value: Optional[str]) -> Dict[str, int]:
+    """Parse per-source quotas written as 'notes=3,mails=2'.
+
+    Args:
+        value (Optional[str]): the quotas, usually the RAG_SOURCE_QUOTAS env variable.
+
+    Returns:
+        Dict[str, int]: maximum number of documents of each source.
+    """
+
+    quotas = {}
+    for item in (value or '').split(','):
+        if '=' in item:
+            source, count = item.split('=', 1)
+            quotas[source.strip()] = int(count)
+    return quotas
+
+
+def get_retrieval_mode() -> str:
+    """Get the retrieval mode from the RAG_RETRIEVAL env variable.
+
+    Raises:
+        ValueError: if the mode is unknown.
+
+    Returns:
+        str: 'vector', 'hybrid' or 'lexical', 'vector' by default.
+    """
+
+    mode = os.environ.get('RAG_RETRIEVAL', 'vector')
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f'Unknown retrieval mode {mode}, expected one of {RETRIEVAL_MODES}.')
+    return mode
+
+
+def fuse_rankings(rankings: Sequence[List[Dict[str, Any]]], n_results: int, k: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Merge rankings of documents with reciprocal rank fusion: a document scores 1 / (k + rank)
+    in each ranking it appears in. The ranks are used, not the scores, so BM25 and distances mix.
+
+    Args:
+        rankings (Sequence[List[Dict[str, Any]]]): the documents of each search, the best first.
+        n_results (int): maximum number of documents.
+        k (Optional[int], optional): the rank offset, a larger k flattens the ranks. Defaults to the RAG_RRF_K env variable, 60.
+
+    Returns:
+        List[Dict[str, Any]]: the documents, with a score in [0, 1] where 0 is the first of every ranking.
+    """
+
+    k = k if k is not None else int(os.environ.get('RAG_RRF_K', 60))
+
+    fused: Dict[str, Dict[str, Any]] = {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking, start=1):
+            # The first ranking that found the document gives its content
+            entry = fused.setdefault(document['id'], {**document, 'rrf': 0.0})
+            entry['rrf'] += 1 / (k + rank)
+
+    best = len(rankings) / (k + 1)
+    documents = sorted(fused.values(), key=lambda document: -document['rrf'])[:n_results]
+    for document in documents:
+        document['score'] = 1 - document.pop('rrf') / best
+
+    return documents
+
+
+def normalize_distance(distance: float, space: str) -> float:
+    """Bring a chroma distance to [0, 1], so the distances of several collections can be compared.
+
+    Args:
+        distance (float): the distance returned by chroma.
+        space (str): the hnsw space of the collection, 'l2', 'cosine' or 'ip'.
+
+    Returns:
+        float: the normalized distance, 0 is the closest.
+    """
+
+    return min(max(distance / _MAX_DISTANCES.get(space, 4.0), 0.0), 1.0)
+
+
+class Retriever():
+
+    def __init__(self, client, db_path: str, sources: Sequence[str] = SOURCES, mode: Optional[str] = None):
+        """Search several collections for a question. The question is embedded once and
+        the collections are searched at the same time.
+
+        Args:
+            client (chromadb.ClientAPI): the chroma client.
+            db_path (str): path to the database, the embedding cache and the lexical indexes are stored next to it.
+            sources (Sequence[str], optional): Names of the collections. Defaults to SOURCES.
+            mode (Optional[str], optional): 'vector', 'hybrid' or 'lexical'. Defaults to get_retrieval_mode().
+        """
+
+        self.client = client
+        self.db_path = db_path
+        self.sources = list(sources)
+        self.mode = mode or get_retrieval_mode()
+        self.embedding_function = get_cached_embedding_function(db_path)
+        self._indexes: Dict[str, Any] = {}
+        # Several questions can be searched at once by the async engine
+        self._executor = ThreadPoolExecutor(
+            max_workers=len(self.sources) * int(os.environ.get('RAG_SERVE_CONCURRENCY', 4)),
+            thread_name_prefix='retrieval'
+        )
+
+    def index(self, source: str):
+        """Get a collection, opened once.
+
+        Args:
+            source (str): Name of the collection.
+
+        Returns:
+            chromadb.Collection: the collection.
+        """
+
+        if source not in self._indexes:
+            self._indexes[source] = open_collection(self.client, source, self.embedding_function, create=False)
+        return self._indexes[source]
+
+    def reset(self):
+        """Forget the open collections, they are opened again on the next search.
+        A collection rebuilt by a sync with --flush is only found again this way.
+        """
+
+        self._indexes = {}
+
+    def versions(self) -> Dict[str, str]:
+        """Get the current version of each collection.
+
+        Returns:
+            Dict[str, str]: the version of each source, empty for a missing collection.
+        """
+
+        # The metadata of an open collection is not refreshed after a sync, we open them again
+        self.reset()
+
+        versions = {}
+        for source in self.sources:
+            try:
+                versions[source] = get_collection_version(self.index(source))
+            except Exception:
+                versions[source] = ''
+        return versions
+
+    def embed(self, query: str) -> List[float]:
+        """Embed a question.
+
+        Args:
+            query (str): the question.
+
+        Returns:
+            List[float]: its vector.
+        """
+
+        return list(self.embedding_function([query])[0])
+
+    def embed_many(self, queries: Sequence[str]) -> List[List[float]]:
+        """Embed several questions in one call of the model.
+
+        Args:
+            queries (Sequence[str]): the questions.
+
+        Returns:
+            List[List[float]]: their vectors.
+        """
+
+        return [list(vector) for vector in self.embedding_function(list(queries))]
+
+    def search(
+            self,
+            source: str,
+            embedding: List[float],
+            n_results: int,
+            where: Optional[Dict[str, Any]] = None
+    ) -> List[Dict[str, Any]]:
+        """Search a collection with a query embedding, the chunks are regrouped by document.
+
+        Args:
+            source (str): Name of the collection.
+            embedding (List[float]): the query vector.
+            n_results (int): Number of documents.
+            where (Optional[Dict[str, Any]], optional): chroma filter on the metadata, see build_where. Defaults to None.
+
+        Returns:
+            List[Dict[str, Any]]: the documents, with their source and normalized distance.
+        """
+
+        return self.search_many(source, [embedding], n_results, where)[0]
+
+    def search_many(
+            self,
+            source: str,
+            embeddings: Sequence[List[float]],
+            n_results: int,
+            where: Optional[Dict[str, Any]] = None
+    ) -> List[List[Dict[str, Any]]]:
+        """Search a collection with several query embeddings in one query.
+
+        Args:
+            source (str): Name of the collection.
+            embeddings (Sequence[List[float]]): the query vectors.
+            n_results (int): Number of documents per query.
+            where (Optional[Dict[str, Any]], optional): chroma filter on the metadata, the chunks
+                are filtered before the similarity search. Defaults to None.
+
+        Returns:
+            List[List[Dict[str, Any]]]: the documents of each query, with their source and normalized distance.
+        """
+
+        index = self.index(source)
+        results = index.query(
+            query_embeddings=list(embeddings),
+            n_results=n_results * int(os.environ.get('CHUNK_QUERY_FACTOR', 4)),
+            where=where,
+            include=['documents', 'metadatas', 'distances'] # type: ignore
+        )
+
+        space = (index.metadata or {}).get('hnsw:space', 'l2')
+        found = []
+        for i in range(len(embeddings)):
+            documents = regroup_chunks(
+                ids=results['ids'][i],
+                documents=results['documents'][i], # type: ignore
+                metadatas=results['metadatas'][i], # type: ignore
+                distances=results['distances'][i], # type: ignore
+                n_results=n_results
+            )
+
+            for document in documents:
+                document['source'] = source
+                document['score'] = normalize_distance(document['distance'], space)
+            found.append(documents)
+
+        return found
+
+    def lexical_search(
+            self,
+            source: str,
+            query: str,
+            n_results: int,
+            where: Optional[Dict[str, Any]] = None
+    ) -> List[Dict[str, Any]]:
+        """Search the lexical index of a collection with BM25, the chunks are regrouped by document.
+
+        Args:
+            source (str): Name of the collection.
+            query (str): the question.
+            n_results (int): Number of documents.
+            where (Optional[Dict[str, Any]], optional): chroma filter on the metadata, see build_where. Defaults to None.
+
+        Returns:
+            List[Dict[str, Any]]: the documents, with their source and their BM25 score, the best first.
+        """
+
+        # The lexical index has no metadata, more hits are read when chroma filters them
+        limit = n_results * int(os.environ.get('CHUNK_QUERY_FACTOR', 4))
+        hits = get_lexical_index(self.db_path, source).search(query, limit=limit if where is None else MAX_FILTERED_HITS)
+        if not hits:
+            return []
+
+        # The chunks are read from chroma, the lexical index only holds the terms
+        stored = self.index(source).get(
+            ids=[chunk_id for chunk_id, _ in hits],
+            where=where,
+            include=['documents', 'metadatas']
+        )
+        chunks = {
+            chunk_id: (document, metadata)
+            for chunk_id, document, metadata in zip(stored['ids'], stored['documents'], stored['metadatas'])
+        }
+        hits = [(chunk_id, score) for chunk_id, score in hits if chunk_id in chunks][:limit]
+
+        documents = regroup_chunks(
+            ids=[chunk_id for chunk_id, _ in hits],
+            documents=[chunks[chunk_id][0] for chunk_id, _ in hits],
+            metadatas=[chunks[chunk_id][1] for chunk_id, _ in hits],
+            distances=[-score for _, score in hits],
+            n_results=n_results
+        )
+
+        for document in documents:
+            document['source'] = source
+            document['bm25'] = -document.pop('distance')
+
+        return documents
+
+    def search_source(
+            self,
+            source: str,
+            query: str,
+            embedding: Optional[List[float]],
+            n_results: int,
+            mode: str,
+            where: Optional[Dict[str, Any]] = None
+    ) -> List[Dict[str, Any]]:
+        """Search a collection in a retrieval mode.
+
+        Args:
+            source (str): Name of the collection.
+            query (str): the question.
+            embedding (Optional[List[float]]): the query vector, None in lexical mode.
+            n_results (int): Number of documents.
+            mode (str): 'vector', 'hybrid' or 'lexical'.
+            where (Optional[Dict[str, Any]], optional): chroma filter on the metadata, see build_where. Defaults to None.
+
+        Returns:
+            List[Dict[str, Any]]: the documents, with their source and score.
+        """
+
+        if mode == 'vector':
+            return self.search(source, embedding, n_results, where) # type: ignore
+        if mode == 'lexical':
+            return fuse_rankings([self.lexical_search(source, query, n_results, where)], n_results)
+
+        # The fusion picks from deeper rankings than the documents it keeps
+        return fuse_rankings(
+            [self.search(source, embedding, 2 * n_results, where), self.lexical_search(source, query, 2 * n_results, where)], # type: ignore
+            n_results
+        )
+
+    def quotas(self, n_results: int, quotas: Optional[Dict[str, int]] = None) -> Dict[str, int]:
+        """Get the number of documents to take from each source.
+
+        Args:
+            n_results (int): Number of documents per source, unless a quota is set for the source.
+            quotas (Optional[Dict[str, int]], optional): maximum number of documents of each source.
+                Defaults to the RAG_SOURCE_QUOTAS env variable.
+
+        Returns:
+            Dict[str, int]: the number of documents of the searched sources.
+        """
+
+        quotas = quotas if quotas is not None else parse_quotas(os.environ.get('RAG_SOURCE_QUOTAS'))
+        return {
+            source: quotas.get(source, n_results)
+            for source in self.sources
+            if quotas.get(source, n_results) > 0
+        }
+
+    def retrieve(
+            self,
+            query: str,
+            n_results: int,
+            quotas: Optional[Dict[str, int]] = None,
+            embedding: Optional[List[float]] = None,
+            mode: Optional[str] = None,
+            filters: Optional[Dict[str, Any]] = None
+    ) -> List[Dict[str, Any]]:
+        """Get the closest documents of all the sources, in one list ranked by score.
+
+        Args:
+            query (str): the question.
+            n_results (int): Number of documents per source, unless a quota is set for the source.
+            quotas (Optional[Dict[str, int]], optional): maximum number of documents of each source.
+                Defaults to the RAG_SOURCE_QUOTAS env variable.
+            embedding (Optional[List[float]], optional): the query vector, if it is already computed. Defaults to None.
+            mode (Optional[str], optional): 'vector', 'hybrid' or 'lexical'. Defaults to the mode of the retriever.
+            filters (Optional[Dict[str, Any]], optional): date range, sender and folder, see parse_filters. Defaults to None.
+
+        Returns:
+            List[Dict[str, Any]]: the documents: id, source, metadata, content, score, and distance or bm25.
+        """
+
+        mode = mode or self.mode
+        if embedding is None and mode != 'lexical':
+            embedding = self.embed(query)
+
+        quotas = self.quotas(n_results, quotas)
+        futures = {
+            source: self._executor.submit(
+                self.search_source, source, query, embedding, quota, mode, build_where(filters, source)
+            )
+            for source, quota in quotas.items()
+        }
+
+        return merge_results(futures, quotas)
+
+    async def retrieve_async(
+            self,
+            query: str,
+            n_results: int,
+            quotas: Optional[Dict[str, int]] = None,
+            embedding: Optional[List[float]] = None,
+            timeout: Optional[float] = None,
+            mode: Optional[str] = None,
+            filters: Optional[Dict[str, Any]] = None
+    ) -> Tuple[List[Dict[str, Any]], bool]:
+        """Get the closest documents of all the sources from an event loop, like retrieve.
+        The sources not searched within the timeout are left out.
+
+        Args:
+            query (str): the question.
+            n_results (int): Number of documents per source, unless a quota is set for the source.
+            quotas (Optional[Dict[str, int]], optional): maximum number of documents of each source.
+                Defaults to the RAG_SOURCE_QUOTAS env variable.
+            embedding (Optional[List[float]], optional): the query vector, if it is already computed. Defaults to None.
+            timeout (Optional[float], optional): seconds to wait for the searches. Defaults to None, no deadline.
+            mode (Optional[str], optional): 'vector', 'hybrid' or 'lexical'. Defaults to the mode of the retriever.
+            filters (Optional[Dict[str, Any]], optional): date range, sender and folder, see parse_filters. Defaults to None.
+
+        Returns:
+            Tuple[List[Dict[str, Any]], bool]: the documents, and False if a source missed the deadline.
+        """
+
+        mode = mode or self.mode
+        loop = asyncio.get_running_loop()
+        if embedding is None and mode != 'lexical':
+            embedding = await loop.run_in_executor(self._executor, self.embed, query)
+
+        quotas = self.quotas(n_results, quotas)
+        futures = {
+            source: loop.run_in_executor(
+                self._executor, self.search_source, source, query, embedding, quota, mode, build_where(filters, source)
+            )
+            for source, quota in quotas.items()
+        }
+        if not futures:
+            return [], True
+
+        _, pending = await asyncio.wait(futures.values(), timeout=timeout)
+
+        # The late searches finish in the background, their documents are dropped
+        late = [source for source, future in futures.items() if future in pending]
+        for source in late:
+            _logger.warning(f'The search of {source} missed its {timeout} s deadline, its documents are left out.')
+
+        return merge_results({source: future for source, future in futures.items() if source not in late}, quotas), not late
+
+    def retrieve_many(
+            self,
+            queries: Sequence[str],
+            n_results: int,
+            quotas: Optional[Dict[str, int]] = None,
+            embeddings: Optional[Sequence[List[float]]] = None,
+            mode: Optional[str] = None
+    ) -> List[List[Dict[str, Any]]]:
+        """Get the closest documents of many questions, with one vector search per collection for all of them.
+
+        Args:
+            queries (Sequence[str]): the questions.
+            n_results (int): Number of documents per source, unless a quota is set for the source.
+            quotas (Optional[Dict[str, int]], optional): maximum number of documents of each source.
+                Defaults to the RAG_SOURCE_QUOTAS env variable.
+            embeddings (Optional[Sequence[List[float]]], optional): the query vectors, if they are already computed. Defaults to None.
+            mode (Optional[str], optional): 'vector', 'hybrid' or 'lexical'. Defaults to the mode of the retriever.
+
+        Returns:
+            List[List[Dict[str, Any]]]: the documents of each question, ranked by score.
+        """
+
+        if not queries:
+            return []
+
+        mode = mode or self.mode
+        if embeddings is None and mode != 'lexical':
+            embeddings = self.embed_many(queries)
+
+        quotas = self.quotas(n_results, quotas)
+        futures = {
+            source: self._executor.submit(self.search_source_many, source, queries, embeddings, quota, mode)
+            for source, quota in quotas.items()
+        }
+
+        found: Dict[str, List[List[Dict[str, Any]]]] = {}
+        for source, future in futures.items():
+            try:
+                found[source] = future.result()
+            except Exception as e:
+                _logger.error(f'Error searching {source}: {e}')
+
+        return [
+            sorted(
+                (document for documents in found.values() for document in documents[i]),
+                key=lambda document: document['score']
+            )
+            for i in range(len(queries))
+        ]
+
+
+    def search_source_many(
+            self,
+            source: str,
+            queries: Sequence[str],
+            embeddings: Optional[Sequence[List[float]]],
+            n_results: int,
+            mode: str
+    ) -> List[List[Dict[str, Any]]]:
+        """Search a collection for many questions in a retrieval mode, with one vector search for all of them.
+
+        Args:
+            source (str): Name of the collection.
+            queries (Sequence[str]): the questions.
+            embeddings (Optional[Sequence[List[float]]]): the query vectors, None in lexical mode.
+            n_results (int): Number of documents per question.
+            mode (str): 'vector', 'hybrid' or 'lexical'.
+
+        Returns:
+            List[List[Dict[str, Any]]]: the documents of each question.
+        """
+
+        if mode == 'vector':
+            return self.search_many(source, embeddings, n_results) # type: ignore
+        if mode == 'lexical':
+            return [fuse_rankings([self.lexical_search(source, query, n_results)], n_results) for query in queries]
+
+        vector_rankings = self.search_many(source, embeddings, 2 * n_results) # type: ignore
+        return [
+            fuse_rankings([vector_ranking, self.lexical_search(source, query, 2 * n_results)], n_results)
+            for query, vector_ranking in zip(queries, vector_rankings)
+        ]
+
+
+def merge_results(futures: Dict[str, Any], quotas: Dict[str, int]) -> List[Dict[str, Any]]:
+    """Merge the documents of the searches of the sources, ranked by score.
+
+    Args:
+        futures (Dict[str, Any]): the finished or running search of each source.
+        quotas (Dict[str, int]): the number of documents asked to each source.
+
+    Returns:
+        List[Dict[str, Any]]: the documents of all the sources.
+    """
+
+    documents = []
+    for source, future in futures.items():
+        try:
+            found = future.result()
+        except Exception as e:
+            _logger.error(f'Error searching {source}: {e}')
+            continue
+
+        if len(found) < quotas[source]:
+            _logger.warning(f'Recollecting less documents from {source}.')
+        documents.extend(found)
+
+    return sorted(documents, key=lambda document: document['score'])
+
+
+def format_documents(documents: List[Dict[str, Any]]) -> str:
+    """Format the retrieved documents for the prompt.
+
+    Args:
+        documents (List[Dict[str, Any]]): the documents, see Retriever.retrieve.
+
+    Returns:
+        str: the documents, with their source and metadata.
+    """
+
+    rag_result = ''
+    for i, document in enumerate(documents):
+        rag_result += f'------- document number {i} ({document["source"]}) ------'
+        # The timestamps and the normalized sender are only used by the filters
+        metadata = {key: value for key, value in document['metadata'].items() if key not in FILTER_KEYS}
+        rag_result += f'Metadata: {metadata}\n'
+        rag_result += f'Content :\n         {document["content"]}\n\n\n'
+
+    return rag_result
@@ -0,0 +1,98 @@
+import os
+import pytest
+
+from typing import Any, Dict, List, Optional, Sequence
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Words of the questions that decide their topic, each topic is one axis of the stand-in embeddings
+TOPICS = ('offsite', 'bank')
+
+
+def topic_embedding(text: str) -> List[float]:
+    """Embed a text on the axes of the topics it names, a text without topic gets its own axis.
+
+    Args:
+        text (str): the text.
+
+    Returns:
+        List[float]: its vector.
+    """
+
+    words = text.casefold()
+    vector = [float(topic in words) for topic in TOPICS]
+    return vector + [0.0 if any(vector) else 1.0]
+
+
+class StandInRetriever():
+
+    def __init__(self, client, db_path: str, sources: Sequence[str] = ('notes', 'mails'), mode: Optional[str] = None):
+        """In memory retriever, one note per topic. The searches are recorded.
+
+        Args:
+            client (chromadb.ClientAPI): unused.
+            db_path (str): unused.
+            sources (Sequence[str], optional): Names of the collections. Defaults to ('notes', 'mails').
+            mode (Optional[str], optional): 'vector' or 'lexical', only recorded. Defaults to 'vector'.
+        """
+
+        self.sources = list(sources)
+        self.mode = mode or 'vector'
+        self.searches: List[str] = []
+        self.documents = {
+            topic: {
+                'id': f'note-{topic}',
+                'source': 'notes',
+                'metadata': {'title': f'About the {topic}', 'folder': 'Notes'},
+                'content': f'Everything about the {topic}.',
+                'score': 0.1,
+                'distance': 0.1,
+            }
+            for topic in TOPICS
+        }
+
+    def versions(self) -> Dict[str, str]:
+        return {source: '' for source in self.sources}
+
+    def embed(self, query: str) -> List[float]:
+        return topic_embedding(query)
+
+    def embed_many(self, queries: Sequence[str]) -> List[List[float]]:
+        return [topic_embedding(query) for query in queries]
+
+    def retrieve(self, query: str, n_results: int, quotas=None, embedding=None, mode=None, filters=None) -> List[Dict[str, Any]]:
+        self.searches.append(query)
+        return [document for topic, document in self.documents.items() if topic in query.casefold()][:n_results]
+
+    def retrieve_many(self, queries: Sequence[str], n_results: int, quotas=None, embeddings=None) -> List[List[Dict[str, Any]]]:
+        return [self.retrieve(query, n_results) for query in queries]
+
+
+@pytest.fixture
+def make_engine(monkeypatch, tmp_path):
+    """Build a QueryEngine on the stand-in retriever, without answer cache, that asks a given LLM server.
+    """
+
+    import src.query
+
+    # The prompt template is read from the repository root
+    monkeypatch.chdir(REPO_ROOT)
+    monkeypatch.setenv('ANSWER_CACHE', 'off')
+    monkeypatch.setattr(src.query, 'Retriever', StandInRetriever)
+
+    def make(base_url: str) -> 'src.query.QueryEngine':
+        return src.query.QueryEngine(str(tmp_path / 'chroma'), 'stand-in', base_url)
+
+    return make
+
+
+@pytest.fixture
+def llm_server():
+    """Stand-in OpenAI compatible server, answering at once.
+    """
+
+    from benchmarks.llm_server import StandInLLMServer
+
+    with StandInLLMServer(first_token_delay=0.0, token_delay=0.0) as server:
+        yield server
@@ -0,0 +1,242 @@
+"""Minimal stand-in IMAP server, enough of IMAP4rev1 for the mail fetching code:
+LOGIN, SELECT/EXAMINE, UID SEARCH and UID FETCH of RFC822.SIZE, BODY[], BODYSTRUCTURE,
+HEADER.FIELDS and the sections of a message, partial fetches included.
+
+The messages are given as raw bytes per mailbox, their UIDs start at 1. Every command
+is recorded, so the tests can count the round trips and check what was downloaded.
+"""
+
+import email
+import re
+import socketserver
+import threading
+
+from email.message import Message
+from typing import Dict, List, Optional, Set, Tuple
+
+
+_ITEM_RE = re.compile(r'BODY(?:\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?|RFC822\.SIZE|BODYSTRUCTURE|UID')
+
+
+def quote(value: Optional[str]) -> str:
+    if value is None:
+        return 'NIL'
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def params(pairs: List[Tuple[str, str]]) -> str:
+    return '(' + ' '.join(f'{quote(key)} {quote(value)}' for key, value in pairs) + ')' if pairs else 'NIL'
+
+
+def body_structure(part: Message) -> str:
+    """Build the BODYSTRUCTURE of a message part.
+
+    Args:
+        part (Message): the part.
+
+    Returns:
+        str: the parenthesized list.
+    """
+
+    if part.is_multipart():
+        children = ''.join(body_structure(child) for child in part.get_payload()) # type: ignore
+        return f'({children} {quote(part.get_content_subtype())} {params([("boundary", part.get_boundary() or "")])} NIL NIL NIL)'
+
+    payload = part.get_payload().encode() # type: ignore
+    fields = [
+        quote(part.get_content_maintype()),
+        quote(part.get_content_subtype()),
+        params([(key, value) for key, value in part.get_params()[1:]] if part.get_params() else []), # type: ignore
+        'NIL',
+        'NIL',
+        quote(part.get('Content-Transfer-Encoding', '7bit')),
+        str(len(payload)),
+    ]
+    if part.get_content_maintype() == 'text':
+        fields.append(str(payload.count(b'\n')))
+
+    disposition = part.get('Content-Disposition')
+    if disposition:
+        kind = disposition.split(';')[0].strip()
+        filename = part.get_filename()
+        fields += ['NIL', f'({quote(kind)} {params([("filename", filename)] if filename else [])})', 'NIL', 'NIL']
+    return '(' + ' '.join(fields) + ')'
+
+
+def body_section(message: Message, section: str) -> bytes:
+    """Get a section of a message, like BODY[section].
+
+    Args:
+        message (Message): the message.
+        section (str): '' for the whole message, a part number like '1.2', or HEADER.FIELDS (...).
+
+    Returns:
+        bytes: the section.
+    """
+
+    if section.startswith('HEADER.FIELDS'):
+        names = section[section.index('(') + 1:section.rindex(')')].split()
+        lines = [f'{name}: {value}\r\n' for name, value in message.items() if name.upper() in names]
+        return (''.join(lines) + '\r\n').encode()
+
+    part = message
+    for position in section.split('.'):
+        # The first part of a single part message is its body
+        part = part.get_payload()[int(position) - 1] if part.is_multipart() else part # type: ignore
+    return part.get_payload().encode() # type: ignore
+
+
+class StandInImapHandler(socketserver.StreamRequestHandler):
+
+    server: 'StandInImapServer'
+
+    def send(self, line: bytes):
+        self.wfile.write(line + b'\r\n')
+
+    def handle(self):
+        self.selected: Optional[str] = None
+        self.send(b'* OK [CAPABILITY IMAP4rev1] stand-in ready')
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, _, command = line.decode().rstrip('\r\n').partition(' ')
+            self.server.record(command)
+            name, _, args = command.partition(' ')
+            name = name.upper()
+
+            if name == 'CAPABILITY':
+                self.send(b'* CAPABILITY IMAP4rev1')
+                self.send(f'{tag} OK CAPABILITY completed'.encode())
+            elif name in ('LOGIN', 'NOOP', 'CLOSE'):
+                self.send(f'{tag} OK {name} completed'.encode())
+            elif name == 'LOGOUT':
+                self.send(b'* BYE stand-in logging out')
+                self.send(f'{tag} OK LOGOUT completed'.encode())
+                return
+            elif name in ('SELECT', 'EXAMINE'):
+                self.select(tag, args.strip().strip('"'))
+            elif name == 'UID' and self.selected is not None:
+                subcommand, _, args = args.partition(' ')
+                if subcommand.upper() == 'SEARCH':
+                    self.search(tag, args)
+                elif subcommand.upper() == 'FETCH':
+                    self.fetch(tag, *args.split(' ', 1))
+                else:
+                    self.send(f'{tag} BAD unknown UID command'.encode())
+            else:
+                self.send(f'{tag} BAD unknown command'.encode())
+
+    def select(self, tag: str, mailbox: str):
+        if mailbox not in self.server.mailboxes:
+            self.selected = None
+            self.send(f'{tag} NO [NONEXISTENT] unknown mailbox'.encode())
+            return
+
+        self.selected = mailbox
+        uids = self.server.uids(mailbox)
+        self.send(f'* {len(uids)} EXISTS'.encode())
+        self.send(f'* OK [UIDVALIDITY {self.server.uidvalidity}] UIDs valid'.encode())
+        self.send(f'* OK [UIDNEXT {max(uids, default=0) + 1}] predicted next UID'.encode())
+        self.send(f'{tag} OK [READ-ONLY] EXAMINE completed'.encode())
+
+    def message_set(self, value: str) -> List[int]:
+        uids = self.server.uids(self.selected) # type: ignore
+        highest = max(uids, default=0)
+        selected = set()
+        for item in value.split(','):
+            start, _, end = item.partition(':')
+            start_uid = highest if start == '*' else int(start)
+            end_uid = start_uid if not end else highest if end == '*' else int(end)
+            low, high = sorted((start_uid, end_uid))
+            selected.update(uid for uid in uids if low <= uid <= high)
+        return sorted(selected)
+
+    def search(self, tag: str, args: str):
+        criteria = args.split()
+        uids = self.message_set(criteria[1]) if len(criteria) == 2 and criteria[0].upper() == 'UID' else []
+        self.send(('* SEARCH ' + ' '.join(str(uid) for uid in uids)).rstrip().encode())
+        self.send(f'{tag} OK SEARCH completed'.encode())
+
+    def fetch(self, tag: str, message_set: str, items: str = ''):
+        uids = self.server.uids(self.selected) # type: ignore
+        selected = self.message_set(message_set)
+        if 'BODY' in items.replace('BODYSTRUCTURE', '') and self.server.fail_uids.intersection(selected):
+            self.send(f'{tag} NO [UNAVAILABLE] stand-in fetch failure'.encode())
+            return
+
+        for uid in selected:
+            raw = self.server.mailboxes[self.selected][uid - 1] # type: ignore
+            message = email.message_from_bytes(raw)
+
+            response = f'* {uids.index(uid) + 1} FETCH ('.encode()
+            fields = []
+            for match in _ITEM_RE.finditer(items):
+                item = match.group(0)
+                if item == 'UID':
+                    fields.append(f'UID {uid}'.encode())
+                elif item == 'RFC822.SIZE':
+                    fields.append(f'RFC822.SIZE {len(raw)}'.encode())
+                elif item == 'BODYSTRUCTURE':
+                    fields.append(f'BODYSTRUCTURE {body_structure(message)}'.encode())
+                else:
+                    section = match.group(1)
+                    data = raw if section == '' else body_section(message, section)
+                    origin = ''
+                    if match.group(2) is not None:
+                        data = data[int(match.group(2)):int(match.group(2)) + int(match.group(3))]
+                        origin = f'<{match.group(2)}>'
+                    self.server.add_sent(len(data))
+                    fields.append(f'BODY[{section}]{origin} {{{len(data)}}}\r\n'.encode() + data)
+            self.send(response + b' '.join(fields) + b')')
+        self.send(f'{tag} OK FETCH completed'.encode())
+
+
+class StandInImapServer(socketserver.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mailboxes: Dict[str, List[bytes]], uidvalidity: int = 1, fail_uids: Optional[Set[int]] = None):
+        """Start the stand-in server on a free port of localhost.
+
+        Args:
+            mailboxes (Dict[str, List[bytes]]): the raw messages of each mailbox, the UID of a message is its position plus one.
+            uidvalidity (int, optional): UIDVALIDITY of the mailboxes. Defaults to 1.
+            fail_uids (Optional[Set[int]], optional): a FETCH of the body of one of these messages answers NO. Defaults to None.
+        """
+
+        super().__init__(('127.0.0.1', 0), StandInImapHandler)
+        self.mailboxes = mailboxes
+        self.uidvalidity = uidvalidity
+        self.fail_uids = set(fail_uids or ())
+        self.commands: List[str] = []
+        self.sent_bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def uids(self, mailbox: str) -> List[int]:
+        return list(range(1, len(self.mailboxes[mailbox]) + 1))
+
+    def record(self, command: str):
+        with self._lock:
+            self.commands.append(command)
+
+    def add_sent(self, n_bytes: int):
+        with self._lock:
+            self.sent_bytes += n_bytes
+
+    def fetches(self) -> List[str]:
+        return [command for command in self.commands if command.upper().startswith('UID FETCH')]
+
+    def __enter__(self) -> 'StandInImapServer':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
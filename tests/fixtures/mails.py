@@ -0,0 +1,37 @@
+"""Sample mails served by the stand-in IMAP server: a plain text mail, a mail with
+alternative parts and a binary attachment, an html only mail and an html mail with a
+text attachment.
+"""
+
+from email.message import EmailMessage
+
+
+ATTACHMENT = bytes(range(256)) * 400
+
+
+def make_mail(subject: str, text=None, html=None, attachment=None, text_attachment=None) -> bytes:
+    message = EmailMessage()
+    message['From'] = 'Alice <alice@example.com>'
+    message['Subject'] = subject
+    message['Date'] = 'Mon, 04 Mar 2024 10:00:00 +0100'
+    message['Message-ID'] = f'<{subject.replace(" ", "-")}@example.com>'
+    if text is not None:
+        message.set_content(text)
+    if html is not None:
+        if text is None:
+            message.set_content(html, subtype='html')
+        else:
+            message.add_alternative(html, subtype='html')
+    if attachment is not None:
+        message.add_attachment(attachment, maintype='application', subtype='pdf', filename='invoice.pdf')
+    if text_attachment is not None:
+        message.add_attachment(text_attachment, filename='notes.txt')
+    return message.as_bytes()
+
+
+MAILS = [
+    make_mail('Plain', text='Hello from Alice'),
+    make_mail('Invoice', text='Your invoice is attached', html='<p>Your <b>invoice</b> is attached</p>', attachment=ATTACHMENT),
+    make_mail('Newsletter', html='<p>Spring <i>news</i></p>'),
+    make_mail('Log', html='<p>See the log</p>', text_attachment='a log line\n'),
+]
@@ -0,0 +1,125 @@
+"""Small NoteStore.sqlite with the tables and columns read by NoteStoreReader.
+
+The bodies are protobuf messages, NoteStoreProto.document(2).note(3).note_text(2),
+gzipped like Notes.app does or left raw, with unrelated fields around the text.
+"""
+
+import gzip
+import sqlite3
+
+from typing import Optional
+
+
+STORE_UUID = '3A5C2E1B-0000-4D6F-9A7B-FIXTURE00001'
+
+# Seconds since 2001-01-01, the Core Data epoch
+CREATED = 700000000.0
+MODIFIED = 700003600.0
+MODIFIED_LATER = 700090000.0
+
+LONG_TEXT = 'Team offsite in Lyon, ' + 'agenda to be confirmed. ' * 8
+
+
+def varint(value: int) -> bytes:
+    encoded = b''
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            encoded += bytes([byte | 0x80])
+        else:
+            return encoded + bytes([byte])
+
+
+def length_field(number: int, payload: bytes) -> bytes:
+    return varint(number << 3 | 2) + varint(len(payload)) + payload
+
+
+def note_body(text: str, compress: bool = True) -> bytes:
+    """Encode a note body like the ZDATA column.
+
+    Args:
+        text (str): the note text.
+        compress (bool, optional): gzip the protobuf. Defaults to True.
+
+    Returns:
+        bytes: the blob.
+    """
+
+    # A varint and a fixed64 field come before the text, they must be skipped
+    note = varint(1 << 3 | 0) + varint(300) + varint(3 << 3 | 1) + b'\x00' * 8 + length_field(2, text.encode('utf-8'))
+    document = varint(1 << 3 | 0) + varint(1) + length_field(3, note)
+    data = varint(1 << 3 | 0) + varint(0) + length_field(2, document)
+    return gzip.compress(data, mtime=0) if compress else data
+
+
+def corrupted_body(text: str) -> bytes:
+    """Encode a note body whose gzip header is valid but whose deflate stream is not.
+
+    Args:
+        text (str): the note text.
+
+    Returns:
+        bytes: the blob.
+    """
+
+    data = bytearray(note_body(text))
+    # The deflate stream starts after the 10 bytes of the header
+    data[10] ^= 0xff
+    return bytes(data)
+
+
+def make_notestore(path: str, created_column: str = 'ZCREATIONDATE3') -> str:
+    """Write the fixture store.
+
+    Args:
+        path (str): location of the sqlite file.
+        created_column (str, optional): creation date column of the macOS version. Defaults to 'ZCREATIONDATE3'.
+
+    Returns:
+        str: the path.
+    """
+
+    connection = sqlite3.connect(path)
+    connection.executescript(f'''
+        CREATE TABLE Z_METADATA (Z_VERSION INTEGER PRIMARY KEY, Z_UUID VARCHAR(255), Z_PLIST BLOB);
+        CREATE TABLE ZICNOTEDATA (Z_PK INTEGER PRIMARY KEY, ZNOTE INTEGER, ZDATA BLOB);
+        CREATE TABLE ZICCLOUDSYNCINGOBJECT (
+            Z_PK INTEGER PRIMARY KEY,
+            ZTITLE1 VARCHAR,
+            ZTITLE2 VARCHAR,
+            ZFOLDER INTEGER,
+            ZNOTEDATA INTEGER,
+            ZMARKEDFORDELETION INTEGER,
+            {created_column} TIMESTAMP,
+            ZMODIFICATIONDATE1 TIMESTAMP
+        );
+    ''')
+    connection.execute('INSERT INTO Z_METADATA VALUES (1, ?, NULL)', (STORE_UUID,))
+
+    def add(primary_key: int, title: Optional[str], folder: Optional[int] = None, body: Optional[bytes] = None,
+            deleted: int = 0, folder_title: Optional[str] = None, modified: float = MODIFIED):
+        data_key = None
+        if body is not None:
+            data_key = 100 + primary_key
+            connection.execute('INSERT INTO ZICNOTEDATA VALUES (?, ?, ?)', (data_key, primary_key, body))
+        connection.execute(
+            'INSERT INTO ZICCLOUDSYNCINGOBJECT VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (primary_key, title, folder_title, folder, data_key, deleted,
+             CREATED if body is not None else None, modified if body is not None else None)
+        )
+
+    # The folders are rows of the same table, titled in ZTITLE2
+    add(1, None, folder_title='Work ')
+    add(2, None, folder_title='Personal')
+
+    add(3, 'Offsite', folder=1, body=note_body(LONG_TEXT))
+    add(4, ' Groceries ', folder=2, body=note_body('Café, crème fraîche\nbread', compress=False), modified=MODIFIED_LATER)
+    add(5, '', folder=2, body=note_body('A note without title'))
+    add(6, 'Deleted', folder=1, body=note_body('In the trash'), deleted=1)
+    add(7, 'Corrupted', folder=1, body=b'\x1f\x8b' + b'not gzip')
+    add(8, 'Bad deflate', folder=1, body=corrupted_body(LONG_TEXT))
+
+    connection.commit()
+    connection.close()
+    return path
@@ -0,0 +1,92 @@
+import asyncio
+import io
+import json
+import pytest
+
+from benchmarks.llm_server import StandInLLMServer
+
+
+# The engine needs the clients and numpy, the tests are skipped without them
+for module in ('chromadb', 'numpy', 'openai'):
+    pytest.importorskip(module)
+
+from src.batch import run_batch
+
+
+QUESTIONS = [{'id': f'q{i}', 'query': f'When is the offsite number {i}?'} for i in range(6)]
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setenv('BATCH_RETRY_DELAY', '0.01')
+
+
+def run(engine, questions, **kwargs):
+    output = io.StringIO()
+    summary = asyncio.run(run_batch(engine, questions, output, n_results=3, **kwargs))
+    return summary, [json.loads(line) for line in output.getvalue().splitlines()]
+
+
+@pytest.mark.parametrize('status', [429, 500, 503])
+def test_overloaded_llm_is_retried(make_engine, status):
+    with StandInLLMServer(first_token_delay=0.0, token_delay=0.0, fail_first=2, fail_status=status) as server:
+        summary, records = run(make_engine(server.base_url), QUESTIONS[:1], concurrency=1, max_retries=4)
+
+    assert summary['answered'] == 1 and summary['failed'] == 0
+    assert records[0]['answer'] == server.answer
+    assert records[0]['attempts'] == 3
+    assert len(server.requests) == 3
+
+
+def test_failed_question_does_not_abort_the_batch(make_engine):
+    # A single failure and no retry, one of the questions fails
+    with StandInLLMServer(first_token_delay=0.0, token_delay=0.0, fail_first=1) as server:
+        summary, records = run(make_engine(server.base_url), QUESTIONS, concurrency=1, max_retries=0)
+
+    assert summary['questions'] == len(QUESTIONS)
+    assert summary['failed'] == 1 and summary['answered'] == len(QUESTIONS) - 1
+    assert len(records) == len(QUESTIONS)
+
+    failed = [record for record in records if 'error' in record]
+    assert len(failed) == 1
+    assert failed[0]['answer'] is None and failed[0]['error']
+    assert all(record['answer'] == server.answer for record in records if 'error' not in record)
+
+
+def test_record_shape(make_engine, llm_server):
+    summary, records = run(make_engine(llm_server.base_url), QUESTIONS[:2], concurrency=2)
+
+    assert sorted(record['index'] for record in records) == [0, 1]
+    for record in records:
+        question = QUESTIONS[record['index']]
+        assert set(record) == {'index', 'id', 'query', 'documents', 'answer', 'cached', 'attempts', 'timings'}
+        assert record['id'] == question['id'] and record['query'] == question['query']
+        assert record['documents'] == [['notes', 'note-offsite']]
+        assert record['cached'] is False and record['attempts'] == 1
+        assert set(record['timings']) == {'embedding_ms', 'search_ms', 'llm_ms'}
+
+    assert {'embedding_ms', 'search_ms', 'total_s'} <= set(summary)
+
+
+def test_concurrency_is_capped(make_engine):
+    with StandInLLMServer(first_token_delay=0.05, token_delay=0.0) as server:
+        engine = make_engine(server.base_url)
+
+        # The LLM calls in flight are counted around the engine
+        complete_async = engine.complete_async
+        in_flight, peak = 0, 0
+
+        async def counted(prompt):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            try:
+                return await complete_async(prompt)
+            finally:
+                in_flight -= 1
+
+        engine.complete_async = counted
+        summary, records = run(engine, QUESTIONS, concurrency=2)
+
+    assert summary['answered'] == len(QUESTIONS)
+    assert peak == 2
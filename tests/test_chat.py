@@ -0,0 +1,89 @@
+import pytest
+
+# The engine needs the clients and numpy, the tests are skipped without them
+for module in ('chromadb', 'numpy', 'openai'):
+    pytest.importorskip(module)
+
+import src.embedding.chunking
+
+from src.chat import ChatSession, count_tokens
+
+
+@pytest.fixture(autouse=True)
+def count_words(monkeypatch):
+    # The words are counted instead of the tokens, the budget does not depend on a downloaded tokenizer
+    monkeypatch.setattr(src.embedding.chunking, 'get_tokenizer', lambda model_name: None)
+
+
+def test_answer_is_streamed(make_engine, llm_server):
+    session = ChatSession(make_engine(llm_server.base_url), n_results=3)
+
+    chunks = list(session.ask('When is the team offsite?'))
+
+    assert len(chunks) == len(llm_server.answer.split(' '))
+    assert ''.join(chunks) == llm_server.answer
+    assert llm_server.requests[-1]['stream'] is True
+    assert 0 <= session.last_turn['retrieval'] <= session.last_turn['ttft'] <= session.last_turn['total']
+
+
+def test_follow_up_reuses_documents(make_engine, llm_server):
+    engine = make_engine(llm_server.base_url)
+    session = ChatSession(engine, n_results=3, topic_similarity=0.6)
+
+    turns = []
+    for question in ['When is the team offsite?', 'And where is the offsite?', 'Was the bank transfer refunded?']:
+        ''.join(session.ask(question))
+        turns.append(session.last_turn)
+
+    assert [turn['reused'] for turn in turns] == [False, True, False]
+    assert engine.retriever.searches == ['When is the team offsite?', 'Was the bank transfer refunded?']
+    # The follow-up is answered with the documents of its topic
+    assert 'Everything about the offsite.' in turns[1]['prompt']
+    assert 'Everything about the bank.' in turns[2]['prompt']
+
+    session.reset()
+    ''.join(session.ask('And where is the offsite?'))
+    assert session.last_turn['reused'] is False
+    assert len(session.history) == 2
+
+
+def test_history_stays_within_budget(make_engine, llm_server):
+    llm_server.answer = 'Next Friday.'
+    questions = ['When is the team offsite?', 'And where is the offsite?', 'Who organizes the offsite?']
+    turn_tokens = max(count_tokens(question) for question in questions) + count_tokens(llm_server.answer)
+
+    # Room for two turns, not for three
+    session = ChatSession(make_engine(llm_server.base_url), n_results=3, history_tokens=2 * turn_tokens)
+    for question in questions:
+        ''.join(session.ask(question))
+
+    assert sum(message['tokens'] for message in session.history) <= session.history_tokens
+    assert [message['content'] for message in session.history] == [
+        questions[1], llm_server.answer, questions[2], llm_server.answer
+    ]
+
+    # The last question was sent with the turns kept before it, without their documents
+    messages = llm_server.requests[-1]['messages']
+    assert [message['role'] for message in messages] == ['system', 'user', 'assistant', 'user', 'assistant', 'user']
+    assert messages[1]['content'] == questions[0]
+    assert messages[3]['content'] == questions[1]
+    assert questions[2] in messages[-1]['content'] and 'Retrieved Documents' in messages[-1]['content']
+
+
+def test_lexical_chat_does_not_embed(make_engine, llm_server, monkeypatch):
+    engine = make_engine(llm_server.base_url)
+    engine.retriever.mode = 'lexical'
+
+    def embed(query):
+        raise AssertionError('the lexical retrieval must not load the embedding model')
+
+    monkeypatch.setattr(engine.retriever, 'embed', embed)
+    session = ChatSession(engine, n_results=3)
+
+    for question in ['When is the team offsite?', 'And where is the offsite?']:
+        assert ''.join(session.ask(question)) == llm_server.answer
+        assert session.last_turn['reused'] is False
+        assert 'Everything about the offsite.' in session.last_turn['prompt']
+
+    # Without embeddings each question is searched
+    assert len(engine.retriever.searches) == 2
@@ -0,0 +1,28 @@
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+
+# The cached embedding function implements the chroma interface
+pytest.importorskip('chromadb')
+
+from src.embedding.cache import EmbeddingCache
+
+
+def test_vectors_are_cached_per_model(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / 'embeddings.sqlite'))
+    cache.put_many('model', ['a', 'b'], [[1.0, 2.0], [3.0, 4.0]])
+
+    assert cache.get_many('model', ['a', 'c', 'b']) == [[1.0, 2.0], None, [3.0, 4.0]]
+    assert cache.get_many('model:int8', ['a']) == [None]
+    assert cache.dimension('model') == 2
+    assert cache.stats() == {'hits': 2, 'misses': 2}
+
+
+def test_counters_are_shared_by_threads(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / 'embeddings.sqlite'))
+    cache.put_many('model', ['cached'], [[1.0]])
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda _: cache.get_many('model', ['cached', 'new', 'other']), range(400)))
+
+    assert cache.stats() == {'hits': 400, 'misses': 800}
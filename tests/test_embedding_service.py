@@ -0,0 +1,44 @@
+import pytest
+
+from src.embedding.service import (
+    DIMENSION_KEY, MODEL_KEY, EmbeddingModelMismatchError, EmbeddingService, check_collection_model, record_collection_model
+)
+
+
+MODEL = 'all-MiniLM-L6-v2'
+
+
+class StandInCollection():
+
+    def __init__(self, metadata=None):
+        self.metadata = metadata
+
+    def modify(self, metadata):
+        self.metadata = metadata
+
+
+@pytest.mark.parametrize('backend, key', [('torch', MODEL), ('onnx', MODEL), ('onnx-int8', f'{MODEL}:int8')])
+def test_cache_key(backend, key):
+    assert EmbeddingService(MODEL, backend).cache_key == key
+
+
+def test_record_collection_model():
+    index = StandInCollection({'hnsw:space': 'cosine'})
+
+    record_collection_model(index, EmbeddingService(MODEL, 'onnx-int8').cache_key, 384)
+
+    assert index.metadata == {MODEL_KEY: f'{MODEL}:int8', DIMENSION_KEY: 384}
+
+
+@pytest.mark.parametrize('stored, configured', [(MODEL, f'{MODEL}:int8'), (f'{MODEL}:int8', MODEL), ('other-model', MODEL)])
+def test_other_quantization_is_refused(stored, configured):
+    with pytest.raises(EmbeddingModelMismatchError, match='--flush'):
+        check_collection_model({MODEL_KEY: stored}, configured)
+
+
+def test_same_model_is_accepted():
+    check_collection_model({MODEL_KEY: f'{MODEL}:int8', DIMENSION_KEY: 384}, f'{MODEL}:int8', 384)
+    check_collection_model({}, MODEL, 384)
+
+    with pytest.raises(EmbeddingModelMismatchError):
+        check_collection_model({MODEL_KEY: MODEL, DIMENSION_KEY: 384}, MODEL, 768)
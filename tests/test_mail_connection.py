@@ -0,0 +1,55 @@
+import imaplib
+import pytest
+
+from src.ingestion.mails.connection import ImapPool, MailboxError
+
+
+class StandInConnection():
+
+    def __init__(self):
+        self.logged_out = False
+
+    def logout(self):
+        self.logged_out = True
+
+
+@pytest.fixture
+def pool():
+    opened = []
+
+    def connect():
+        opened.append(StandInConnection())
+        return opened[-1]
+
+    pool = ImapPool(1, connect=connect)
+    pool.opened = opened
+    return pool
+
+
+def borrow(pool, error=None):
+    with pool.connection() as mail:
+        if error is not None:
+            raise error
+        return mail
+
+
+def test_connection_is_reused(pool):
+    assert borrow(pool) is borrow(pool)
+    assert len(pool.opened) == 1 and not pool.opened[0].logged_out
+
+
+def test_refused_mailbox_keeps_the_connection(pool):
+    with pytest.raises(MailboxError):
+        borrow(pool, MailboxError('unknown mailbox'))
+
+    assert borrow(pool) is pool.opened[0]
+
+
+@pytest.mark.parametrize('error', [imaplib.IMAP4.abort('socket closed'), OSError('reset'), ValueError('bad response')])
+def test_failed_connection_is_logged_out(pool, error):
+    with pytest.raises(type(error)):
+        borrow(pool, error)
+
+    # The slot is free again and a new connection is opened
+    assert pool.opened[0].logged_out
+    assert borrow(pool) is pool.opened[1]
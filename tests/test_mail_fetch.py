@@ -0,0 +1,140 @@
+import imaplib
+import pytest
+
+from src.ingestion.mails.fetch import (
+    compress_uid_set, fetch_messages, fetch_text_messages, find_text_part, parse_sexp, plan_batches
+)
+from src.ingestion.mails.parsing import parse_raw_mail_data
+
+from tests.fixtures.imap_server import StandInImapServer
+from tests.fixtures.mails import ATTACHMENT, MAILS
+
+
+def test_compress_uid_set():
+    assert compress_uid_set([]) == ''
+    assert compress_uid_set([5]) == '5'
+    assert compress_uid_set([9, 3, 1, 2, 2, 7, 10, 11]) == '1:3,7,9:11'
+
+
+def test_plan_batches_by_count():
+    assert plan_batches([5, 1, 3, 2, 4], batch_size=2) == [[1, 2], [3, 4], [5]]
+
+
+def test_plan_batches_by_bytes():
+    sizes = {1: 400, 2: 400, 3: 5000, 4: 100, 5: 100}
+
+    # The oversized message gets a batch of its own
+    assert plan_batches([1, 2, 3, 4, 5], batch_size=10, max_batch_bytes=1000, sizes=sizes) == [[1, 2], [3], [4, 5]]
+    # A message without a known size counts for nothing
+    assert plan_batches([1, 2, 6], batch_size=10, max_batch_bytes=1000, sizes=sizes) == [[1, 2, 6]]
+
+
+def test_parse_sexp():
+    parsed = parse_sexp(b'("text" "plain" ("charset" "utf-8") NIL nil "7bit" 12 ("a \\"quoted\\" \\\\ name"))')
+
+    assert parsed == [['text', 'plain', ['charset', 'utf-8'], None, None, '7bit', '12', ['a "quoted" \\ name']]]
+
+
+def test_parse_sexp_unbalanced():
+    # A truncated line is closed, an extra parenthesis is ignored
+    assert parse_sexp(b'(1 (2 3') == [['1', ['2', '3']]]
+    assert parse_sexp(b'1) 2') == ['1', '2']
+
+
+def structure(line: bytes):
+    return parse_sexp(line)[0]
+
+
+def test_find_text_part_single():
+    part = find_text_part(structure(b'("TEXT" "PLAIN" ("CHARSET" "iso-8859-1") NIL NIL "QUOTED-PRINTABLE" 120 4 NIL NIL NIL NIL)'))
+
+    assert part == {'section': '1', 'subtype': 'plain', 'encoding': 'quoted-printable', 'charset': 'iso-8859-1', 'size': 120}
+
+
+def test_find_text_part_prefers_plain():
+    line = (
+        b'((("text" "html" ("charset" "utf-8") NIL NIL "7bit" 80 2 NIL NIL NIL NIL)'
+        b'("text" "plain" NIL NIL NIL "base64" 40 1 NIL NIL NIL NIL) "alternative" ("boundary" "b2") NIL NIL NIL)'
+        b'("application" "pdf" ("name" "a.pdf") NIL NIL "base64" 90000 NIL ("attachment" ("filename" "a.pdf")) NIL NIL)'
+        b' "mixed" ("boundary" "b1") NIL NIL NIL)'
+    )
+
+    part = find_text_part(structure(line))
+
+    # Without charset parameter the part is read as utf-8
+    assert part == {'section': '1.2', 'subtype': 'plain', 'encoding': 'base64', 'charset': 'utf-8', 'size': 40}
+
+
+def test_find_text_part_skips_attachments():
+    line = (
+        b'(("text" "html" ("charset" "utf-8") NIL NIL "7bit" 80 2 NIL NIL NIL NIL)'
+        b'("text" "plain" ("charset" "utf-8") NIL NIL "7bit" 11 1 NIL ("attachment" ("filename" "notes.txt")) NIL NIL)'
+        b'("message" "rfc822" NIL NIL NIL "7bit" 500 NIL NIL NIL NIL NIL NIL 10 NIL NIL NIL NIL) "mixed" NIL NIL NIL NIL)'
+    )
+
+    assert find_text_part(structure(line))['section'] == '1'
+    assert find_text_part(structure(b'("image" "png" NIL NIL NIL "base64" 300 NIL NIL NIL NIL)')) is None
+
+
+@pytest.fixture
+def imap():
+    with StandInImapServer({'inbox': list(MAILS)}) as server:
+        mail = imaplib.IMAP4('127.0.0.1', server.port)
+        mail.login('alice@example.com', 'secret')
+        mail.select('"inbox"', readonly=True)
+        yield server, mail
+        mail.logout()
+
+
+def test_fetch_messages(imap):
+    server, mail = imap
+
+    fetched = dict(fetch_messages(mail, [4, 1, 2, 3], batch_size=2))
+
+    assert fetched == {uid: raw for uid, raw in enumerate(MAILS, 1)}
+    # One FETCH for the sizes, then one per batch of two messages
+    assert server.fetches() == [
+        'UID FETCH 1:4 (RFC822.SIZE)',
+        'UID FETCH 1:2 (UID BODY.PEEK[])',
+        'UID FETCH 3:4 (UID BODY.PEEK[])',
+    ]
+
+
+def test_fetch_text_messages(imap):
+    server, mail = imap
+
+    fetched = dict(fetch_text_messages(mail, [1, 2, 3, 4]))
+    mails = {uid: parse_raw_mail_data(raw, str(uid)) for uid, raw in fetched.items()}
+
+    assert sorted(mails) == [1, 2, 3, 4]
+    assert mails[1]['content'] == 'Hello from Alice'
+    assert mails[2]['content'] == 'Your invoice is attached'
+    assert 'Spring' in mails[3]['content'] and '<i>' not in mails[3]['content']
+    # The text attachment is not taken for the body
+    assert 'See the log' in mails[4]['content'] and 'a log line' not in mails[4]['content']
+    assert mails[2]['subject'] == 'Invoice' and mails[2]['from'] == 'Alice <alice@example.com>'
+
+    # The attachment is never downloaded
+    assert server.sent_bytes < len(ATTACHMENT)
+    assert not any('BODY.PEEK[]' in command for command in server.fetches())
+
+
+def test_fetch_text_part_is_truncated(imap):
+    server, mail = imap
+
+    fetched = dict(fetch_text_messages(mail, [1], max_part_bytes=5))
+
+    assert parse_raw_mail_data(fetched[1], '1')['content'] == 'Hello'
+    assert server.fetches()[-1].endswith('BODY.PEEK[1]<0.5>)')
+
+
+def test_bodystructures_are_batched(imap):
+    server, mail = imap
+
+    fetched = dict(fetch_text_messages(mail, [1, 2, 3, 4], batch_size=2))
+
+    assert sorted(fetched) == [1, 2, 3, 4]
+    assert [command for command in server.fetches() if 'BODYSTRUCTURE' in command] == [
+        'UID FETCH 1:2 (UID BODYSTRUCTURE)',
+        'UID FETCH 3:4 (UID BODYSTRUCTURE)',
+    ]
@@ -0,0 +1,82 @@
+import imaplib
+import pytest
+
+# The mail ingestion imports the chroma client and the embedding cache
+for module in ('chromadb', 'numpy'):
+    pytest.importorskip(module)
+
+from src.ingestion.mails.connection import MailboxError
+from src.ingestion.mails.ingestion import iter_raw_mails, select_mailbox
+from src.ingestion.mails.state import MailSyncState
+
+from tests.fixtures.imap_server import StandInImapServer
+from tests.fixtures.mails import MAILS
+
+
+@pytest.fixture
+def imap():
+    with StandInImapServer({'inbox': list(MAILS[:2]), 'Archive': []}, uidvalidity=7) as server:
+        mail = imaplib.IMAP4('127.0.0.1', server.port)
+        mail.login('alice@example.com', 'secret')
+        yield server, mail
+        mail.logout()
+
+
+def test_select_mailbox(imap):
+    _, mail = imap
+
+    assert select_mailbox(mail, 'inbox') == (7, 3)
+    with pytest.raises(MailboxError):
+        select_mailbox(mail, 'Missing')
+
+    # The refused mailbox leaves the connection usable
+    assert select_mailbox(mail, 'Archive') == (7, 1)
+
+
+def test_incremental_sync(imap, tmp_path):
+    server, mail = imap
+    state = MailSyncState(str(tmp_path / 'mail_state.json'))
+
+    ids = [mail_id for _, mail_id, _ in iter_raw_mails('inbox', state=state, mail=mail)]
+    assert ids == ['inbox/7/1', 'inbox/7/2']
+    assert state.get('inbox') == {'uidvalidity': 7, 'last_uid': 2}
+
+    # Nothing new, the mailbox is not searched again
+    n_commands = len(server.commands)
+    assert list(iter_raw_mails('inbox', state=state, mail=mail)) == []
+    assert [command.split()[0] for command in server.commands[n_commands:]] == ['EXAMINE']
+
+    server.mailboxes['inbox'].append(MAILS[2])
+    ids = [mail_id for _, mail_id, _ in iter_raw_mails('inbox', state=state, mail=mail)]
+    assert ids == ['inbox/7/3']
+    assert state.get('inbox') == {'uidvalidity': 7, 'last_uid': 3}
+
+
+def test_missing_mailbox_is_not_synced(imap, tmp_path):
+    _, mail = imap
+    state = MailSyncState(str(tmp_path / 'mail_state.json'))
+
+    with pytest.raises(MailboxError):
+        list(iter_raw_mails('Missing', state=state, mail=mail))
+    assert state.get('Missing') is None
+
+
+@pytest.mark.parametrize('fetch_mode', ['text', 'full'])
+def test_failed_batch_is_fetched_again(imap, tmp_path, monkeypatch, fetch_mode):
+    server, mail = imap
+    server.mailboxes['inbox'] = list(MAILS)
+    server.fail_uids = {2}
+    monkeypatch.setenv('IMAP_FETCH_BATCH_SIZE', '1')
+    monkeypatch.setenv('IMAP_FETCH_MODE', fetch_mode)
+    state = MailSyncState(str(tmp_path / 'mail_state.json'))
+
+    # The batch of the second message is refused, the others are fetched
+    ids = [mail_id for _, mail_id, _ in iter_raw_mails('inbox', state=state, mail=mail)]
+    assert sorted(ids) == ['inbox/7/1', 'inbox/7/3', 'inbox/7/4']
+    assert state.get('inbox') == {'uidvalidity': 7, 'last_uid': 1}
+
+    # The next sync fetches it, with the messages after it
+    server.fail_uids = set()
+    ids = [mail_id for _, mail_id, _ in iter_raw_mails('inbox', state=state, mail=mail)]
+    assert sorted(ids) == ['inbox/7/2', 'inbox/7/3', 'inbox/7/4']
+    assert state.get('inbox') == {'uidvalidity': 7, 'last_uid': 4}
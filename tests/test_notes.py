@@ -0,0 +1,115 @@
+import os
+import pytest
+import subprocess
+
+# The notes ingestion imports the chroma client and the embedding cache
+for module in ('chromadb', 'numpy'):
+    pytest.importorskip(module)
+
+from src.ingestion.notes.applescript import RecordedScriptRunner, read_osascript_stream, split_records
+from src.ingestion.notes.ingestion import fetch_notes_by_id, list_notes
+from src.ingestion.notes.manifest import NotesManifest, get_note_id
+
+
+RECORDINGS = os.path.join(os.path.dirname(__file__), 'fixtures', 'notes')
+STORE = 'x-coredata://5F1C0B9E-2D4A-4E8B-9C31-7A0D2E6B1F44/ICNote'
+
+
+@pytest.fixture
+def runner():
+    return RecordedScriptRunner(RECORDINGS)
+
+
+def note_id(primary_key: int) -> str:
+    return get_note_id({'id': f'{STORE}/p{primary_key}'})
+
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 9, 1000])
+def test_split_records(chunk_size):
+    text = 'first|||END|||\nsecond|||END|||\nunterminated'
+    chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+
+    # A delimiter cut between two chunks is still found
+    assert list(split_records(iter(chunks))) == ['first', '\nsecond', '\nunterminated']
+
+
+def test_split_records_drops_blank_tail():
+    assert list(split_records(iter(['a|||END|||', '\n  \n']))) == ['a']
+    assert list(split_records(iter([]))) == []
+
+
+def test_list_notes(runner):
+    listing = list_notes(runner=runner)
+
+    # The untitled note and the malformed record are left out
+    assert set(listing) == {note_id(12), note_id(15), note_id(21)}
+    assert listing[note_id(15)] == {'id': f'{STORE}/p15', 'modified': '2024-02-20-18-02-41', 'folder': 'Personal'}
+    assert note_id(22) in list_notes(ignore_empty_title=False, runner=runner)
+
+
+def test_fetch_notes_by_id(runner):
+    notes = list(fetch_notes_by_id([f'{STORE}/p12', f'{STORE}/p21'], runner=runner))
+
+    # The recording holds a note that was not asked for, it is dropped
+    assert [note['id'] for note in notes] == [f'{STORE}/p12', f'{STORE}/p21']
+    offsite = notes[0]
+    assert offsite['title'] == 'Team offsite'
+    assert offsite['folder'] == 'Work'
+    assert offsite['created'] == '2024-01-10-14-00-00'
+    assert 'Lyon, April 12' in offsite['content'] and '<div>' not in offsite['content']
+
+
+def test_manifest_diff_against_listing(runner, tmp_path):
+    listing = list_notes(runner=runner)
+    notes = {get_note_id(note): note for note in fetch_notes_by_id([entry['id'] for entry in listing.values()], runner=runner)}
+
+    manifest = NotesManifest(str(tmp_path / 'manifest.json'))
+    assert manifest.changed_in_listing(listing) == [entry['id'] for entry in listing.values()]
+
+    manifest.update(notes)
+    manifest.save()
+    manifest = NotesManifest(str(tmp_path / 'manifest.json'))
+    assert manifest.supports_listing()
+    assert manifest.changed_in_listing(listing) == []
+
+    # A modified note, a moved note and a new note are fetched again
+    listing[note_id(12)] = {**listing[note_id(12)], 'modified': '2024-03-02-10-00-00'}
+    listing[note_id(15)] = {**listing[note_id(15)], 'folder': 'Archive'}
+    listing[note_id(30)] = {'id': f'{STORE}/p30', 'modified': '2024-03-06-12-00-00', 'folder': 'Work'}
+    assert manifest.changed_in_listing(listing) == [f'{STORE}/p12', f'{STORE}/p15', f'{STORE}/p30']
+
+    # A note deleted from the app is pruned
+    del listing[note_id(21)]
+    assert manifest.missing(set(listing)) == [note_id(21)]
+
+
+@pytest.fixture
+def osascript(tmp_path, monkeypatch):
+    """Put a fake osascript on the PATH, it writes its records to stderr like the real one.
+    """
+
+    def install(output: str, exit_code: int):
+        script = tmp_path / 'osascript'
+        script.write_text(f'#!/bin/sh\nprintf %s {output!r} >&2\nexit {exit_code}\n')
+        script.chmod(0o755)
+        monkeypatch.setenv('PATH', f'{tmp_path}{os.pathsep}{os.environ.get("PATH", "")}')
+
+    return install
+
+
+def test_read_osascript_stream(osascript):
+    osascript('a|||END|||b|||END|||', 0)
+
+    assert list(read_osascript_stream('list_notes.scpt')) == ['a', 'b']
+
+
+def test_read_osascript_stream_raises_on_failure(osascript):
+    osascript('a|||END|||partial', 1)
+
+    records = []
+    with pytest.raises(subprocess.CalledProcessError):
+        for record in read_osascript_stream('list_notes.scpt'):
+            records.append(record)
+
+    # The records written before the failure are read, the caller decides what to keep
+    assert records == ['a', 'partial']
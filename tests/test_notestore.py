@@ -0,0 +1,96 @@
+import gzip
+import pytest
+
+from src.ingestion.notes.manifest import get_note_id
+from src.ingestion.notes.notestore import COREDATA_EPOCH, NoteStoreReader, coredata_to_str, extract_note_text
+
+from tests.fixtures.notestore import (
+    CREATED, LONG_TEXT, MODIFIED, MODIFIED_LATER, STORE_UUID, corrupted_body, make_notestore, note_body
+)
+
+
+@pytest.fixture(params=['ZCREATIONDATE3', 'ZCREATIONDATE1'])
+def store(request, tmp_path):
+    reader = NoteStoreReader(make_notestore(str(tmp_path / 'NoteStore.sqlite'), request.param))
+    yield reader
+    reader.connection.close()
+
+
+def app_id(primary_key: int) -> str:
+    return f'x-coredata://{STORE_UUID}/ICNote/p{primary_key}'
+
+
+def test_extract_gzipped_body():
+    # The text is longer than 127 bytes, its length is a varint of two bytes
+    assert len(LONG_TEXT.encode('utf-8')) > 127
+    assert extract_note_text(note_body(LONG_TEXT)) == LONG_TEXT
+
+
+def test_extract_raw_body():
+    assert extract_note_text(note_body('Café, crème fraîche', compress=False)) == 'Café, crème fraîche'
+
+
+@pytest.mark.parametrize('data', [None, b'', b'\x1f\x8bnot gzip', corrupted_body(LONG_TEXT), gzip.compress(b'\x12\x05ab')])
+def test_extract_undecodable_body(data):
+    assert extract_note_text(data) == ''
+
+
+def test_stream_notes(store):
+    notes = {note['id']: note for note in store.stream_notes()}
+
+    assert sorted(notes) == [app_id(3), app_id(4), app_id(7), app_id(8)]
+
+    offsite = notes[app_id(3)]
+    assert offsite['title'] == 'Offsite'
+    assert offsite['folder'] == 'Work'
+    assert offsite['content'] == 'Offsite\n' + LONG_TEXT.strip()
+    assert offsite['created'] == coredata_to_str(CREATED)
+    assert offsite['modified'] == coredata_to_str(MODIFIED)
+
+    groceries = notes[app_id(4)]
+    assert groceries['title'] == 'Groceries'
+    assert groceries['folder'] == 'Personal'
+    assert groceries['content'] == 'Groceries\nCafé, crème fraîche\nbread'
+
+    # An unreadable body leaves the title
+    assert notes[app_id(7)]['content'] == 'Corrupted\n'
+    assert notes[app_id(8)]['content'] == 'Bad deflate\n'
+
+
+def test_untitled_notes_can_be_kept(store):
+    ids = [note['id'] for note in store.stream_notes(ignore_empty_title=False)]
+
+    assert app_id(5) in ids
+    assert app_id(6) not in ids
+
+
+def test_list_notes(store):
+    listing = store.list_notes()
+
+    assert set(listing) == {get_note_id({'id': app_id(key)}) for key in (3, 4, 7, 8)}
+    entry = listing[get_note_id({'id': app_id(3)})]
+    assert entry == {'id': app_id(3), 'modified': coredata_to_str(MODIFIED), 'folder': 'Work'}
+
+
+def test_fetch_notes_by_id(store):
+    ids = [app_id(4), app_id(6), 'x-coredata://OTHER-STORE/ICNote/p3', 'unknown']
+
+    notes = list(store.fetch_notes_by_id(ids))
+
+    assert [note['id'] for note in notes] == [app_id(4)]
+
+
+def test_notes_changed_since(store):
+    def changed(timestamp):
+        return sorted(note['id'] for note in store.notes_changed_since(timestamp + COREDATA_EPOCH))
+
+    # Every note was modified after its creation, only one after MODIFIED
+    assert changed(CREATED) == [app_id(3), app_id(4), app_id(7), app_id(8)]
+    assert changed(MODIFIED) == [app_id(4)]
+    assert changed(MODIFIED_LATER) == []
+    assert app_id(5) in [note['id'] for note in store.notes_changed_since(CREATED + COREDATA_EPOCH, ignore_empty_title=False)]
+
+
+def test_coredata_to_str():
+    assert coredata_to_str(None) == ''
+    assert len(coredata_to_str(0)) == len('2001-01-01-00-00-00')